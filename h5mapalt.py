@@ -2,14 +2,25 @@
 # -*- encoding: UTF-8 -*-
 #
 
-import os, sys
+import os, sys, time, io, contextlib, traceback, math
 import random as rand
-import shutil, zipfile
+import bisect, copy, functools, hashlib, json, pickle, shutil, struct, zipfile, zlib
+import concurrent.futures, multiprocessing, tracemalloc
 import xml.etree.ElementTree as ET
 
+try:
+    import numpy as np # optional - selections of all armies are computed as arrays
+except ImportError:
+    np = None
+
+try:
+    import lxml.etree as LET # optional - faster parsing/writing of map file
+except ImportError:
+    LET = None
+
 
 __author__ = "Zich Robert (cichy)"
-__version__ = "1.8.0"
+__version__ = "1.9.0"
 
 
 def printHelp():
@@ -49,6 +60,7 @@ Options:
     --creaMoodRatio=0,3,2,1         Will modify crea mood (probably does not affect groups).
                                         - mood order: FRIENDLY,AGGRESSIVE,HOSTILE,WILD
                                         - value "1,1,0,0" would give us 50% FRIENDLY and 50% AGGRESSIVE
+                                        - ratios can be fractional (value "0.5,1.5,0,0")
     --creaNeutralRatio=-2           To change chance of neutrals to be placed on map.
                                         - creaNeutralRatio == 0: chanceToPlaceOnMap = 1 / (townsCount + 1)
                                         - creaNeutralRatio < 0: chanceToPlaceOnMap = 1 / (townsCount * (creaNeutralRatio * -1 + 1) + 1)
@@ -56,6 +68,7 @@ Options:
     --creaNCF=false                 To load and work with NCF creatures.
                                         - will look for files in data folder, which names starts with "NCF"
                                         - if NFC is used, then --creaNeutralRatio=0, or higher should be set (probably)
+    --creaLoadJobs=1                Number of processes used to load creatures (0 == number of cpus, 1 == no parallel loading).
     
     --enableScripts=true            To enable scripts.
                                         - will enable scripts only if not already enabled
@@ -66,6 +79,7 @@ Options:
     --dwellRatio=4,3,1,0            To choose possible tiers(and theirs weight) of dwell
                                         - tier order: 4,5,6,7
                                         - value "1,1,0,0" would give us 50% T4 and 50% T5
+                                        - ratios can be fractional (value "0.5,1.5,0,0")
                                         - value "0,0,0,0" will disable high tier dwellings and replace them with battle sites 
     --townBuild=""                  To build, or limit some town buildings
                                         - value example "TB_MAGIC_GUILD,1,3,ALL"
@@ -82,10 +96,46 @@ Options:
                                         - town: no Capiton and T5 to T7 dwellings
     
     --nogui                         To run console version (in gui version)
+    --jobs=1                        Number of processes used to change maps (0 == number of cpus).
+                                        - artifacts/creatures are loaded only once
+                                        - if some map fails, other maps are still changed
+    --seed=""                       Seed of random values (same seed, args and map give same changed map).
+                                        - every map and every change (artifacts, creatures, water, ...) has own random values
+                                        - random values of map are given by its path relative to common folder of all changed maps
+                                          (e.g. "A/map.h5m" and "B/map.h5m", or only "map.h5m", if all maps are in same folder)
+                                        - empty value: random values are different with every run
+    --variants=1                    Number of changed maps (variants) to create from one map (map is loaded only once).
+                                        - variants are saved next to map as "name_1.h5m", "name_2.h5m", ... (map is not changed)
+                                        - every variant has own random values
+    --candidates=1                  Number of changed maps (candidates) to choose from, only the most balanced one is saved.
+                                        - balance: power of guards and price of artifacts around players' towns
+                                        - candidates are changed by more processes (arg "jobs"), if only one map is changed
+                                        - seed is generated, if not set (printed to be able to get same map)
     --pathToGameFolder=../          Path to game folder.
     --loadMapFromBck=true           To load map from backup file (backup file is generated with first change).
                                         - better to leave true
     --createMapBck=true             To create backup of original map (only if not exist)
+    --catalogCache=true             To cache loaded artifacts/creatures in file next to "data" folder.
+                                        - cache is rebuilt automatically, when some used archive is changed
+    --xmlBackend=auto               To choose library used to load/save map file (auto, lxml, stdlib).
+                                        - auto: lxml if installed (faster), else stdlib (xml.etree)
+                                        - saved map file is same with both libraries
+    --compressLevel=""              Compression level of saved map (0 - 9, 0 == fastest, 9 == smallest).
+                                        - empty value: default level, only map file is compressed (other files are copied)
+                                        - other value: all files are compressed again
+    --compressJobs=1                Number of threads used to compress saved map (0 == number of cpus).
+    --mapCache=true                 To cache map file (unpacked) of backup file next to it (map is not unpacked with every run).
+                                        - used only when map is loaded from backup
+                                        - cache is rebuilt automatically, when backup is changed
+    --profile=""                    File of performance report (json), wall/cpu time of stages is measured for every map.
+                                        - empty value: no profiling
+                                        - stages: catalogs, load, change stages, save (summary is printed at end)
+    --memprofile=false              To measure also memory of stages (peak, retained, top allocation sites), written to report of arg "profile".
+                                        - report is saved to "h5mapalt_profile.json", if arg "profile" is not set
+                                        - stages are slower, when memory is measured
+    --counters=""                   File of counters report (json), counts of expensive loops/calls are printed for every map.
+                                        - empty value: no counters
+                                        - e.g. town redraws, steps of group power loop, tier by power calls, scanned archive entries, objects of stages
     
     --logArtInit=false              To log art init info.
     --logArtChange=false            To log art change info.
@@ -111,6 +161,18 @@ def resetArgs():
     g["pathToGameFolder"] = "../"
     g["loadMapFromBck"] = "true"
     g["createMapBck"] = "true"
+    g["catalogCache"] = "true"
+    g["mapCache"] = "true"
+    g["xmlBackend"] = "auto"
+    g["compressLevel"] = ""
+    g["compressJobs"] = "1"
+    g["profile"] = ""
+    g["memprofile"] = "false"
+    g["counters"] = ""
+    g["jobs"] = "1"
+    g["seed"] = ""
+    g["variants"] = "1"
+    g["candidates"] = "1"
 
     g["artChange"] = "true"
     g["creaChange"] = "true"
@@ -125,6 +187,7 @@ def resetArgs():
     g["creaGroupRatio"] = "0.55"
     g["creaNeutralRatio"] = "-2"
     g["creaNCF"] = "false"
+    g["creaLoadJobs"] = "1"
     
     g["enableScripts"] = "true"
     g["waterChange"] = "true"
@@ -145,10 +208,11 @@ def resetArgs():
     
     # no args
     g["guiIsShown"] = False
-    g["creaMoodList"] = None
-    g["dwellList"] = None
+    g["creaMoodSampler"] = None
+    g["dwellSampler"] = None
     g["dataFolder"] = None
     g["mainArchFile"] = None
+    g["catalogCacheFile"] = None
 
 
 # custom exception
@@ -176,9 +240,11 @@ def parseArgs(pArgs):
     ignoreArgs = ["--nogui"]
     validArgs = [
         "pathToGameFolder", "loadMapFromBck", "createMapBck", "artChange", 
+        "catalogCache", "mapCache", "xmlBackend", "compressLevel", "compressJobs", 
+        "profile", "memprofile", "counters", "jobs", "seed", "variants", "candidates", 
         "creaChange", "artChangeOnlyRandom", "artRandom", "creaChangeOnlyRandom", 
         "creaMoodChange", "creaMoodRatio", "creaPowerRatio", "creaGroupRatio", 
-        "creaNeutralRatio", "creaRandom", "creaNCF", "enableScripts", 
+        "creaNeutralRatio", "creaRandom", "creaNCF", "creaLoadJobs", "enableScripts", 
         "waterChange", "dwellChange", "dwellRatio", "townBuild", "bonusChest", "bonusArt", 
         "gamePowerLimit", "logArtInit", "logArtChange", "logCreaInit", "logCreaChange", 
         "logWaterChange", "logMapInfo", "logWarnings", "guiIsShown"
@@ -208,6 +274,19 @@ def parseArgs(pArgs):
 
     g["loadMapFromBck"] = g["loadMapFromBck"] in trueStrList
     g["createMapBck"] = g["createMapBck"] in trueStrList
+    g["catalogCache"] = g["catalogCache"] in trueStrList
+    g["mapCache"] = g["mapCache"] in trueStrList
+    if g["xmlBackend"] == "auto":
+        g["xmlBackend"] = "lxml" if LET is not None else "stdlib"
+    elif g["xmlBackend"] not in ["lxml", "stdlib"]:
+        printHelp()
+        Log.error("Value error!")
+    elif g["xmlBackend"] == "lxml" and LET is None:
+        Log.error("Library lxml is not installed!")
+    g["seed"] = g["seed"] if len(g["seed"]) > 0 else None
+    g["memprofile"] = g["memprofile"] in trueStrList
+    g["profile"] = g["profile"] if len(g["profile"]) > 0 else ("h5mapalt_profile.json" if g["memprofile"] else None)
+    g["counters"] = g["counters"] if len(g["counters"]) > 0 else None
 
     g["artChange"] = g["artChange"] in trueStrList
     g["artChangeOnlyRandom"] = g["artChangeOnlyRandom"] in trueStrList
@@ -237,6 +316,19 @@ def parseArgs(pArgs):
         g["creaGroupRatio"] = float(g["creaGroupRatio"])
         g["creaNeutralRatio"] = int(g["creaNeutralRatio"])
         g["bonusChest"] = int(g["bonusChest"])
+        g["creaLoadJobs"] = int(g["creaLoadJobs"])
+        g["jobs"] = int(g["jobs"])
+        g["variants"] = max(1, int(g["variants"]))
+        g["candidates"] = max(1, int(g["candidates"]))
+        g["compressLevel"] = min(9, max(0, int(g["compressLevel"]))) if len(g["compressLevel"]) > 0 else None
+        g["compressJobs"] = int(g["compressJobs"])
+        if g["compressJobs"] <= 0:
+            g["compressJobs"] = os.cpu_count() or 1
+        
+        if g["creaLoadJobs"] <= 0:
+            g["creaLoadJobs"] = os.cpu_count() or 1
+        if g["jobs"] <= 0:
+            g["jobs"] = os.cpu_count() or 1
         
         if g["creaNeutralRatio"] > 8:
             g["creaNeutralRatio"] = 8
@@ -250,8 +342,8 @@ def parseArgs(pArgs):
         if g["creaPowerRatio"] <= 0.0:
             g["creaPowerRatio"] = 1.0
 
-        # fill creaMoodList
-        g["creaMoodList"] = []
+        # fill creaMoodSampler
+        g["creaMoodSampler"] = None
         if creaMoodChange:
             basicMoodList = ["MONSTER_MOOD_FRIENDLY", "MONSTER_MOOD_AGGRESSIVE", "MONSTER_MOOD_HOSTILE", "MONSTER_MOOD_WILD"]
             basicCourageList = ["MONSTER_COURAGE_ALWAYS_JOIN", "MONSTER_COURAGE_ALWAYS_FIGHT", "MONSTER_COURAGE_CAN_FLEE_JOIN"]
@@ -260,20 +352,19 @@ def parseArgs(pArgs):
             if len(moodRatioParts) != 4:
                 printHelp()
                 Log.error("Value error!")
-            for moodIndex, moodRationPart in enumerate(moodRatioParts):
+            moodWeights = []
+            for moodRationPart in moodRatioParts:
                 try:
-                    moodRationPart = int(moodRationPart)
-                    if moodRationPart > 0:
-                        for i in range(moodRationPart):
-                            g["creaMoodList"].append(basicMoodList[moodIndex])
+                    moodWeights.append(float(moodRationPart))
                 except ValueError:
-                    pass
-            if len(g["creaMoodList"]) == 0:
+                    moodWeights.append(0)
+            g["creaMoodSampler"] = WeightedSampler(basicMoodList, moodWeights)
+            if len(g["creaMoodSampler"]) == 0:
                 printHelp()
                 Log.error("Value error!")
     
-    # fill dwellList
-    g["dwellList"] = []
+    # fill dwellSampler
+    g["dwellSampler"] = WeightedSampler([], [])
     if dwellChange:
         basicDwellList = [
             "/MapObjects/Random/RandomDwelling4.xdb#xpointer(/AdvMapDwellingShared)",
@@ -286,14 +377,13 @@ def parseArgs(pArgs):
         if len(dwellRatioParts) != 4:
             printHelp()
             Log.error("Value error!")
-        for dwellIndex, dwellRatioPart in enumerate(dwellRatioParts):
+        dwellWeights = []
+        for dwellRatioPart in dwellRatioParts:
             try:
-                dwellRatioPart = int(dwellRatioPart)
-                if dwellRatioPart > 0:
-                    for i in range(dwellRatioPart):
-                        g["dwellList"].append(basicDwellList[dwellIndex])
+                dwellWeights.append(float(dwellRatioPart))
             except ValueError:
-                pass
+                dwellWeights.append(0)
+        g["dwellSampler"] = WeightedSampler(basicDwellList, dwellWeights)
     
     
     # check map file
@@ -315,10 +405,625 @@ def parseArgs(pArgs):
     g["mainArchFile"] = os.path.join(g["dataFolder"], "data.pak") 
     if not os.path.exists(g["mainArchFile"]):
         Log.error("Archive does not exist: \"{}\"".format(g["mainArchFile"]))
+    
+    # catalog cache file (next to data folder)
+    if g["catalogCache"]:
+        g["catalogCacheFile"] = os.path.join(g["pathToGameFolder"], "h5mapalt_catalog.cache")
 
 
 # main prog
 
+class Profiler:
+    sReport = None # report of current map (None == profiling disabled or outside map)
+    sPath = [] # names of running stages (nested stages)
+    sPeaks = [] # memory peaks of running stages (peaks of finished nested stages)
+    sReports = [] # finished reports (catalogs, maps)
+    sSnapshot = None # memory at start of report
+    sTopSites = 10 # allocation sites in report
+    
+    @classmethod
+    def begin(pClass, pName):
+        if profile is not None:
+            pClass.sReport = {"name": pName, "wall": time.perf_counter(), "cpu": time.process_time(), "stages": {}}
+            pClass.sPath = []
+            pClass.sPeaks = []
+            if memprofile:
+                if not tracemalloc.is_tracing():
+                    tracemalloc.start()
+                pClass.sSnapshot = tracemalloc.take_snapshot()
+                pClass.sReport["memStart"] = tracemalloc.get_traced_memory()[0]
+                pClass.sReport["memPeak"] = 0
+                tracemalloc.reset_peak()
+    
+    @classmethod
+    def end(pClass):
+        # finished report (also returned by map jobs to main process)
+        report = pClass.sReport
+        if report is not None:
+            report["wall"] = time.perf_counter() - report["wall"]
+            report["cpu"] = time.process_time() - report["cpu"]
+            report["stages"] = [dict(name=name, **record) for name, record in report["stages"].items()]
+            if memprofile:
+                current, peak = tracemalloc.get_traced_memory()
+                report["memPeak"] = max(report["memPeak"], peak) - report["memStart"]
+                report["memRetained"] = current - report.pop("memStart")
+                report["memSites"] = pClass.getTopSites(pClass.sSnapshot)
+                pClass.sSnapshot = None
+            pClass.sReports.append(report)
+            pClass.sReport = None
+        return report
+    
+    @classmethod
+    @contextlib.contextmanager
+    def stage(pClass, pName, pObjects=None):
+        # wall/cpu time of stage (repeated stages are summed, nested stages are named "parent/stage")
+        # memory: peak above memory at start of stage, retained memory
+        if pClass.sReport is None:
+            yield
+            return
+        
+        pClass.sPath.append(pName)
+        record = pClass.sReport["stages"].setdefault("/".join(pClass.sPath), {"wall": 0.0, "cpu": 0.0, "calls": 0})
+        if memprofile:
+            memStart, outerPeak = tracemalloc.get_traced_memory()
+            tracemalloc.reset_peak()
+            pClass.sPeaks.append(0)
+        wallStart = time.perf_counter()
+        cpuStart = time.process_time()
+        try:
+            yield
+        finally:
+            record["wall"] += time.perf_counter() - wallStart
+            record["cpu"] += time.process_time() - cpuStart
+            record["calls"] += 1
+            if pObjects is not None:
+                record["objects"] = record.get("objects", 0) + pObjects
+            if memprofile:
+                current, peak = tracemalloc.get_traced_memory()
+                peak = max(peak, pClass.sPeaks.pop())
+                record["memPeak"] = max(record.get("memPeak", 0), peak - memStart)
+                record["memRetained"] = record.get("memRetained", 0) + current - memStart
+                # peak of outer stage (before and within this stage)
+                if len(pClass.sPeaks) > 0:
+                    pClass.sPeaks[-1] = max(pClass.sPeaks[-1], outerPeak, peak)
+                else:
+                    pClass.sReport["memPeak"] = max(pClass.sReport["memPeak"], outerPeak, peak)
+            pClass.sPath.pop()
+    
+    @classmethod
+    def getTopSites(pClass, pSnapshot):
+        # lines with most memory allocated (and not freed) since snapshot (stats are sorted by size difference)
+        stats = [stat for stat in tracemalloc.take_snapshot().compare_to(pSnapshot, "lineno") 
+                 if stat.size_diff > 0 and stat.traceback[0].filename != tracemalloc.__file__]
+        return [{"site": "{}:{}".format(stat.traceback[0].filename, stat.traceback[0].lineno), "size": stat.size_diff, "count": stat.count_diff}
+                for stat in stats[:pClass.sTopSites]]
+    
+    @classmethod
+    def countHandlers(pClass, pHandlers, pCounter):
+        # handlers counting passed objects (only when profiling or counting)
+        if pClass.sReport is None and Counters.sValues is None:
+            return pHandlers
+        
+        def getCounted(pHandler):
+            def handler(pItem):
+                pCounter[0] += 1
+                pHandler(pItem)
+            return handler
+        
+        return {href: getCounted(handler) for href, handler in pHandlers.items()}
+    
+    @classmethod
+    def printSummary(pClass):
+        def getMemText(pRecord):
+            if not memprofile or "memPeak" not in pRecord:
+                return ""
+            return " {:>10.1f} {:>10.1f}".format(pRecord["memPeak"] / 2**20, pRecord["memRetained"] / 2**20)
+        
+        print("")
+        print("{:<40} {:>10} {:>10} {:>7} {:>9}".format("stage", "wall [s]", "cpu [s]", "calls", "objects") 
+              + (" {:>10} {:>10}".format("peak [MiB]", "kept [MiB]") if memprofile else ""))
+        for report in pClass.sReports:
+            print("{:<40} {:>10.3f} {:>10.3f} {:>7} {:>9}".format(os.path.basename(report["name"])[:40], report["wall"], report["cpu"], "", "") 
+                  + getMemText(report))
+            for record in report["stages"]:
+                depth = record["name"].count("/") + 1
+                name = "  " * depth + record["name"].rsplit("/", 1)[-1]
+                print("{:<40} {:>10.3f} {:>10.3f} {:>7} {:>9}".format(name[:40], record["wall"], record["cpu"], record["calls"], record.get("objects", "")) 
+                      + getMemText(record))
+    
+    @classmethod
+    def writeReport(pClass, pFileName):
+        # machine readable report (to be tracked by pipelines)
+        report = {
+            "version": __version__, 
+            "python": sys.version.split()[0], 
+            "xmlBackend": xmlBackend, 
+            "numpy": np is not None, 
+            "jobs": jobs, 
+            "memprofile": memprofile, 
+            "reports": pClass.sReports
+        }
+        with open(pFileName, "w", encoding="utf-8") as reportFile:
+            json.dump(report, reportFile, indent=2)
+        print("profile saved ({})".format(pFileName))
+
+
+class Counters:
+    sValues = None # counters of current map (None == counters disabled or outside map)
+    sName = ""
+    sReports = [] # finished reports (catalogs, maps)
+    
+    @classmethod
+    def begin(pClass, pName):
+        if counters is not None:
+            pClass.sValues = {}
+            pClass.sName = pName
+    
+    @classmethod
+    def end(pClass):
+        # finished report (printed, also returned by map jobs to main process)
+        if pClass.sValues is None:
+            return None
+        
+        report = {"name": pClass.sName, "counters": dict(sorted(pClass.sValues.items()))}
+        pClass.sReports.append(report)
+        pClass.sValues = None
+        print("counters ({}):".format(report["name"]))
+        for name, value in report["counters"].items():
+            print("    {:<36} {:>12}".format(name, value))
+        return report
+    
+    @classmethod
+    def add(pClass, pName, pCount=1):
+        # callers add counts once per call (not in inner loops) - only one check, when disabled
+        if pClass.sValues is not None:
+            pClass.sValues[pName] = pClass.sValues.get(pName, 0) + pCount
+    
+    @classmethod
+    def writeReport(pClass, pFileName):
+        with open(pFileName, "w", encoding="utf-8") as reportFile:
+            json.dump({"version": __version__, "reports": pClass.sReports}, reportFile, indent=2)
+        print("counters saved ({})".format(pFileName))
+
+
+class CatalogCache:
+    sVersion = 1
+    sFile = None
+    sData = None
+    
+    @staticmethod
+    def getArchKey(pArchFiles):
+        # archives are identified by path, size and modification time
+        key = []
+        for archFile in pArchFiles:
+            stat = os.stat(archFile)
+            key.append((os.path.abspath(archFile), stat.st_size, stat.st_mtime_ns))
+        return key
+    
+    @classmethod
+    def load(pClass):
+        pClass.sFile = catalogCacheFile
+        pClass.sData = {}
+        if catalogCacheFile is None or not os.path.exists(catalogCacheFile):
+            return
+        
+        try:
+            with open(catalogCacheFile, "rb") as cacheFile:
+                data = pickle.load(cacheFile)
+            if data.get("version") == (pClass.sVersion, __version__):
+                pClass.sData = data["sections"]
+        except Exception as ex:
+            Log.warning("Catalog cache cannot be loaded! ({})".format(ex))
+    
+    @classmethod
+    def getTables(pClass, pSection, pArchFiles):
+        if catalogCacheFile is None:
+            return None
+        if pClass.sData is None or pClass.sFile != catalogCacheFile:
+            pClass.load()
+        
+        section = pClass.sData.get(pSection)
+        if section is not None and section["key"] == pClass.getArchKey(pArchFiles):
+            return section["tables"]
+        return None
+    
+    @classmethod
+    def setTables(pClass, pSection, pArchFiles, pTables):
+        if catalogCacheFile is None:
+            return
+        if pClass.sData is None or pClass.sFile != catalogCacheFile:
+            pClass.load()
+        
+        pClass.sData[pSection] = {"key": pClass.getArchKey(pArchFiles), "tables": pTables}
+        
+        # write to temp file first - cache is never left half written
+        tempFile = catalogCacheFile + ".tmp"
+        try:
+            with open(tempFile, "wb") as cacheFile:
+                pickle.dump({"version": (pClass.sVersion, __version__), "sections": pClass.sData}, cacheFile, pickle.HIGHEST_PROTOCOL)
+            os.replace(tempFile, catalogCacheFile)
+        except OSError as ex:
+            Log.warning("Catalog cache cannot be saved! ({})".format(ex))
+
+
+class XmlBackend:
+    # map file is loaded/saved by lxml or by xml.etree (stdlib), elements are created by same library as map tree
+    sWriteDepth = 2 # elements up to this depth are written by parts (root, its children and their children)
+    sWriteBufferSize = 1024 * 1024
+    
+    @staticmethod
+    def getParser():
+        return LET.XMLParser(remove_comments=True, remove_pis=True, huge_tree=True)
+    
+    @classmethod
+    def parse(pClass, pFile):
+        if xmlBackend == "lxml":
+            return LET.parse(pFile, pClass.getParser())
+        return ET.parse(pFile)
+    
+    @classmethod
+    def fromBytes(pClass, pData):
+        if xmlBackend == "lxml":
+            return LET.ElementTree(LET.fromstring(pData, pClass.getParser()))
+        return ET.ElementTree(ET.fromstring(pData))
+    
+    @staticmethod
+    def fixLxmlBytes(pData):
+        # same output as xml.etree (empty elements are written with space, tab in attribute is written with zero)
+        # ">" is always escaped by lxml, so "/>" is only end of empty element
+        return pData.replace(b"/>", b" />").replace(b"&#9;", b"&#09;")
+    
+    @classmethod
+    def iterLxmlBytes(pClass, pElement, pDepth):
+        # element is written by parts (start tag, children, end tag), deepest parts are written whole
+        if pDepth >= pClass.sWriteDepth or len(pElement) == 0:
+            yield pClass.fixLxmlBytes(LET.tostring(pElement, encoding="UTF-8", with_tail=pDepth > 0))
+            return
+        
+        startElement = LET.Element(pElement.tag, dict(pElement.attrib))
+        startElement.text = pElement.text if pElement.text is not None else ""
+        startData = LET.tostring(startElement, encoding="UTF-8")
+        startData = startData[:startData.rindex(b"</")]
+        yield pClass.fixLxmlBytes(startData)
+        for child in pElement:
+            yield from pClass.iterLxmlBytes(child, pDepth + 1)
+        yield "</{}>".format(pElement.tag).encode("UTF-8")
+        if pDepth > 0 and pElement.tail is not None:
+            tailElement = LET.Element("tail")
+            tailElement.tail = pElement.tail
+            yield LET.tostring(tailElement, encoding="UTF-8", with_tail=True)[len(b"<tail/>"):]
+    
+    @classmethod
+    def write(pClass, pTree, pFile):
+        if xmlBackend == "lxml":
+            # written by parts - memory is limited by buffer size and biggest part (single map object)
+            pFile.write(b"<?xml version='1.0' encoding='UTF-8'?>\n")
+            chunks = []
+            chunksSize = 0
+            for data in pClass.iterLxmlBytes(pTree.getroot(), 0):
+                chunks.append(data)
+                chunksSize += len(data)
+                if chunksSize >= pClass.sWriteBufferSize:
+                    pFile.write(b"".join(chunks))
+                    chunks = []
+                    chunksSize = 0
+            pFile.write(b"".join(chunks))
+        else:
+            # written directly to file (by small buffer)
+            pTree.write(pFile, "UTF-8", True)
+    
+    @classmethod
+    def toBytes(pClass, pTree):
+        output = io.BytesIO()
+        pClass.write(pTree, output)
+        return output.getvalue()
+    
+    @staticmethod
+    def element(pTag):
+        if xmlBackend == "lxml":
+            return LET.Element(pTag)
+        return ET.Element(pTag)
+    
+    @staticmethod
+    def subElement(pParent, pTag):
+        # works with elements of both libraries
+        element = pParent.makeelement(pTag, {})
+        pParent.append(element)
+        return element
+
+
+class MapCache:
+    sVersion = 1
+    sExt = ".cache"
+    sMemory = None # last entry only (file name, hash, entry) - repeated runs of same map in one process (gui)
+    
+    @staticmethod
+    def getHash(pFileName):
+        fileHash = hashlib.sha1()
+        with open(pFileName, "rb") as file:
+            for data in iter(lambda: file.read(1024 * 1024), b""):
+                fileHash.update(data)
+        return fileHash.hexdigest()
+    
+    @classmethod
+    def get(pClass, pFileName):
+        # entry of map arch (unpacked map file and arch members), if arch was not changed
+        fileHash = pClass.getHash(pFileName)
+        if pClass.sMemory is not None and pClass.sMemory[:2] == (os.path.abspath(pFileName), fileHash):
+            return fileHash, pClass.sMemory[2]
+        
+        cacheFileName = pFileName + pClass.sExt
+        if os.path.exists(cacheFileName):
+            try:
+                with open(cacheFileName, "rb") as cacheFile:
+                    data = pickle.load(cacheFile)
+                if data.get("version") == (pClass.sVersion, __version__) and data["hash"] == fileHash:
+                    pClass.sMemory = (os.path.abspath(pFileName), fileHash, data["entry"])
+                    return fileHash, data["entry"]
+            except Exception as ex:
+                Log.warning("Map cache cannot be loaded! ({})".format(ex))
+        return fileHash, None
+    
+    @classmethod
+    def set(pClass, pFileName, pHash, pEntry):
+        pClass.sMemory = (os.path.abspath(pFileName), pHash, pEntry)
+        
+        # write to temp file first - cache is never left half written
+        cacheFileName = pFileName + pClass.sExt
+        tempFile = cacheFileName + ".tmp"
+        try:
+            with open(tempFile, "wb") as cacheFile:
+                pickle.dump({"version": (pClass.sVersion, __version__), "hash": pHash, "entry": pEntry}, cacheFile, pickle.HIGHEST_PROTOCOL)
+            os.replace(tempFile, cacheFileName)
+        except OSError as ex:
+            Log.warning("Map cache cannot be saved! ({})".format(ex))
+
+
+class PakArchive:
+    sOpened = {}
+    
+    def __init__(self, pFileName):
+        self.mFileName = pFileName
+        self.mStatKey = None
+        self.mArch = zipfile.ZipFile(pFileName, "r")
+        self.mIndex = {}
+        self.mPrefixIndex = {}
+        
+        # hashed index of archive entries (path -> zip info)
+        for info in self.mArch.infolist():
+            self.mIndex[info.filename] = info
+        Counters.add("pak.opened")
+        Counters.add("pak.entriesIndexed", len(self.mIndex))
+    
+    @classmethod
+    def get(pClass, pFileName):
+        # each archive is opened only once per process (reopened only if it was changed)
+        key = os.path.abspath(pFileName)
+        stat = os.stat(key)
+        statKey = (stat.st_size, stat.st_mtime_ns)
+        
+        pak = pClass.sOpened.get(key)
+        if pak is None or pak.mStatKey != statKey:
+            if pak is not None:
+                pak.close()
+            pak = PakArchive(pFileName)
+            pak.mStatKey = statKey
+            pClass.sOpened[key] = pak
+        return pak
+    
+    @classmethod
+    def forget(pClass):
+        # drop archives inherited from parent process (their file handles must not be shared)
+        pClass.sOpened = {}
+    
+    @classmethod
+    def closeAll(pClass):
+        for pak in pClass.sOpened.values():
+            pak.close()
+        pClass.sOpened = {}
+    
+    def close(self):
+        self.mArch.close()
+    
+    def has(self, pPath):
+        return pPath in self.mIndex
+    
+    def open(self, pPath):
+        return self.mArch.open(self.mIndex[pPath], "r")
+    
+    def getPaths(self, pPrefix):
+        paths = self.mPrefixIndex.get(pPrefix)
+        if paths is None:
+            paths = [path for path in self.mIndex if path.startswith(pPrefix)]
+            self.mPrefixIndex[pPrefix] = paths
+            Counters.add("pak.entriesScanned", len(self.mIndex))
+        return paths
+
+
+class PakOverlay:
+    def __init__(self, pFileNames):
+        # first archive has highest priority (same as game - newer archive hides files of older one)
+        self.mFileNames = list(pFileNames)
+        self.mPaks = [PakArchive.get(fileName) for fileName in self.mFileNames]
+    
+    @staticmethod
+    def getGameFileNames():
+        fileNames = []
+        indexArchFile = os.path.join(dataFolder, "MMH55-Index.pak")
+        if os.path.exists(indexArchFile):
+            fileNames.append(indexArchFile)
+        fileNames.append(mainArchFile)
+        return fileNames
+    
+    def find(self, pPath):
+        for pak in self.mPaks:
+            if pak.has(pPath):
+                return pak
+        return None
+    
+    def has(self, pPath):
+        return self.find(pPath) is not None
+    
+    def open(self, pPath):
+        pak = self.find(pPath)
+        if pak is None:
+            Log.error("File not found in archives: \"{}\"".format(pPath))
+        return pak.open(pPath)
+    
+    def getPaths(self, pPrefix):
+        paths = []
+        usedPaths = set()
+        for pak in self.mPaks:
+            for path in pak.getPaths(pPrefix):
+                if path not in usedPaths:
+                    usedPaths.add(path)
+                    paths.append(path)
+        return paths
+
+
+class XmlStream:
+    @staticmethod
+    def parseFields(pFile, pRootTag, pFields):
+        # parse only some children of root (first occurrences), other are cleared
+        # reading stops, when all fields are found
+        # returns root with found fields only (or empty root, if root tag is different)
+        result = None
+        root = None
+        depth = 0
+        foundFields = set()
+        for event, elem in ET.iterparse(pFile, ("start", "end")):
+            if event == "start":
+                if depth == 0:
+                    result = ET.Element(elem.tag)
+                    if elem.tag != pRootTag:
+                        break
+                    root = elem
+                depth += 1
+            else:
+                depth -= 1
+                if depth == 1:
+                    if elem.tag in pFields and elem.tag not in foundFields:
+                        foundFields.add(elem.tag)
+                        result.append(elem)
+                    root.clear()
+                    if len(foundFields) == len(pFields):
+                        break
+        return result
+    
+    @staticmethod
+    def iterItems(pFile, pListTag):
+        # yield items of first list (child of root with given tag) one by one
+        # processed items are cleared and reading stops at end of list
+        listElem = None
+        depth = 0
+        for event, elem in ET.iterparse(pFile, ("start", "end")):
+            if event == "start":
+                depth += 1
+                if depth == 2 and listElem is None and elem.tag == pListTag:
+                    listElem = elem
+            else:
+                depth -= 1
+                if listElem is not None:
+                    if depth == 2:
+                        yield elem
+                        listElem.clear()
+                    elif depth == 1:
+                        return
+
+
+class RandTools:
+    sIdRand = rand.Random() # ids of new objects (own random values - ids do not change other random values)
+    
+    @classmethod
+    def setStream(pClass, *pKeys):
+        # independent random values for keys (map, stage) - only if seed is set
+        if seed is not None:
+            streamSeed = "/".join([str(seed)] + [str(key) for key in pKeys])
+            rand.seed(streamSeed)
+            pClass.sIdRand.seed(streamSeed + "/ids")
+    
+    @classmethod
+    def getObjectId(pClass, pPrefix):
+        return pPrefix + str(pClass.sIdRand.randint(1, 999999999))
+    
+    @staticmethod
+    def randoms(pCount):
+        # list of random values [0, 1) - always drawn by random module (same values with or without numpy)
+        return [rand.random() for i in range(pCount)]
+    
+    @staticmethod
+    def binomial(pCount, pChance):
+        if pChance >= 1.0:
+            return pCount
+        if pCount * pChance * (1.0 - pChance) < 25:
+            # exact
+            return len([i for i in range(pCount) if rand.random() < pChance])
+        # normal approximation
+        value = round(rand.gauss(pCount * pChance, math.sqrt(pCount * pChance * (1.0 - pChance))))
+        return min(pCount, max(0, value))
+    
+    @staticmethod
+    def multinomial(pCount, pChoiceCount):
+        # counts of uniformly selected choices
+        counts = []
+        countLeft = pCount
+        for i in range(pChoiceCount, 0, -1):
+            count = RandTools.binomial(countLeft, 1.0 / i)
+            counts.append(count)
+            countLeft -= count
+        return counts
+
+
+class WeightedSampler:
+    # weighted random choice by alias tables (memory is proportional to count of choices, weights can be fractional)
+    def __init__(self, pChoices, pWeights):
+        self.mChoices = []
+        weights = []
+        for choice, weight in zip(pChoices, pWeights):
+            if weight > 0:
+                self.mChoices.append(choice)
+                weights.append(weight)
+        
+        choiceCount = len(self.mChoices)
+        self.mChances = [1.0] * choiceCount
+        self.mAliases = list(range(choiceCount))
+        if choiceCount == 0:
+            return
+        
+        # split scaled weights to lower and higher than average, higher ones fill rest of lower ones
+        weightSum = sum(weights)
+        scaledWeights = [weight * choiceCount / weightSum for weight in weights]
+        smallList = [i for i, weight in enumerate(scaledWeights) if weight < 1.0]
+        largeList = [i for i, weight in enumerate(scaledWeights) if weight >= 1.0]
+        while len(smallList) > 0 and len(largeList) > 0:
+            small = smallList.pop()
+            large = largeList[-1]
+            self.mChances[small] = scaledWeights[small]
+            self.mAliases[small] = large
+            scaledWeights[large] -= 1.0 - scaledWeights[small]
+            if scaledWeights[large] < 1.0:
+                smallList.append(largeList.pop())
+    
+    def __len__(self):
+        return len(self.mChoices)
+    
+    def choice(self):
+        value = rand.random() * len(self.mChoices)
+        index = int(value)
+        if value - index >= self.mChances[index]:
+            index = self.mAliases[index]
+        return self.mChoices[index]
+    
+    def choices(self, pCount):
+        # same random values and same results as choice (numpy only selects by alias tables)
+        if np is not None:
+            values = np.asarray(RandTools.randoms(pCount)) * len(self.mChoices)
+            indexes = values.astype(np.int64)
+            indexes = np.where(values - indexes >= np.asarray(self.mChances)[indexes], np.asarray(self.mAliases)[indexes], indexes)
+            return [self.mChoices[index] for index in indexes.tolist()]
+        return [self.choice() for i in range(pCount)]
+
+
 class Artifact:
     sAll = []
     sMapId = {}
@@ -352,26 +1057,52 @@ class Artifact:
         return obj
     
     @classmethod
-    def init(pClass):
-        archFile = os.path.join(dataFolder, "MMH55-Index.pak") 
-        if not os.path.exists(archFile):
-            archFile = mainArchFile
+    def getTables(pClass):
+        # tables of loaded artifacts (only basic types - for catalog cache)
+        allIndex = {id(art): i for i, art in enumerate(pClass.sAll)}
+        return {
+            "all": [dict(art.__dict__) for art in pClass.sAll],
+            "groups": {price: [allIndex[id(art)] for art in group] for price, group in pClass.sGroups.items()},
+            "typeGroups": {artType: [allIndex[id(art)] for art in group] for artType, group in pClass.sTypeGroups.items()}
+        }
+    
+    @classmethod
+    def setTables(pClass, pTables):
+        for artDesc in pTables["all"]:
+            art = Artifact()
+            art.__dict__.update(artDesc)
+            pClass.sAll.append(art)
+            pClass.sMapId[art.mId] = art
+            pClass.sMapShared[art.mShared] = art
         
-        # load from file
-        with zipfile.ZipFile(archFile, "r") as arch:
-            with arch.open("GameMechanics/RefTables/Artifacts.xdb", "r") as dataFile:
-                tree = ET.parse(dataFile)
-                root = tree.getroot()
-                items = root.find("objects")
+        for price, group in pTables["groups"].items():
+            pClass.sGroups[price] = [pClass.sAll[i] for i in group]
+        for artType, group in pTables["typeGroups"].items():
+            pClass.sTypeGroups[artType] = [pClass.sAll[i] for i in group]
+    
+    @classmethod
+    def init(pClass):
+        archFiles = PakOverlay.getGameFileNames()
         
+        # clear list
+        pClass.sAll = []
+        pClass.sMapId = {}
+        pClass.sMapShared = {}
+        pClass.sGroups = {}
+        pClass.sTypeGroups = {}
+        
+        tables = CatalogCache.getTables("artifacts", archFiles)
+        Counters.add("artifact.cacheHits" if tables is not None else "artifact.cacheMisses")
+        if tables is not None:
+            # load from cache
+            pClass.setTables(tables)
+        else:
+            # load from file
+            paks = PakOverlay(archFiles)
+            with paks.open("GameMechanics/RefTables/Artifacts.xdb") as dataFile:
                 # fill list
-                pClass.sAll = []
-                pClass.sMapId = {}
-                pClass.sMapShared = {}
-                pClass.sGroups = {}
-                pClass.sTypeGroups = {}
                 pClass.sTypeGroups["ARTF_CLASS_ANY"] = []
-                for item in items:
+                for item in XmlStream.iterItems(dataFile, "objects"):
                     art = Artifact.fromXml(item)
                     if art is not None:
                         pClass.sAll.append(art)
@@ -387,6 +1118,8 @@ class Artifact:
                                 pClass.sTypeGroups[art.mType] = []
                             pClass.sTypeGroups[art.mType].append(art)
                             pClass.sTypeGroups["ARTF_CLASS_ANY"].append(art)
+            
+            CatalogCache.setTables("artifacts", archFiles, pClass.getTables())
         
         # add rand artifacts
         randArtList = [
@@ -446,15 +1179,20 @@ class Artifact:
 
 
 class Creature:
+    sXmlFields = ["CreatureTown", "CreatureTier", "Upgrade", "Power", "WeeklyGrowth", "SubjectOfRandomGeneration", "MonsterShared"]
     sAll = []
     sMap = {}
     sMapId = {}
     sMapShared = {}
     sMapTierPower = {}
     sTownList = []
-    sTownWeightList = []
+    sTownSampler = None
     sRandList = []
     sHighestCommonTier = 1
+    sTownTiers = {}
+    sTierTownSamplers = {}
+    sTierPowerList = []
+    sTierPowerTierList = []
     
     def __init__(self):
         self.mId = ""
@@ -487,26 +1225,13 @@ class Creature:
             self.mId = pXml.findtext("Creature", "")
     
     @classmethod
-    def init(pClass):
-        archFile = os.path.join(dataFolder, "MMH55-Index.pak") 
-        if not os.path.exists(archFile):
-            archFile = mainArchFile
+    def getArchFiles(pClass):
+        gameArchFiles = PakOverlay.getGameFileNames()
         
-        # clear list
-        pClass.sAll = []
-        pClass.sMap = {}
-        pClass.sMapId = {}
-        pClass.sMapShared = {}
-        pClass.sMapTierPower = {}
-        pClass.sTownList = []
-        pClass.sTownWeightList = []
-        pClass.sRandList = []
-        pClass.sHighestCommonTier = 1
-        
-        # files with creatures
+        # files with creatures (creatures are loaded from first file, ids from all files)
         archFiles = [{
-            "mainFile": archFile,
-            "idFile": mainArchFile
+            "mainFile": gameArchFiles[0],
+            "idFiles": gameArchFiles
         }]
         
         if creaNCF:
@@ -517,100 +1242,209 @@ class Creature:
                         fileName = os.path.join(dirPath, fileName)
                         archFiles.append({
                             "mainFile": fileName,
-                            "idFile": fileName
+                            "idFiles": [fileName]
                         })
         
-        # load from file
+        return archFiles
+    
+    @staticmethod
+    def loadFromArch(pMainFile, pIdFiles, pPaths):
+        # load creatures (and their ids) from some files of arch
+        # can run in worker process (returns only basic types)
+        startTime = time.perf_counter()
+        loadedCreas = []
+        warnings = []
+        
+        # load desc from arch
+        mainPak = PakArchive.get(pMainFile)
+        for archFilePath in pPaths:
+            with mainPak.open(archFilePath) as dataFile:
+                root = None
+                try:
+                    root = XmlStream.parseFields(dataFile, "Creature", Creature.sXmlFields)
+                except:
+                    continue
+                
+                if root is not None and root.tag == "Creature":
+                    # add to list
+                    crea = Creature.fromXml(root)
+                    if crea is None or len(crea.mShared) == 0:
+                        warnings.append("Creature error! ({})".format(archFilePath))
+                    else:
+                        loadedCreas.append(crea)
+        
+        # load ids from arch
+        idPaks = PakOverlay(pIdFiles)
+        for crea in loadedCreas:
+            creaFileEndPos = crea.mShared.find(".xdb")
+            if creaFileEndPos != -1:
+                creaFile = crea.mShared[:creaFileEndPos + 4]
+                if creaFile.startswith("/"):
+                    creaFile = creaFile[1:]
+                if idPaks.has(creaFile):
+                    with idPaks.open(creaFile) as dataFile:
+                        root = XmlStream.parseFields(dataFile, "AdvMapMonsterShared", ["Creature"])
+                        if root is not None and root.tag == "AdvMapMonsterShared":
+                            crea.setIdFromXml(root)
+        
+        return [dict(crea.__dict__) for crea in loadedCreas], warnings, time.perf_counter() - startTime
+    
+    @classmethod
+    def loadArchFiles(pClass, pArchFiles):
+        # split creature files to tasks
+        tasks = []
+        for archFileIndex, archFile in enumerate(pArchFiles):
+            paths = [path for path in PakArchive.get(archFile["mainFile"]).getPaths("GameMechanics/Creature/Creatures/") 
+                     if path.endswith(".xdb")]
+            chunkCount = creaLoadJobs * 4 if creaLoadJobs > 1 else 1
+            chunkSize = max(1, -(-len(paths) // chunkCount))
+            for i in range(0, max(len(paths), 1), chunkSize):
+                tasks.append({"index": archFileIndex, "args": (archFile["mainFile"], archFile["idFiles"], paths[i:i + chunkSize])})
+            Counters.add("creature.filesParsed", len(paths))
+        
+        # load tasks (results are merged in tasks order - same as serial loading)
+        startTime = time.perf_counter()
+        if creaLoadJobs > 1:
+            with concurrent.futures.ProcessPoolExecutor(creaLoadJobs, initializer=PakArchive.forget) as pool:
+                results = list(pool.map(Creature.loadFromArch, *zip(*[task["args"] for task in tasks])))
+        else:
+            results = [Creature.loadFromArch(*task["args"]) for task in tasks]
+        loadTime = time.perf_counter() - startTime
+        
+        loadedCreasList = [[] for archFile in pArchFiles]
+        serialLoadTime = 0
+        for task, (creaDescs, warnings, taskLoadTime) in zip(tasks, results):
+            for warning in warnings:
+                Log.warning(warning)
+            for creaDesc in creaDescs:
+                crea = Creature()
+                crea.__dict__.update(creaDesc)
+                loadedCreasList[task["index"]].append(crea)
+            serialLoadTime += taskLoadTime
+            Counters.add("creature.loaded", len(creaDescs))
+        
+        if creaLoadJobs > 1:
+            print("creatures parsed by {} processes: {:.2f}s (serial: {:.2f}s, speedup: {:.2f}x)".format(
+                    creaLoadJobs, loadTime, serialLoadTime, serialLoadTime / loadTime if loadTime > 0 else 0))
+        
+        return loadedCreasList
+    
+    @classmethod
+    def getTables(pClass):
+        # tables of loaded creatures (only basic types - for catalog cache)
+        allIndex = {id(crea): i for i, crea in enumerate(pClass.sAll)}
+        return {
+            "all": [dict(crea.__dict__) for crea in pClass.sAll],
+            "map": {townId: {tierId: [allIndex[id(crea)] for crea in tierCreas] for tierId, tierCreas in townCreas.items()} 
+                    for townId, townCreas in pClass.sMap.items()},
+            "mapTierPower": dict(pClass.sMapTierPower)
+        }
+    
+    @classmethod
+    def setTables(pClass, pTables):
+        for creaDesc in pTables["all"]:
+            crea = Creature()
+            crea.__dict__.update(creaDesc)
+            pClass.sAll.append(crea)
+            pClass.sMapId[crea.mId] = crea
+            pClass.sMapShared[crea.mShared] = crea
+        
+        for townId, townCreas in pTables["map"].items():
+            pClass.sMap[townId] = {tierId: [pClass.sAll[i] for i in tierCreas] for tierId, tierCreas in townCreas.items()}
+        pClass.sMapTierPower = dict(pTables["mapTierPower"])
+    
+    @classmethod
+    def init(pClass):
+        # clear list
+        pClass.sAll = []
+        pClass.sMap = {}
+        pClass.sMapId = {}
+        pClass.sMapShared = {}
+        pClass.sMapTierPower = {}
+        pClass.sTownList = []
+        pClass.sTownSampler = None
+        pClass.sRandList = []
+        pClass.sHighestCommonTier = 1
+        pClass.sTownTiers = {}
+        pClass.sTierTownSamplers = {}
+        pClass.sTierPowerList = []
+        pClass.sTierPowerTierList = []
+        
+        archFiles = pClass.getArchFiles()
+        usedArchFiles = []
         for archFile in archFiles:
-            loadedCreas = []
-            
-            def loadIdsFromArch(pArchFile):
-                archFilePaths = arch.namelist()
+            for usedArchFile in [archFile["mainFile"]] + archFile["idFiles"]:
+                if usedArchFile not in usedArchFiles:
+                    usedArchFiles.append(usedArchFile)
+        
+        tables = CatalogCache.getTables("creatures", usedArchFiles)
+        Counters.add("creature.cacheHits" if tables is not None else "creature.cacheMisses")
+        if tables is not None:
+            # load from cache
+            pClass.setTables(tables)
+        else:
+            # load from file
+            loadedCreasList = pClass.loadArchFiles(archFiles)
+            for loadedCreas in loadedCreasList:
+                # register loaded creas
                 for crea in loadedCreas:
-                    creaFileEndPos = crea.mShared.find(".xdb")
-                    if creaFileEndPos != -1:
-                        creaFile = crea.mShared[:creaFileEndPos + 4]
-                        if creaFile.startswith("/"):
-                            creaFile = creaFile[1:]
-                        if creaFile in archFilePaths:
-                            with arch.open(creaFile, "r") as dataFile:
-                                tree = ET.parse(dataFile)
-                                root = tree.getroot()
-                                if root.tag == "AdvMapMonsterShared":
-                                    crea.setIdFromXml(root)
-            
-            # load desc from arch
-            with zipfile.ZipFile(archFile["mainFile"], "r") as arch:
-                for archFilePath in arch.namelist():
-                    if archFilePath.startswith("GameMechanics/Creature/Creatures/") and archFilePath.endswith(".xdb"):
-                        with arch.open(archFilePath, "r") as dataFile:
-                            tree = None
-                            try:
-                                tree = ET.parse(dataFile)
-                            except:
-                                continue
-                            
-                            root = tree.getroot()
-                            if root.tag == "Creature":
-                                # add to list
-                                crea = Creature.fromXml(root)
-                                if crea is None or len(crea.mShared) == 0:
-                                    Log.warning("Creature error! ({})".format(archFilePath))
-                                else:
-                                    loadedCreas.append(crea)
+                    if len(crea.mId) == 0:
+                        otherCrea = Creature.getByShared(crea.mShared)
+                        if otherCrea is None:
+                            Log.warning("Creature id not found! ({})".format(crea.mShared))
+                        else:
+                            # creature with this shared is already registered
+                            # id is empty because shared point out to other file
+                            Log.warning("Creature alredy exist! ({})".format(crea.mShared))
+                        continue
                 
-                if archFile["mainFile"] == archFile["idFile"]:
-                    # load ids from this arch
-                    loadIdsFromArch(arch)
-            
-            if archFile["mainFile"] != archFile["idFile"]:
-                # load ids from other arch
-                with zipfile.ZipFile(archFile["idFile"], "r") as arch:
-                    loadIdsFromArch(arch)
-            
-            # register loaded creas
-            for crea in loadedCreas:
-                if len(crea.mId) == 0:
-                    otherCrea = Creature.getByShared(crea.mShared)
-                    if otherCrea is None:
-                        Log.warning("Creature id not found! ({})".format(crea.mShared))
-                    else:
-                        # creature with this shared is already registered
-                        # id is empty because shared point out to other file
-                        Log.warning("Creature alredy exist! ({})".format(crea.mShared))
-                    continue
+                    pClass.sAll.append(crea)
+                    pClass.sMapId[crea.mId] = crea
+                    pClass.sMapShared[crea.mShared] = crea
                 
-                pClass.sAll.append(crea)
-                pClass.sMapId[crea.mId] = crea
-                pClass.sMapShared[crea.mShared] = crea
+                    if crea.mCanGen:
+                        if crea.mTown not in pClass.sMap:
+                            pClass.sMap[crea.mTown] = {}
+                        if crea.mTier not in pClass.sMap[crea.mTown]:
+                            pClass.sMap[crea.mTown][crea.mTier] = []
+                        pClass.sMap[crea.mTown][crea.mTier].append(crea)
+        
+            # fill sMapTierPower
+            tierCreasCount = {}
+            for townId in pClass.sMap:
+                townCreas = pClass.sMap[townId]
+                for tierId in townCreas:
+                    if tierId not in pClass.sMapTierPower:
+                        pClass.sMapTierPower[tierId] = 0
+                        tierCreasCount[tierId] = 0
                 
-                if crea.mCanGen:
-                    if crea.mTown not in pClass.sMap:
-                        pClass.sMap[crea.mTown] = {}
-                    if crea.mTier not in pClass.sMap[crea.mTown]:
-                        pClass.sMap[crea.mTown][crea.mTier] = []
-                    pClass.sMap[crea.mTown][crea.mTier].append(crea)
-        
-        # fill sTownList and sTownWeightList
+                    tierCreas = townCreas[tierId]
+                    for crea in tierCreas:
+                        pClass.sMapTierPower[tierId] += crea.mPower
+                        tierCreasCount[tierId] += 1
+        
+            for tierId in pClass.sMapTierPower:
+                if tierCreasCount[tierId] > 0:
+                    pClass.sMapTierPower[tierId] = int(pClass.sMapTierPower[tierId] / tierCreasCount[tierId])
+        
+            CatalogCache.setTables("creatures", usedArchFiles, pClass.getTables())
+        
+        # fill sTownList and sTownSampler
+        townWeights = []
         for townId in pClass.sMap:
             pClass.sTownList.append(townId)
             
-            if creaNeutralRatio != 0:
-                if creaNeutralRatio < 0:
-                    # decreasing chance of neutral creas
-                    pClass.sTownWeightList.append(townId)
-                    if townId != "TOWN_NO_TYPE":
-                        for i in range(creaNeutralRatio * -1):
-                            pClass.sTownWeightList.append(townId)
-                else:
-                    # increasing chance of neutral creas
-                    if townId != "TOWN_NO_TYPE":
-                        pClass.sTownWeightList.append(townId)
-                    else:
-                        for i in range(2 ** creaNeutralRatio):
-                            pClass.sTownWeightList.append(townId)
-            else:
-                pClass.sTownWeightList.append(townId)
+            townWeight = 1
+            if creaNeutralRatio < 0:
+                # decreasing chance of neutral creas
+                if townId != "TOWN_NO_TYPE":
+                    townWeight += creaNeutralRatio * -1
+            elif creaNeutralRatio > 0:
+                # increasing chance of neutral creas
+                if townId == "TOWN_NO_TYPE":
+                    townWeight = 2 ** creaNeutralRatio
+            townWeights.append(townWeight)
+        pClass.sTownSampler = WeightedSampler(pClass.sTownList, townWeights)
         
         # find sHighestCommonTier
         pClass.sHighestCommonTier = 100
@@ -620,23 +1454,23 @@ class Creature:
                 while pClass.sHighestCommonTier not in pClass.sMap[townId]:
                     pClass.sHighestCommonTier -= 1
         
-        # fill sMapTierPower
-        tierCreasCount = {}
-        for townId in pClass.sMap:
-            townCreas = pClass.sMap[townId]
-            for tierId in townCreas:
-                if tierId not in pClass.sMapTierPower:
-                    pClass.sMapTierPower[tierId] = 0
-                    tierCreasCount[tierId] = 0
-                
-                tierCreas = townCreas[tierId]
-                for crea in tierCreas:
-                    pClass.sMapTierPower[tierId] += crea.mPower
-                    tierCreasCount[tierId] += 1
-        
-        for tierId in pClass.sMapTierPower:
-            if tierCreasCount[tierId] > 0:
-                pClass.sMapTierPower[tierId] = int(pClass.sMapTierPower[tierId] / tierCreasCount[tierId])
+        # fill sTownTiers and sTierTownSamplers (towns which have tier - no need to draw towns until one fits)
+        for townId in pClass.sTownList:
+            pClass.sTownTiers[townId] = {tierId for tierId, tierCreas in pClass.sMap[townId].items() if len(tierCreas) > 0}
+        for tierId in {tierId for townTiers in pClass.sTownTiers.values() for tierId in townTiers}:
+            pClass.sTierTownSamplers[tierId] = WeightedSampler(pClass.sTownList, 
+                                                               [townWeight if tierId in pClass.sTownTiers[townId] else 0 
+                                                                for townId, townWeight in zip(pClass.sTownList, townWeights)])
+        
+        # fill sTierPowerList and sTierPowerTierList (sorted by power - for bisect)
+        # tiers with same power: only first one (in order of sMapTierPower) can be selected
+        powerTiers = {}
+        for tierId, tierPower in pClass.sMapTierPower.items():
+            if tierPower > 0 and tierPower not in powerTiers:
+                powerTiers[tierPower] = int(tierId)
+        for tierPower in sorted(powerTiers):
+            pClass.sTierPowerList.append(tierPower)
+            pClass.sTierPowerTierList.append(powerTiers[tierPower])
         
         # fill sRandList
         randTierList = [
@@ -698,15 +1532,22 @@ class Creature:
     
     @classmethod
     def getTierByPower(pClass, pPower):
-        actTier = "1"
-        actTierPower = 0
         # select tier with equal or little lower power
-        for tierId in pClass.sMapTierPower:
-            tierPower = pClass.sMapTierPower[tierId]
-            if tierPower <= pPower and actTierPower < tierPower:
-                actTier = tierId
-                actTierPower = tierPower
-        return int(actTier)
+        Counters.add("creature.tierByPower")
+        index = bisect.bisect_right(pClass.sTierPowerList, pPower)
+        if index == 0:
+            return 1
+        return pClass.sTierPowerTierList[index - 1]
+    
+    @classmethod
+    def getTiersByPower(pClass, pPowers):
+        # same as getTierByPower for list of powers
+        if np is not None and len(pClass.sTierPowerList) > 0:
+            Counters.add("creature.tierByPower", len(pPowers))
+            indexes = np.searchsorted(np.asarray(pClass.sTierPowerList), np.asarray(pPowers, dtype=float), side="right")
+            tiers = np.asarray(pClass.sTierPowerTierList)[np.maximum(indexes - 1, 0)]
+            return np.where(indexes > 0, tiers, 1).tolist()
+        return [pClass.getTierByPower(power) for power in pPowers]
     
     @classmethod
     def getPowerByTier(pClass, pTier):
@@ -725,7 +1566,28 @@ class Creature:
     
     @classmethod
     def getRandomTownId(pClass):
-        return rand.choice(pClass.sTownWeightList)
+        return pClass.sTownSampler.choice()
+    
+    @classmethod
+    def getRandomTownIdsByTier(pClass, pTiers):
+        # same as drawing towns until one has tier (tier is lowered to highest common tier after first miss)
+        # towns without tier are drawn again from towns which have it
+        townIds = pClass.sTownSampler.choices(len(pTiers))
+        tiers = list(pTiers)
+        missIndexes = {}
+        for i, townId in enumerate(townIds):
+            if not pClass.townHasTier(townId, tiers[i]):
+                if tiers[i] > pClass.sHighestCommonTier:
+                    tiers[i] = pClass.sHighestCommonTier
+                if tiers[i] not in missIndexes:
+                    missIndexes[tiers[i]] = []
+                missIndexes[tiers[i]].append(i)
+        for tier, indexes in missIndexes.items():
+            for i, townId in zip(indexes, pClass.sTierTownSamplers[tier].choices(len(indexes))):
+                townIds[i] = townId
+            Counters.add("army.townRedraws", len(indexes))
+        Counters.add("army.townDraws", len(townIds))
+        return townIds, tiers
     
     @classmethod
     def getTownCreatures(pClass, pTownId):
@@ -737,10 +1599,12 @@ class Creature:
     
     @classmethod
     def townHasTier(pClass, pTownId, pTier):
-        return pTier in pClass.sMap[pTownId] and len(pClass.sMap[pTownId][pTier]) > 0
+        return pTier in pClass.sTownTiers[pTownId]
 
 
 class Army:
+    sAddLoopLimit = 200
+    
     def __init__(self):
         self.mMood = "MONSTER_MOOD_AGGRESSIVE"
         self.mCourage = "MONSTER_COURAGE_CAN_FLEE_JOIN"
@@ -840,14 +1704,14 @@ class Army:
             if otherUnits is not None:
                 pXml.remove(otherUnits)
             
-            otherUnits = ET.SubElement(pXml, "AdditionalStacks")
+            otherUnits = XmlBackend.subElement(pXml, "AdditionalStacks")
             for i, unit in enumerate(self.mUnits):
                 if i != highestUnitIndex:
-                    unitDesc = ET.SubElement(otherUnits, "Item")
-                    ET.SubElement(unitDesc, "Creature").text = unit["crea"].mId
-                    ET.SubElement(unitDesc, "Amount").text = str(unit["count"])
-                    ET.SubElement(unitDesc, "Amount2").text = "0"
-                    ET.SubElement(unitDesc, "CustomAmount").text = "true"
+                    unitDesc = XmlBackend.subElement(otherUnits, "Item")
+                    XmlBackend.subElement(unitDesc, "Creature").text = unit["crea"].mId
+                    XmlBackend.subElement(unitDesc, "Amount").text = str(unit["count"])
+                    XmlBackend.subElement(unitDesc, "Amount2").text = "0"
+                    XmlBackend.subElement(unitDesc, "CustomAmount").text = "true"
     
     def isRand(self):
         for unit in self.mUnits:
@@ -855,160 +1719,254 @@ class Army:
                 return False
         return True
     
+    @staticmethod
+    def addMissingPowerByLoop(pCreas, pArmyPower, pArmyPowerLeft):
+        # add one creature at a time
+        # 10% of missing army has 160% chance of adding (1% has 16%)
+        armyPowerLeft = pArmyPowerLeft
+        loopCount = 0
+        while armyPowerLeft > 0 and rand.random() < ((armyPowerLeft / pArmyPower) * 16):
+            loopCount += 1
+            crea = rand.choice(pCreas)
+            addOneRatio = armyPowerLeft / crea["crea"].mPower # how big part of this creature is missing
+            if rand.random() < addOneRatio:
+                crea["count"] += 1
+                armyPowerLeft -= crea["crea"].mPower
+        Counters.add("army.fillLoops")
+        Counters.add("army.fillLoopSteps", loopCount)
+        return armyPowerLeft
+    
+    @classmethod
+    def addMissingPower(pClass, pCreas, pArmyPower, pArmyPowerLeft):
+        # same as addMissingPowerByLoop, but certain adds are drawn at once (loop is used only for small armies and tail)
+        creaCount = len(pCreas)
+        powers = [crea["crea"].mPower for crea in pCreas]
+        meanPower = sum(powers) / creaCount
+        powerVariance = sum([(power - meanPower) ** 2 for power in powers]) / creaCount
+        armyPowerLeft = pArmyPowerLeft
+        
+        if armyPowerLeft / meanPower <= pClass.sAddLoopLimit:
+            return pClass.addMissingPowerByLoop(pCreas, pArmyPower, pArmyPowerLeft)
+        
+        Counters.add("army.fillClosedForms")
+        
+        # adds are certain, while more than 1/16 of power is missing (and creature is not stronger than missing power)
+        # they are split uniformly between creatures (normal approximation), counts are conditioned on added power
+        # margin (sum of powers) is bigger than rounding of counts - 1/16 of power is always crossed by loop
+        bulkPower = max(0, armyPowerLeft - pArmyPower / 16 - sum(powers))
+        addCount = bulkPower / meanPower
+        if powerVariance > 0:
+            addCount = rand.gauss(addCount, math.sqrt(bulkPower * powerVariance / meanPower ** 3))
+        counts = RandTools.multinomial(max(0, round(addCount)), creaCount)
+        if powerVariance > 0:
+            powerDiff = sum([count * power for count, power in zip(counts, powers)]) - bulkPower
+            counts = [max(0, round(count - (power - meanPower) * powerDiff / (creaCount * powerVariance))) 
+                      for count, power in zip(counts, powers)]
+        Counters.add("army.fillClosedFormAdds", sum(counts))
+        
+        for crea, count, power in zip(pCreas, counts, powers):
+            crea["count"] += count
+            armyPowerLeft -= count * power
+        
+        # tail is not certain - chance to continue drops by power of each added creature, so it is left to loop
+        # (loop has only about sqrt(armyPower / meanPower) steps there)
+        return pClass.addMissingPowerByLoop(pCreas, pArmyPower, armyPowerLeft)
+    
     @classmethod
     def getAlt(pClass, pArmy):
         # create alt army
-        altArmy = Army()
-        altArmy.mMood = pArmy.mMood
-        altArmy.mCourage = pArmy.mCourage
-        
-        if creaMoodChange:
-            altArmy.mMood = rand.choice(creaMoodList) # sel mood
-        
-        armyPower = pArmy.getPower() * creaPowerRatio # sel new power
-        isGroup = not creaRandom and rand.random() < creaGroupRatio and armyPower  > 100
-        
-        if not isGroup:
-            # single unit
-            randCount = 2 + int(20 * rand.random() * 2) # basic count is 2 + (0 - 39)
-            if randCount == 0:
-                randCount = 1
-            tier = Creature.getTierByPower(armyPower / randCount) # sel basic tier
+        return pClass.getAltList([pArmy])[0]
+    
+    @classmethod
+    def getAltList(pClass, pArmies):
+        # create alt armies (random values of all armies are drawn at once)
+        armyCount = len(pArmies)
+        armyPowers = [army.getPower() * creaPowerRatio for army in pArmies] # sel new power
+        moods = creaMoodSampler.choices(armyCount) if creaMoodChange else [army.mMood for army in pArmies] # sel mood
+        isGroupList = [not creaRandom and groupValue < creaGroupRatio and armyPower > 100 
+                       for groupValue, armyPower in zip(RandTools.randoms(armyCount), armyPowers)]
+        randCounts = [2 + int(20 * value * 2) for value in RandTools.randoms(armyCount)] # basic count is 2 + (0 - 39)
+        Counters.add("army.armies", armyCount)
+        Counters.add("army.groups", sum(isGroupList))
+        
+        # sel basic tier (single) or highest tier (group)
+        unitPowers = [armyPower / 3 / 2 if isGroup else armyPower / randCount 
+                      for armyPower, isGroup, randCount in zip(armyPowers, isGroupList, randCounts)]
+        tiers = Creature.getTiersByPower(unitPowers)
+        if creaRandom:
+            tiers = [min(tier, 7) for tier in tiers]
+            townIds = [None] * armyCount
+        else:
+            # select town
+            townIds, tiers = Creature.getRandomTownIdsByTier(tiers)
+        tierChangeValues = RandTools.randoms(armyCount)
+        addOneValues = RandTools.randoms(armyCount)
+        
+        altArmies = []
+        for i, army in enumerate(pArmies):
+            altArmy = Army()
+            altArmy.mMood = moods[i]
+            altArmy.mCourage = army.mCourage
+            armyPower = armyPowers[i]
+            tier = tiers[i]
+            townId = townIds[i]
             
-            if creaRandom:
-                # random unit
-                if tier > 7:
-                    tier = 7
-                tierPower = Creature.getPowerByTier(tier)
-                count = int(armyPower / tierPower) # real count
-                addOneRatio = (armyPower - (tierPower * count)) / tierPower # how big part of one unit is missing
-                if rand.random() < addOneRatio:
-                    count += 1 # add one to real count
-                
-                # set tier and count
-                crea = Creature.getRandomCreature(tier)
-                altArmy.addUnit(crea, count)
-            else:
-                # specific unit
-                # select town
-                townId = None
-                while townId is None:
-                    townId = Creature.getRandomTownId()
-                    if not Creature.townHasTier(townId, tier):
-                        townId = None
-                        if tier > Creature.sHighestCommonTier:
-                            tier = Creature.sHighestCommonTier
-                
-                # may change tier
-                tierChangeRatio = 0.10
-                canTierDown = Creature.townHasTier(townId, tier - 1)
-                canTierUp = randCount >= 5 and Creature.townHasTier(townId, tier + 1)
-                randNum = rand.random()
-                if canTierDown and randNum < tierChangeRatio:
-                    tier -= 1
-                elif canTierUp and randNum >= (1 - tierChangeRatio):
-                    tier += 1
+            if not isGroupList[i]:
+                # single unit
+                if creaRandom:
+                    # random unit
+                    crea = Creature.getRandomCreature(tier)
+                else:
+                    # specific unit
+                    # may change tier
+                    tierChangeRatio = 0.10
+                    canTierDown = Creature.townHasTier(townId, tier - 1)
+                    canTierUp = randCounts[i] >= 5 and Creature.townHasTier(townId, tier + 1)
+                    if canTierDown and tierChangeValues[i] < tierChangeRatio:
+                        tier -= 1
+                    elif canTierUp and tierChangeValues[i] >= (1 - tierChangeRatio):
+                        tier += 1
+                    
+                    # sel creature
+                    crea = rand.choice(Creature.getTownCreatures(townId)[tier])
                 
-                # sel creature and count
-                tierCreas = Creature.getTownCreatures(townId)[tier]
-                crea = rand.choice(tierCreas)
+                # sel count
                 count = int(armyPower / crea.mPower) # real count
                 addOneRatio = (armyPower - (crea.mPower * count)) / crea.mPower # how big part of one unit is missing
-                if rand.random() < addOneRatio:
+                if addOneValues[i] < addOneRatio:
                     count += 1 # add one to real count
                 
                 altArmy.addUnit(crea, count) # set unit
-        else:
-            # group
-            # select highest tier
-            highUnitPower = armyPower / 3 / 2
-            highUnitTier = Creature.getTierByPower(highUnitPower)
-            
-            # select town
-            townId = None
-            while townId is None:
-                townId = Creature.getRandomTownId()
-                if not Creature.townHasTier(townId, highUnitTier):
-                    townId = None
-                    if highUnitTier > Creature.sHighestCommonTier:
-                        highUnitTier = Creature.sHighestCommonTier
-            
-            # find available tiers
-            canSelTierList = []
-            for i in range(highUnitTier, highUnitTier - 4, -1):
-                if Creature.townHasTier(townId, i):
-                    canSelTierList.append(i)
-            
-            # sel group size
-            minGroupSize = 2 if len(canSelTierList) > 1 else 1
-            groupSize = rand.randint(minGroupSize, len(canSelTierList))
-            
-            # sel tiers in group
-            tierList = []
-            if groupSize == len(canSelTierList):
-                tierList = canSelTierList
             else:
-                while len(tierList) < groupSize:
-                    i = rand.choice(canSelTierList)
-                    tierList.append(i)
-            
-            ratioBasedChoose = False
-            ratioList = []
-            if ratioBasedChoose:
-                # sel tiers ratio (is needed? random add may would be better?)
-                fullRatio = 0
-                for i in range(0, groupSize):
-                    ratio = rand.random()
-                    fullRatio += ratio
-                    ratioList.append(ratio)
-                minRatio = fullRatio * (1 / (groupSize + 2))
-                maxRatio = fullRatio - (minRatio * groupSize)
-                usedRatio = 0
-                for i, ratio in enumerate(ratioList):
-                    if ratio < minRatio:
-                        ratioList[i] = minRatio
-                    elif ratio > maxRatio:
-                        ratioList[i] = maxRatio
-                    usedRatio += ratioList[i]
-                    ratioList[i] = (1 / fullRatio) * ratioList[i] * 100 # ratio to percentage
-                # sum is not 100% so we multiply it (may not needed - would be more dinamic - would boost stronger creatures)
-                usedRatioMult = fullRatio / usedRatio
-                for i, ratio in enumerate(ratioList):
-                    ratioList[i] *= usedRatioMult
-                
-                powerBit = armyPower / 100 # 1 percent of power
-            
-            # sel creatures and their counts
-            armyPowerLeft = armyPower
-            townCreas = Creature.getTownCreatures(townId)
-            creas = []
-            for i, tier in enumerate(tierList):
-                crea = rand.choice(townCreas[tier])
-                count = 0
-                if ratioBasedChoose:
-                    count = int((powerBit * ratioList[i]) / crea.mPower)
-                armyPowerLeft -= count * crea.mPower
-                creas.append({"crea": crea, "count": count})
-            
-            # add missing power to army
-            # 10% of missing army has 160% chance of adding (1% has 16%)
-            while armyPowerLeft > 0 and rand.random() < ((armyPowerLeft / armyPower) * 16):
-                crea = rand.choice(creas)
-                addOneRatio = armyPowerLeft / crea["crea"].mPower # how big part of this creature is missing
-                if rand.random() < addOneRatio:
-                    crea["count"] += 1
-                    armyPowerLeft -= crea["crea"].mPower
+                # group
+                pClass.addGroupUnits(altArmy, armyPower, townId, tier)
             
-            # move creatures and their counts to army
-            for crea in creas:
-                if crea["count"] > 0:
-                    altArmy.addUnit(crea["crea"], crea["count"])
+            altArmies.append(altArmy)
+        
+        return altArmies
+    
+    @classmethod
+    def addGroupUnits(pClass, pArmy, pArmyPower, pTownId, pHighUnitTier):
+        # find available tiers
+        townTiers = Creature.sTownTiers[pTownId]
+        canSelTierList = [i for i in range(pHighUnitTier, pHighUnitTier - 4, -1) if i in townTiers]
+        
+        # sel group size
+        minGroupSize = 2 if len(canSelTierList) > 1 else 1
+        groupSize = rand.randint(minGroupSize, len(canSelTierList))
+        
+        # sel tiers in group
+        tierList = []
+        if groupSize == len(canSelTierList):
+            tierList = canSelTierList
+        else:
+            while len(tierList) < groupSize:
+                i = rand.choice(canSelTierList)
+                tierList.append(i)
+            Counters.add("army.groupTierDraws", groupSize)
+        
+        ratioBasedChoose = False
+        ratioList = []
+        if ratioBasedChoose:
+            # sel tiers ratio (is needed? random add may would be better?)
+            fullRatio = 0
+            for i in range(0, groupSize):
+                ratio = rand.random()
+                fullRatio += ratio
+                ratioList.append(ratio)
+            minRatio = fullRatio * (1 / (groupSize + 2))
+            maxRatio = fullRatio - (minRatio * groupSize)
+            usedRatio = 0
+            for i, ratio in enumerate(ratioList):
+                if ratio < minRatio:
+                    ratioList[i] = minRatio
+                elif ratio > maxRatio:
+                    ratioList[i] = maxRatio
+                usedRatio += ratioList[i]
+                ratioList[i] = (1 / fullRatio) * ratioList[i] * 100 # ratio to percentage
+            # sum is not 100% so we multiply it (may not needed - would be more dinamic - would boost stronger creatures)
+            usedRatioMult = fullRatio / usedRatio
+            for i, ratio in enumerate(ratioList):
+                ratioList[i] *= usedRatioMult
             
-            if len(altArmy.mUnits) == 0:
-                # army is empty - add one creature
-                altArmy.addUnit(creas[0]["crea"], 1)
+            powerBit = pArmyPower / 100 # 1 percent of power
+        
+        # sel creatures and their counts
+        armyPowerLeft = pArmyPower
+        townCreas = Creature.getTownCreatures(pTownId)
+        creas = []
+        for i, tier in enumerate(tierList):
+            crea = rand.choice(townCreas[tier])
+            count = 0
+            if ratioBasedChoose:
+                count = int((powerBit * ratioList[i]) / crea.mPower)
+            armyPowerLeft -= count * crea.mPower
+            creas.append({"crea": crea, "count": count})
+        
+        # add missing power to army
+        pClass.addMissingPower(creas, pArmyPower, armyPowerLeft)
+        
+        # move creatures and their counts to army
+        for crea in creas:
+            if crea["count"] > 0:
+                pArmy.addUnit(crea["crea"], crea["count"])
+        
+        if len(pArmy.mUnits) == 0:
+            # army is empty - add one creature
+            pArmy.addUnit(creas[0]["crea"], 1)
+
+
+class ObjectEdits:
+    def __init__(self):
+        self.mRemoved = set()
+        self.mAdded = []
+    
+    def remove(self, pItem):
+        self.mRemoved.add(pItem)
+    
+    def add(self, pTag):
+        item = XmlBackend.element(pTag)
+        self.mAdded.append(item)
+        return item
+    
+    def apply(self, pObjectsRoot):
+        # all edits are applied by one rebuild of objects list (new objects are added at end)
+        if pObjectsRoot is None:
+            return
+        if len(self.mRemoved) > 0:
+            pObjectsRoot[:] = [item for item in pObjectsRoot if item not in self.mRemoved]
+        pObjectsRoot.extend(self.mAdded)
         
-        return altArmy
+        self.mRemoved = set()
+        self.mAdded = []
+
+
+class ObjectDispatcher:
+    def __init__(self):
+        self.mHandlers = {}
+        self.mFinishers = []
+    
+    def register(self, pHandlers, pFinish=None):
+        # handlers are called with map objects (by href), finishers are called (in order of registration) after all objects
+        for href, handler in pHandlers.items():
+            if href not in self.mHandlers:
+                self.mHandlers[href] = []
+            self.mHandlers[href].append(handler)
+        if pFinish is not None:
+            self.mFinishers.append(pFinish)
+    
+    def run(self, pObjectsRoot):
+        # walk map objects only once
+        if pObjectsRoot is not None and len(self.mHandlers) > 0:
+            for item in pObjectsRoot:
+                handlers = self.mHandlers.get(item.get("href", ""))
+                if handlers is not None:
+                    for handler in handlers:
+                        handler(item)
+            Counters.add("objects.walked", len(pObjectsRoot))
+        
+        for finish in self.mFinishers:
+            finish()
 
 
 class Town:
@@ -1034,23 +1992,28 @@ class Town:
         return obj
     
     @classmethod
-    def init(pClass, pMapTree):
-        if pMapTree is None:
-            return
-        
-        root = pMapTree.getroot()
-        allTowns = root.findall("./objects/Item[@href='#n:inline(AdvMapTown)']")
-        
-        # fill list
+    def register(pClass, pDispatcher):
+        # clear list
         pClass.sAll = []
         pClass.sMapId = {}
         
-        for item in allTowns:
-            town = Town.fromXml(item)
+        def onTown(pItem):
+            town = Town.fromXml(pItem)
             if town is not None:
                 pClass.sAll.append(town)
                 pClass.sMapId[town.mId] = town
         
+        pDispatcher.register({"#n:inline(AdvMapTown)": onTown})
+    
+    @classmethod
+    def init(pClass, pMapTree):
+        if pMapTree is None:
+            return
+        
+        dispatcher = ObjectDispatcher()
+        pClass.register(dispatcher)
+        dispatcher.run(pMapTree.getroot().find("objects"))
+        
         #print("towns loaded: {}".format(len(pClass.sAll)))
     
     @classmethod
@@ -1064,14 +2027,152 @@ class Town:
         return self.mPlayer != "PLAYER_NONE"
 
 
+class ZipTools:
+    sRawAttrs = ["fp", "filelist", "NameToInfo", "start_dir", "_didModify"] # private fields of zipfile used by raw write
+    
+    @staticmethod
+    def readRawMember(pSrcFile, pInfo):
+        # already compressed data of member (in chunks)
+        pSrcFile.seek(pInfo.header_offset)
+        header = struct.unpack(zipfile.structFileHeader, pSrcFile.read(zipfile.sizeFileHeader))
+        if header[0] != zipfile.stringFileHeader:
+            Log.error("Bad archive member: \"{}\"".format(pInfo.filename))
+        pSrcFile.seek(header[10] + header[11], os.SEEK_CUR) # skip file name and extra field
+        
+        sizeLeft = pInfo.compress_size
+        while sizeLeft > 0:
+            data = pSrcFile.read(min(sizeLeft, 1024 * 1024))
+            if len(data) == 0:
+                Log.error("Bad archive member: \"{}\"".format(pInfo.filename))
+            sizeLeft -= len(data)
+            yield data
+    
+    @classmethod
+    def copyRawMember(pClass, pSrcFile, pDstArch, pInfo):
+        # copy already compressed member from source arch file to other arch (without recompression)
+        pClass.writeRawMember(pDstArch, pInfo, pClass.readRawMember(pSrcFile, pInfo))
+    
+    @staticmethod
+    def decompress(pInfo, pChunks):
+        # data of member from its compressed chunks
+        if pInfo.compress_type == zipfile.ZIP_STORED:
+            return b"".join(pChunks)
+        if pInfo.compress_type == zipfile.ZIP_DEFLATED:
+            decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+            return b"".join([decompressor.decompress(data) for data in pChunks]) + decompressor.flush()
+        Log.error("Unsupported compression of archive member: \"{}\"".format(pInfo.filename))
+    
+    @classmethod
+    def writeRawMember(pClass, pDstArch, pInfo, pChunks):
+        if not all([hasattr(pDstArch, attr) for attr in pClass.sRawAttrs]):
+            # other zipfile implementation - member is decompressed and written (compressed again) by public api
+            info = copy.copy(pInfo)
+            info.flag_bits &= ~0x08
+            pDstArch.writestr(info, pClass.decompress(pInfo, pChunks))
+            return
+        
+        # sizes and crc are known - data descriptor is not needed
+        info = copy.copy(pInfo)
+        info.flag_bits &= ~0x08
+        info.header_offset = pDstArch.fp.tell()
+        pDstArch.fp.write(info.FileHeader())
+        for data in pChunks:
+            pDstArch.fp.write(data)
+        
+        # register member (zipfile has no public api for raw copy)
+        pDstArch.filelist.append(info)
+        pDstArch.NameToInfo[info.filename] = info
+        pDstArch.start_dir = pDstArch.fp.tell()
+        pDstArch._didModify = True
+
+
+class DeflateWriter:
+    # file-like object - written data are deflated by blocks, blocks can be deflated by more threads (zlib releases GIL)
+    # every block uses end of previous block as dictionary and is ended by sync flush, so blocks form one deflate stream
+    sBlockSize = 1024 * 1024
+    sDictSize = 32 * 1024
+    
+    def __init__(self, pLevel, pPool=None):
+        self.mLevel = pLevel if pLevel is not None else zlib.Z_DEFAULT_COMPRESSION
+        self.mPool = pPool
+        self.mMaxPending = compressJobs * 2
+        self.mBlock = []
+        self.mBlockSize = 0
+        self.mDict = b""
+        self.mPending = []
+        self.mChunks = []
+        self.mCrc = 0
+        self.mSize = 0
+    
+    @staticmethod
+    def deflateBlock(pData, pDict, pLevel, pIsLast):
+        if len(pDict) > 0:
+            compressor = zlib.compressobj(pLevel, zlib.DEFLATED, -zlib.MAX_WBITS, zdict=pDict)
+        else:
+            compressor = zlib.compressobj(pLevel, zlib.DEFLATED, -zlib.MAX_WBITS)
+        return compressor.compress(pData) + compressor.flush(zlib.Z_FINISH if pIsLast else zlib.Z_SYNC_FLUSH)
+    
+    def write(self, pData):
+        self.mBlock.append(pData)
+        self.mBlockSize += len(pData)
+        if self.mBlockSize >= self.sBlockSize:
+            self.deflate(False)
+        return len(pData)
+    
+    def deflate(self, pIsLast):
+        data = b"".join(self.mBlock)
+        self.mBlock = []
+        self.mBlockSize = 0
+        self.mCrc = zlib.crc32(data, self.mCrc)
+        self.mSize += len(data)
+        
+        if self.mPool is not None:
+            self.mPending.append(self.mPool.submit(self.deflateBlock, data, self.mDict, self.mLevel, pIsLast))
+            # only few blocks are waiting (memory)
+            while len(self.mPending) > self.mMaxPending or (pIsLast and len(self.mPending) > 0):
+                self.mChunks.append(self.mPending.pop(0).result())
+        else:
+            self.mChunks.append(self.deflateBlock(data, self.mDict, self.mLevel, pIsLast))
+        self.mDict = (self.mDict + data)[-self.sDictSize:]
+    
+    def finish(self, pInfo):
+        # info (with sizes and crc) and deflated data
+        self.deflate(True)
+        info = copy.copy(pInfo)
+        info.compress_type = zipfile.ZIP_DEFLATED
+        info.CRC = self.mCrc
+        info.file_size = self.mSize
+        info.compress_size = sum([len(chunk) for chunk in self.mChunks])
+        return info, self.mChunks
+
+
 class Map:
+    sJobMap = None # map shared by candidate jobs (worker process)
+    
     def __init__(self, pFileName):
         self.mTree = None
         self.mFileName = pFileName
+        self.mStreamKey = self.getStreamKey(pFileName)
+        self.mVariant = 0
+        self.mCandidate = 0
+        self.mSrcFileName = None
+        self.mSrcInfos = None
         self.mDataFileName = None
-        self.mTempFolder = ".tempMapFolder6541351"
         self.mBckExt = ".bck"
-        self.useDirectAccess = False and sys.version_info.major >= 3 and sys.version_info.minor >= 6
+        self.mTempExt = ".tmp"
+        self.mEdits = ObjectEdits()
+    
+    def __getstate__(self):
+        # map tree is pickled as xml (faster than pickled elements, lxml elements cannot be pickled)
+        state = dict(self.__dict__)
+        if self.mTree is not None:
+            state["mTree"] = XmlBackend.toBytes(self.mTree)
+        return state
+    
+    def __setstate__(self, pState):
+        self.__dict__.update(pState)
+        if self.mTree is not None:
+            self.mTree = XmlBackend.fromBytes(self.mTree)
     
     def load(self):
         if (self.mFileName is not None 
@@ -1082,81 +2183,300 @@ class Map:
                 # load map from backup
                 fileName = self.mFileName + self.mBckExt
             
+            # backup is not changed by script - its unpacked map file can be cached
+            useCache = mapCache and fileName != self.mFileName
+            if useCache:
+                fileHash, entry = MapCache.get(fileName)
+                if entry is not None:
+                    self.mSrcFileName = fileName
+                    self.mSrcInfos = entry["infos"]
+                    self.mDataFileName = entry["dataFileName"]
+                    with Profiler.stage("parse"):
+                        self.mTree = XmlBackend.fromBytes(entry["data"])
+                    print("map loaded ({})".format(self.mFileName))
+                    return
+            
             with zipfile.ZipFile(fileName, "r") as arch:
                 filePaths = arch.namelist()
                 for filePath in filePaths:
                     if filePath.endswith("map.xdb"):
                         # found map file path
+                        self.mSrcFileName = fileName
+                        self.mSrcInfos = arch.infolist()
                         self.mDataFileName = filePath
                         
-                        if self.useDirectAccess:
-                            with arch.open(self.mDataFileName, "r") as archInnerFile:
-                                # load map xml tree
-                                self.mTree = ET.parse(archInnerFile)
+                        # load map xml tree
+                        if useCache:
+                            with Profiler.stage("unpack"):
+                                data = arch.read(self.mDataFileName)
+                            with Profiler.stage("parse"):
+                                self.mTree = XmlBackend.fromBytes(data)
+                            MapCache.set(fileName, fileHash, {"dataFileName": self.mDataFileName, "infos": self.mSrcInfos, "data": data})
                         else:
-                            if os.path.exists(self.mTempFolder):
-                                shutil.rmtree(self.mTempFolder)
-                            # extract map arch to temp folder
-                            arch.extractall(self.mTempFolder)
-                        
-                            # load map xml tree
-                            self.mTree = ET.parse(os.path.join(self.mTempFolder, self.mDataFileName))
+                            # map file is unpacked while parsed
+                            with Profiler.stage("parse"), arch.open(self.mDataFileName, "r") as archInnerFile:
+                                self.mTree = XmlBackend.parse(archInnerFile)
                         
                         print("map loaded ({})".format(self.mFileName))
                         break
-            
-            Town.init(self.mTree)
     
     def save(self):
         if (self.mTree is not None 
                 and self.mFileName is not None 
                 and len(self.mFileName) > 0
-                and self.mDataFileName is not None 
-                and (self.useDirectAccess or os.path.exists(os.path.join(self.mTempFolder, self.mDataFileName)))):
+                and self.mSrcFileName is not None
+                and self.mDataFileName is not None):
             
             if createMapBck and os.path.exists(self.mFileName) and not os.path.exists(self.mFileName + self.mBckExt):
                 # backup does not exist - create it - before we change original map file
                 os.rename(self.mFileName, self.mFileName + self.mBckExt)
+                if self.mSrcFileName == self.mFileName:
+                    self.mSrcFileName = self.mFileName + self.mBckExt
             
-            if self.useDirectAccess:
-                # direct save to zip file
-                # TODO: copy arch from backup (if available/needed)?
-                # INFO: not tested!
-                with zipfile.ZipFile(self.mFileName, "a", zipfile.ZIP_DEFLATED) as arch:
-                    with arch.open(self.mDataFileName, "w") as archInnerFile:
-                        # write map xml tree to file
-                        self.mTree.write(archInnerFile, "UTF-8", True)
-            else:
-                # write map xml tree to temp file
-                self.mTree.write(os.path.join(self.mTempFolder, self.mDataFileName), "UTF-8", True)
-                
-                # compress content of temp folder to map arch and remove temp folder
-                with zipfile.ZipFile(self.mFileName, "w", zipfile.ZIP_DEFLATED) as arch:
-                    files = []
-                    for (dirPath, dirNames, fileNames) in os.walk(self.mTempFolder):
-                        for fileName in fileNames:
-                            files.append(os.path.join(dirPath, fileName))
-
-                    tempFileNamePrefixLen = len(self.mTempFolder + "/")
-                    for f in files:
-                        arch.write(f, f[tempFileNamePrefixLen:])
-                    shutil.rmtree(self.mTempFolder)
+            self.saveAs(self.mFileName)
+    def saveAs(self, pFileName, pRawMembers=None):
+        # write new map arch to temp file, then replace map by it
+        # pRawMembers: already read (compressed) files of source arch
+        if self.mTree is not None and self.mSrcFileName is not None and self.mDataFileName is not None:
+            tempFileName = pFileName + self.mTempExt
+            try:
+                self.writeArch(tempFileName, pRawMembers)
+                os.replace(tempFileName, pFileName)
+            except BaseException:
+                # half written temp file is not left next to map (also on interrupt)
+                if os.path.exists(tempFileName):
+                    os.remove(tempFileName)
+                raise
             
-            print("map saved")
+            print("map saved" if pFileName == self.mFileName else "map saved ({})".format(pFileName))
+    
+    def writeArch(self, pFileName, pRawMembers):
+        # map xml tree is written directly to arch, other files are copied (still compressed) from source arch
+        useDeflateWriter = compressLevel is not None or compressJobs > 1
+        with open(self.mSrcFileName, "rb") as srcFile, \
+                (zipfile.ZipFile(srcFile, "r") if compressLevel is not None else contextlib.nullcontext()) as srcArch, \
+                (concurrent.futures.ThreadPoolExecutor(compressJobs) if compressJobs > 1 else contextlib.nullcontext()) as pool:
+            with zipfile.ZipFile(pFileName, "w", zipfile.ZIP_DEFLATED) as arch:
+                for info in self.getSrcInfos(srcFile):
+                    if info.filename == self.mDataFileName:
+                        dataInfo = zipfile.ZipInfo(info.filename, time.localtime()[:6])
+                        dataInfo.compress_type = zipfile.ZIP_DEFLATED
+                        dataInfo.external_attr = info.external_attr
+                        # map file is compressed while written
+                        with Profiler.stage("write"):
+                            if useDeflateWriter:
+                                # write map xml tree to deflate writer (by more threads), then to arch
+                                deflateWriter = DeflateWriter(compressLevel, pool)
+                                XmlBackend.write(self.mTree, deflateWriter)
+                                ZipTools.writeRawMember(arch, *deflateWriter.finish(dataInfo))
+                            else:
+                                with arch.open(dataInfo, "w") as archInnerFile:
+                                    # write map xml tree to arch
+                                    XmlBackend.write(self.mTree, archInnerFile)
+                    elif pRawMembers is not None and info.filename in pRawMembers:
+                        with Profiler.stage("copy"):
+                            ZipTools.writeRawMember(arch, *pRawMembers[info.filename])
+                    else:
+                        with Profiler.stage("copy"):
+                            ZipTools.writeRawMember(arch, *self.getRawMember(srcArch, srcFile, info, pool))
+    
+    def getSrcInfos(self, pSrcFile):
+        # members of source arch (read by load, or from cache)
+        if self.mSrcInfos is None:
+            with zipfile.ZipFile(pSrcFile, "r") as srcArch:
+                self.mSrcInfos = srcArch.infolist()
+        return self.mSrcInfos
     
-    def changeArtifacts(self):
+    @staticmethod
+    def getRawMember(pSrcArch, pSrcFile, pInfo, pPool=None):
+        # info and compressed data of source arch file (compressed again, if compression level is set)
+        if compressLevel is None or pInfo.is_dir():
+            return pInfo, ZipTools.readRawMember(pSrcFile, pInfo)
+        
+        deflateWriter = DeflateWriter(compressLevel, pPool)
+        with pSrcArch.open(pInfo, "r") as srcInnerFile:
+            shutil.copyfileobj(srcInnerFile, deflateWriter, DeflateWriter.sBlockSize)
+        return deflateWriter.finish(pInfo)
+    
+    def getRawMembers(self):
+        # compressed files of source arch (except map file) - to be shared by more saved maps
+        rawMembers = {}
+        with open(self.mSrcFileName, "rb") as srcFile, \
+                (zipfile.ZipFile(srcFile, "r") if compressLevel is not None else contextlib.nullcontext()) as srcArch, \
+                (concurrent.futures.ThreadPoolExecutor(compressJobs) if compressJobs > 1 else contextlib.nullcontext()) as pool:
+            for info in self.getSrcInfos(srcFile):
+                if info.filename != self.mDataFileName:
+                    info, chunks = self.getRawMember(srcArch, srcFile, info, pool)
+                    rawMembers[info.filename] = (info, [b"".join(chunks)])
+        return rawMembers
+    
+    def getVariantFileName(self, pVariant):
+        fileRoot, fileExt = os.path.splitext(self.mFileName)
+        return "{}_{}{}".format(fileRoot, pVariant, fileExt)
+    
+    def processObjects(self, pStages):
+        # stages register their handlers, then map objects are walked only once
+        # (handlers only collect objects, stages change them in finish - in given order)
         if self.mTree is None:
             return
         
-        root = self.mTree.getroot()
-        items = root.find("objects")
-        artifactsChanged = 0
-        artifactsCount = {}
+        objectsRoot = self.mTree.getroot().find("objects")
+        dispatcher = ObjectDispatcher()
+        Town.register(dispatcher)
+        for stage in pStages:
+            stage(dispatcher)
+        with Profiler.stage("objects", len(objectsRoot) if objectsRoot is not None else 0):
+            dispatcher.run(objectsRoot)
+            
+            # stages only queue removed/added objects
+            with Profiler.stage("edits"):
+                self.mEdits.apply(objectsRoot)
+    
+    @staticmethod
+    def getStreamKey(pFileName):
+        # path relative to common folder of all changed maps (same name in other folders has other random values)
+        fileName = os.path.abspath(pFileName)
+        folders = [os.path.dirname(os.path.abspath(mapFile)) for mapFile in mapFiles] + [os.path.dirname(fileName)]
+        try:
+            fileName = os.path.relpath(fileName, os.path.commonpath(folders))
+        except ValueError:
+            # other drives (full path is used)
+            pass
+        return fileName.replace(os.sep, "/")
+    
+    def runStage(self, pStage, pDispatcher, pHandlers, pFinish):
+        objectCount = [0]
+        pHandlers = Profiler.countHandlers(pHandlers, objectCount)
+        
+        def finish():
+            # every stage has own random values (result does not depend on other stages)
+            RandTools.setStream(self.mStreamKey, pStage)
+            Counters.add("objects.{}".format(pStage), objectCount[0])
+            with Profiler.stage(pStage, objectCount[0]):
+                pFinish()
+        
+        if pDispatcher is None:
+            # stage alone
+            self.processObjects([lambda pDispatcher: pDispatcher.register(pHandlers, finish)])
+        else:
+            pDispatcher.register(pHandlers, finish)
+    
+    def setStream(self, pVariant=0, pCandidate=0):
+        # every variant/candidate has own random values (first candidate has same values as map without candidates)
+        self.mVariant = pVariant
+        self.mCandidate = pCandidate
+        self.mStreamKey = self.getStreamKey(self.mFileName)
+        if pVariant > 0:
+            self.mStreamKey += "/variant{}".format(pVariant)
+        if pCandidate > 0:
+            self.mStreamKey += "/candidate{}".format(pCandidate)
+    
+    def getCopy(self, pVariant=0, pCandidate=0):
+        # copy of map (tree is copied, original tree is not changed by copy)
+        mapCopy = Map(self.mFileName)
+        mapCopy.mTree = copy.deepcopy(self.mTree)
+        mapCopy.mSrcFileName = self.mSrcFileName
+        mapCopy.mSrcInfos = self.mSrcInfos
+        mapCopy.mDataFileName = self.mDataFileName
+        mapCopy.setStream(pVariant, pCandidate)
+        return mapCopy
+    
+    def getCandidate(self, pCandidate):
+        # copy of map with changed objects
+        candidateMap = self.getCopy(self.mVariant, pCandidate)
+        with contextlib.redirect_stdout(io.StringIO()):
+            candidateMap.processObjects(getMapStages(candidateMap))
+        return candidateMap
+    
+    def getBalance(self):
+        # power of guards and price of artifacts around players (objects belong to nearest player town on same floor)
+        towns = []
+        objs = []
+        
+        def getPos(pInnerObj):
+            pos = pInnerObj.find("Pos")
+            return (pInnerObj.findtext("Floor", ""), float(pos.findtext("x", "0")), float(pos.findtext("y", "0")))
+        
+        def onTown(pItem):
+            innerObj = pItem.find("AdvMapTown")
+            if innerObj is not None and innerObj.findtext("PlayerID", "PLAYER_NONE") != "PLAYER_NONE":
+                towns.append({"player": innerObj.findtext("PlayerID"), "pos": getPos(innerObj)})
+        
+        def onArmy(pItem):
+            innerObj = pItem.find("AdvMapMonster")
+            army = Army.fromXml(innerObj)
+            if army is not None:
+                objs.append({"type": "guardPower", "value": army.getPower(), "pos": getPos(innerObj)})
+        
+        def onArt(pItem):
+            innerObj = pItem.find("AdvMapArtifact")
+            art = Artifact.getByShared(innerObj.find("Shared").get("href", "")) if innerObj is not None else None
+            if art is not None:
+                objs.append({"type": "artPrice", "value": art.mPrice, "pos": getPos(innerObj)})
+        
+        dispatcher = ObjectDispatcher()
+        dispatcher.register({"#n:inline(AdvMapTown)": onTown, "#n:inline(AdvMapMonster)": onArmy, "#n:inline(AdvMapArtifact)": onArt})
+        dispatcher.run(self.mTree.getroot().find("objects"))
+        
+        balance = {town["player"]: {"guardPower": 0, "artPrice": 0} for town in towns}
+        for obj in objs:
+            floor, x, y = obj["pos"]
+            nearestTown = None
+            nearestDist = 0
+            for town in towns:
+                townFloor, townX, townY = town["pos"]
+                dist = (townX - x) ** 2 + (townY - y) ** 2
+                if townFloor == floor and (nearestTown is None or dist < nearestDist):
+                    nearestTown = town
+                    nearestDist = dist
+            if nearestTown is not None:
+                balance[nearestTown["player"]][obj["type"]] += obj["value"]
+        return balance
+    
+    @staticmethod
+    def getBalanceScore(pBalance):
+        # sum of relative differences between players (lower is better)
+        score = 0.0
+        for valueType in ["guardPower", "artPrice"]:
+            values = [playerBalance[valueType] for playerBalance in pBalance.values()]
+            if len(values) > 1 and sum(values) > 0:
+                score += (max(values) - min(values)) / (sum(values) / len(values))
+        return score
+    
+    def getCandidateScore(self, pCandidate):
+        return self.getBalanceScore(self.getCandidate(pCandidate).getBalance())
+    
+    def findBestCandidate(self, pArgs=None, pJobs=1):
+        # candidates are only scored, best one is changed again (by same random values)
+        scores = {}
+        with Profiler.stage("candidates"):
+            if pJobs > 1 and pArgs is not None:
+                with concurrent.futures.ProcessPoolExecutor(min(pJobs, candidates), initializer=initCandidateJob, 
+                                                            initargs=(pArgs, getCatalogState(), self)) as pool:
+                    for candidate, score in zip(range(candidates), pool.map(runCandidateJob, range(candidates))):
+                        scores[candidate] = score
+            else:
+                for candidate in range(candidates):
+                    scores[candidate] = self.getCandidateScore(candidate)
+        
+        bestCandidate = min(scores, key=lambda candidate: (scores[candidate], candidate))
+        for candidate in range(candidates):
+            print("candidate {}: balance score {:.3f}{}".format(candidate, scores[candidate], " (best)" if candidate == bestCandidate else ""))
+        return bestCandidate
+    
+    def changeArtifacts(self, pDispatcher=None):
+        if self.mTree is None:
+            return
         
-        # change artifacts on map
-        for item in items:
-            href = item.get("href", "")
-            if href == "#n:inline(AdvMapArtifact)":
+        artItems = []
+        
+        def finish():
+            root = self.mTree.getroot()
+            artifactsChanged = 0
+            artifactsCount = {}
+            
+            # change artifacts on map
+            for item in artItems:
                 art = item.find("AdvMapArtifact")
                 if art is not None:
                     artShared = art.find("Shared")
@@ -1175,578 +2495,688 @@ class Map:
                                 print("artifact change:")
                                 print("old: {}".format(oldArt.mShared))
                                 print("new: {}\n".format(newArt.mShared))
+            
+            # allow all artifacts
+            allowedArtifactsNode = root.find("artifactIDs")
+            if allowedArtifactsNode is None:
+                allowedArtifactsNode = XmlBackend.subElement(root, "artifactIDs")
+            allowedArtifactsNode.clear()
+            
+            print("artifacts changed: {}".format(artifactsChanged))
+            
+            if logMapInfo:
+                # new map info
+                print("ARTIFACT COUNT (new map):")
+                for artType in artifactsCount:
+                    print("{}: {}".format(artType, artifactsCount[artType]))
+                print("")
         
-        # allow all artifacts
-        allowedArtifactsNode = root.find("artifactIDs")
-        if allowedArtifactsNode is None:
-            allowedArtifactsNode = ET.SubElement(root, "artifactIDs")
-        allowedArtifactsNode.clear()
-        
-        print("artifacts changed: {}".format(artifactsChanged))
-        
-        if logMapInfo:
-            # new map info
-            print("ARTIFACT COUNT (new map):")
-            for artType in artifactsCount:
-                print("{}: {}".format(artType, artifactsCount[artType]))
-            print("")
+        self.runStage("artifacts", pDispatcher, {"#n:inline(AdvMapArtifact)": artItems.append}, finish)
     
-    def changeCreatures(self):
+    def changeCreatures(self, pDispatcher=None):
         if self.mTree is None:
             return
         
-        root = self.mTree.getroot()
-        items = root.find("objects")
-        creaturesChanged = 0
-        
-        armies = []
-        powerDownDiff = 0
-        powerDownCount = 0
-        powerDownMaxDiff = 0
-        powerUpDiff = 0
-        powerUpCount = 0
-        powerUpMaxDiff = 0
-        
-        # change creatures on map
-        for item in items:
-            href = item.get("href", "")
-            if href == "#n:inline(AdvMapMonster)":
+        armyItems = []
+        
+        def finish():
+            creaturesChanged = 0
+            
+            armies = []
+            powerDownDiff = 0
+            powerDownCount = 0
+            powerDownMaxDiff = 0
+            powerUpDiff = 0
+            powerUpCount = 0
+            powerUpMaxDiff = 0
+            
+            # load creatures on map
+            armyXmls = []
+            for item in armyItems:
                 armyXml = item.find("AdvMapMonster")
                 if armyXml is not None:
                     army = Army.fromXml(armyXml)
                     if army is not None and (not creaChangeOnlyRandom or army.isRand()):
                         armies.append(army)
-                        creaturesChanged += 1
-                        altArmy = Army.getAlt(army)
-                        altArmy.toXml(armyXml)
-                        
-                        if logCreaChange:
-                            armyPower = army.getPower()
-                            armyPowerDiff = (altArmy.getPower() - armyPower) / (armyPower / 100)
-                            if armyPowerDiff < 0:
-                                powerDownDiff += armyPowerDiff
-                                powerDownCount += 1
-                                if powerDownMaxDiff > armyPowerDiff:
-                                    powerDownMaxDiff = armyPowerDiff
-                            elif armyPowerDiff > 0:
-                                powerUpDiff += armyPowerDiff
-                                powerUpCount += 1
-                                if powerUpMaxDiff < armyPowerDiff:
-                                    powerUpMaxDiff = armyPowerDiff
-                            
-                            print("creature change: {:.2f}%".format(armyPowerDiff))
-                            print("old:\n{}".format(army))
-                            print("new:\n{}\n".format(altArmy))
-        
-        if logCreaChange and len(armies) > 0:
-            print("power diff: {:.2f}%".format((powerDownDiff + powerUpDiff) / (powerDownCount + powerUpCount)))
-            if powerDownCount > 0:
-                print("power down - avr: {:.2f}% max: {:.2f}%".format(powerDownDiff / powerDownCount, powerDownMaxDiff))
-            if powerUpCount > 0:
-                print("power up - avr:    {:.2f}% max:  {:.2f}%\n".format(powerUpDiff / powerUpCount, powerUpMaxDiff))
-        
-        print("creatures changed: {}".format(creaturesChanged))
-        
-        if logMapInfo:
-            # old map info
-            print("ARMIES (old map):")
-            lowArmy = {}
-            highArmy = {}
-            tierLowArmy = {}
-            tierHighArmy = {}
-            for army in armies:
-                armySize = len(army.mUnits)
-                armyPower = army.getPower()
-                if armySize not in lowArmy or lowArmy[armySize]["power"] > armyPower:
-                    lowArmy[armySize] = {"army": army, "power": armyPower}
-                if armySize not in highArmy or highArmy[armySize]["power"] < armyPower:
-                    highArmy[armySize] = {"army": army, "power": armyPower}
-                for unit in army.mUnits:
-                    crea = unit["crea"]
-                    if crea.mTier not in tierLowArmy or tierLowArmy[crea.mTier]["power"] > armyPower:
-                        tierLowArmy[crea.mTier] = {"army": army, "power": armyPower}
-                    if crea.mTier not in tierHighArmy or tierHighArmy[crea.mTier]["power"] < armyPower:
-                        tierHighArmy[crea.mTier] = {"army": army, "power": armyPower}
-        
-            print("LOW ARMIES:")
-            for i in lowArmy:
-                print(lowArmy[i]["army"])
-            print("HIGH ARMIES:")
-            for i in highArmy:
-                print(highArmy[i]["army"])
-            print("TIER LOW ARMIES:")
-            for i in tierLowArmy:
-                print("tier: {}".format(i))
-                print(tierLowArmy[i]["army"])
-            print("TIER HIGH ARMIES:")
-            for i in tierHighArmy:
-                print("tier: {}".format(i))
-                print(tierHighArmy[i]["army"])
-    
-    def changeWaterObjects(self):
+                        armyXmls.append(armyXml)
+            
+            # change creatures on map (all at once)
+            altArmies = Army.getAltList(armies)
+            for army, armyXml, altArmy in zip(armies, armyXmls, altArmies):
+                creaturesChanged += 1
+                altArmy.toXml(armyXml)
+                
+                if logCreaChange:
+                    armyPower = army.getPower()
+                    armyPowerDiff = (altArmy.getPower() - armyPower) / (armyPower / 100)
+                    if armyPowerDiff < 0:
+                        powerDownDiff += armyPowerDiff
+                        powerDownCount += 1
+                        if powerDownMaxDiff > armyPowerDiff:
+                            powerDownMaxDiff = armyPowerDiff
+                    elif armyPowerDiff > 0:
+                        powerUpDiff += armyPowerDiff
+                        powerUpCount += 1
+                        if powerUpMaxDiff < armyPowerDiff:
+                            powerUpMaxDiff = armyPowerDiff
+                    
+                    print("creature change: {:.2f}%".format(armyPowerDiff))
+                    print("old:\n{}".format(army))
+                    print("new:\n{}\n".format(altArmy))
+            
+            if logCreaChange and len(armies) > 0:
+                print("power diff: {:.2f}%".format((powerDownDiff + powerUpDiff) / (powerDownCount + powerUpCount)))
+                if powerDownCount > 0:
+                    print("power down - avr: {:.2f}% max: {:.2f}%".format(powerDownDiff / powerDownCount, powerDownMaxDiff))
+                if powerUpCount > 0:
+                    print("power up - avr:    {:.2f}% max:  {:.2f}%\n".format(powerUpDiff / powerUpCount, powerUpMaxDiff))
+            
+            print("creatures changed: {}".format(creaturesChanged))
+            
+            if logMapInfo:
+                # old map info
+                print("ARMIES (old map):")
+                lowArmy = {}
+                highArmy = {}
+                tierLowArmy = {}
+                tierHighArmy = {}
+                for army in armies:
+                    armySize = len(army.mUnits)
+                    armyPower = army.getPower()
+                    if armySize not in lowArmy or lowArmy[armySize]["power"] > armyPower:
+                        lowArmy[armySize] = {"army": army, "power": armyPower}
+                    if armySize not in highArmy or highArmy[armySize]["power"] < armyPower:
+                        highArmy[armySize] = {"army": army, "power": armyPower}
+                    for unit in army.mUnits:
+                        crea = unit["crea"]
+                        if crea.mTier not in tierLowArmy or tierLowArmy[crea.mTier]["power"] > armyPower:
+                            tierLowArmy[crea.mTier] = {"army": army, "power": armyPower}
+                        if crea.mTier not in tierHighArmy or tierHighArmy[crea.mTier]["power"] < armyPower:
+                            tierHighArmy[crea.mTier] = {"army": army, "power": armyPower}
+            
+                print("LOW ARMIES:")
+                for i in lowArmy:
+                    print(lowArmy[i]["army"])
+                print("HIGH ARMIES:")
+                for i in highArmy:
+                    print(highArmy[i]["army"])
+                print("TIER LOW ARMIES:")
+                for i in tierLowArmy:
+                    print("tier: {}".format(i))
+                    print(tierLowArmy[i]["army"])
+                print("TIER HIGH ARMIES:")
+                for i in tierHighArmy:
+                    print("tier: {}".format(i))
+                    print(tierHighArmy[i]["army"])
+        
+        self.runStage("creatures", pDispatcher, {"#n:inline(AdvMapMonster)": armyItems.append}, finish)
+    
+    def changeWaterObjects(self, pDispatcher=None):
         if self.mTree is None:
             return
         
-        root = self.mTree.getroot()
-        
-        # set ReflectiveWater to true
-        reflectiveWaterNode = root.find("ReflectiveWater")
-        if reflectiveWaterNode is None:
-            reflectiveWaterNode = ET.SubElement(root, "ReflectiveWater")
-        reflectiveWaterNode.text = "true"
-        
-        # water objects lists
-        oneSquareWaterTreaList = [
-            {"weight": 12, "type": "floatsam", "shared": "/MapObjects/Floatsam.(AdvMapTreasureShared).xdb#xpointer(/AdvMapTreasureShared)"},
-            {"weight": 6, "type": "chest", "shared": "/MapObjects/Sea_Chest.(AdvMapTreasureShared).xdb#xpointer(/AdvMapTreasureShared)"},
-            {"weight": 1, "type": "special", "shared": "/MapObjects/Water/Shipwrecks_2/PeasantWreck.xdb#xpointer(/AdvMapTreasureShared)"},
-            {"weight": 1, "type": "special", "shared": "/MapObjects/Water/Shipwrecks_2/FootmanWreck.xdb#xpointer(/AdvMapTreasureShared)"}
-        ]
-        oneSquareWaterObjList = [
-            {"weight": 1, "type": "combat", "shared": "/MapObjects/Water/Damaged_Boats_2/Unkempt_Junk.xdb#xpointer(/AdvMapBuildingShared)"},
-            {"weight": 1, "type": "combat", "shared": "/MapObjects/Water/Damaged_Boats_2/Unkempt_Galley.xdb#xpointer(/AdvMapBuildingShared)"},
-            {"weight": 1, "type": "combat", "shared": "/MapObjects/Water/Damaged_Boats_2/Unkempt_Galleon.xdb#xpointer(/AdvMapBuildingShared)"},
-            {"weight": 1, "type": "combat", "shared": "/MapObjects/Water/Damaged_Boats_2/Demolish_Galleon.xdb#xpointer(/AdvMapBuildingShared)"},
-            {"weight": 1, "type": "combat", "shared": "/MapObjects/Water/Damaged_Boats_2/Demolish_Galley.xdb#xpointer(/AdvMapBuildingShared)"},
-            {"weight": 1, "type": "combat", "shared": "/MapObjects/Water/Damaged_Boats_2/Demolish_Junk.xdb#xpointer(/AdvMapBuildingShared)"},
-            {"weight": 1, "type": "other", "shared": "/MapObjects/Sirens.(AdvMapBuildingShared).xdb#xpointer(/AdvMapBuildingShared)"},
-            {"weight": 1, "type": "other", "shared": "/MapObjects/Mermaids.(AdvMapBuildingShared).xdb#xpointer(/AdvMapBuildingShared)"},
-            {"weight": 1, "type": "other", "shared": "/MapObjects/Buoy.(AdvMapBuildingShared).xdb#xpointer(/AdvMapBuildingShared)"}
-        ]
-        
-        def getSharedList(mList, byWeight):
-            lList = []
-            for obj in mList:
-                if not byWeight:
-                    lList.append(obj["shared"])
-                else:
-                    for i in range(obj["weight"]):
-                        lList.append(obj["shared"])
-            return lList
-        
-        oneSquareWaterTreasShared = getSharedList(oneSquareWaterTreaList, False)
-        oneSquareWaterObjsShared = getSharedList(oneSquareWaterObjList, False)
-        
-        oneSquareWaterTreasSharedWeight = getSharedList(oneSquareWaterTreaList, True)
-        oneSquareWaterObjsSharedWeight = getSharedList(oneSquareWaterObjList, True)
-        
-        # ratios
-        waterObjDelRatio = 0.0
-        waterTreaRatio = 0.7
-        
-        # counts
-        oldOneSquareWaterItemsCount = {}
-        newOneSquareWaterItemsCount = {}
-        
-        oneSquareWaterItems = []
-        
-        items = root.find("objects")
-        
-        # load water objects
-        for item in items:
-            itemHref = item.get("href", "")
-            isTreasure = itemHref == "#n:inline(AdvMapTreasure)"
-            isBuilding = itemHref == "#n:inline(AdvMapBuilding)"
-            if isTreasure or isBuilding:
-                innerItem = item.find("AdvMapTreasure" if isTreasure else "AdvMapBuilding")
-                if innerItem is not None:
-                    innerItemShared = innerItem.find("Shared")
-                    if innerItemShared is not None:
-                        innerItemSharedValue = innerItemShared.get("href", "")
-                        if ((isTreasure and innerItemSharedValue in oneSquareWaterTreasShared) 
-                            or (isBuilding and innerItemSharedValue in oneSquareWaterObjsShared)):
-                            
-                            if innerItemSharedValue not in oldOneSquareWaterItemsCount:
-                                oldOneSquareWaterItemsCount[innerItemSharedValue] = 0
-                            oldOneSquareWaterItemsCount[innerItemSharedValue] += 1
-                            
-                            # remove some sub elements
-                            tagsToRemove = ["IsCustom", "Amount", "MessageFileRef", "PlayerID", "GroupID", "showCameras"]
-                            for tagToRemove in tagsToRemove:
-                                someItem = innerItem.find(tagToRemove)
-                                if someItem is not None:
-                                    innerItem.remove(someItem)
-                            
-                            oneSquareWaterItems.append({"item": item, "innerItem": innerItem})
+        waterItems = []
         
-        # change water objects
-        for oneSquareWaterItem in oneSquareWaterItems:
-            item = oneSquareWaterItem["item"]
-            innerItem = oneSquareWaterItem["innerItem"]
-            innerItemShared = innerItem.find("Shared")
+        def finish():
+            root = self.mTree.getroot()
             
-            if rand.random() < waterObjDelRatio:
-                # remove water object
-                items.remove(item)
-            else:
-                isTreasure = rand.random() < waterTreaRatio
-                if isTreasure:
-                    # treasure
-                    item.set("href", "#n:inline(AdvMapTreasure)")
-                    innerItem.tag = "AdvMapTreasure"
-                    innerItemShared.set("href", rand.choice(oneSquareWaterTreasSharedWeight))
-                    
-                    # add some sub elements
-                    ET.SubElement(innerItem, "IsCustom").text = "false"
-                    ET.SubElement(innerItem, "Amount").text = "0"
-                    ET.SubElement(innerItem, "MessageFileRef").set("href", "")
+            # set ReflectiveWater to true
+            reflectiveWaterNode = root.find("ReflectiveWater")
+            if reflectiveWaterNode is None:
+                reflectiveWaterNode = XmlBackend.subElement(root, "ReflectiveWater")
+            reflectiveWaterNode.text = "true"
+            
+            # water objects lists
+            oneSquareWaterTreaList = [
+                {"weight": 12, "type": "floatsam", "shared": "/MapObjects/Floatsam.(AdvMapTreasureShared).xdb#xpointer(/AdvMapTreasureShared)"},
+                {"weight": 6, "type": "chest", "shared": "/MapObjects/Sea_Chest.(AdvMapTreasureShared).xdb#xpointer(/AdvMapTreasureShared)"},
+                {"weight": 1, "type": "special", "shared": "/MapObjects/Water/Shipwrecks_2/PeasantWreck.xdb#xpointer(/AdvMapTreasureShared)"},
+                {"weight": 1, "type": "special", "shared": "/MapObjects/Water/Shipwrecks_2/FootmanWreck.xdb#xpointer(/AdvMapTreasureShared)"}
+            ]
+            oneSquareWaterObjList = [
+                {"weight": 1, "type": "combat", "shared": "/MapObjects/Water/Damaged_Boats_2/Unkempt_Junk.xdb#xpointer(/AdvMapBuildingShared)"},
+                {"weight": 1, "type": "combat", "shared": "/MapObjects/Water/Damaged_Boats_2/Unkempt_Galley.xdb#xpointer(/AdvMapBuildingShared)"},
+                {"weight": 1, "type": "combat", "shared": "/MapObjects/Water/Damaged_Boats_2/Unkempt_Galleon.xdb#xpointer(/AdvMapBuildingShared)"},
+                {"weight": 1, "type": "combat", "shared": "/MapObjects/Water/Damaged_Boats_2/Demolish_Galleon.xdb#xpointer(/AdvMapBuildingShared)"},
+                {"weight": 1, "type": "combat", "shared": "/MapObjects/Water/Damaged_Boats_2/Demolish_Galley.xdb#xpointer(/AdvMapBuildingShared)"},
+                {"weight": 1, "type": "combat", "shared": "/MapObjects/Water/Damaged_Boats_2/Demolish_Junk.xdb#xpointer(/AdvMapBuildingShared)"},
+                {"weight": 1, "type": "other", "shared": "/MapObjects/Sirens.(AdvMapBuildingShared).xdb#xpointer(/AdvMapBuildingShared)"},
+                {"weight": 1, "type": "other", "shared": "/MapObjects/Mermaids.(AdvMapBuildingShared).xdb#xpointer(/AdvMapBuildingShared)"},
+                {"weight": 1, "type": "other", "shared": "/MapObjects/Buoy.(AdvMapBuildingShared).xdb#xpointer(/AdvMapBuildingShared)"}
+            ]
+            
+            def getSharedSampler(mList):
+                return WeightedSampler([obj["shared"] for obj in mList], [obj["weight"] for obj in mList])
+            
+            oneSquareWaterTreasShared = {obj["shared"] for obj in oneSquareWaterTreaList}
+            oneSquareWaterObjsShared = {obj["shared"] for obj in oneSquareWaterObjList}
+            
+            oneSquareWaterTreasSharedSampler = getSharedSampler(oneSquareWaterTreaList)
+            oneSquareWaterObjsSharedSampler = getSharedSampler(oneSquareWaterObjList)
+            
+            # ratios
+            waterObjDelRatio = 0.0
+            waterTreaRatio = 0.7
+            
+            # counts
+            oldOneSquareWaterItemsCount = {}
+            newOneSquareWaterItemsCount = {}
+            
+            oneSquareWaterItems = []
+            
+            # load water objects
+            for item in waterItems:
+                itemHref = item.get("href", "")
+                isTreasure = itemHref == "#n:inline(AdvMapTreasure)"
+                isBuilding = itemHref == "#n:inline(AdvMapBuilding)"
+                if isTreasure or isBuilding:
+                    innerItem = item.find("AdvMapTreasure" if isTreasure else "AdvMapBuilding")
+                    if innerItem is not None:
+                        innerItemShared = innerItem.find("Shared")
+                        if innerItemShared is not None:
+                            innerItemSharedValue = innerItemShared.get("href", "")
+                            if ((isTreasure and innerItemSharedValue in oneSquareWaterTreasShared) 
+                                or (isBuilding and innerItemSharedValue in oneSquareWaterObjsShared)):
+                                
+                                if innerItemSharedValue not in oldOneSquareWaterItemsCount:
+                                    oldOneSquareWaterItemsCount[innerItemSharedValue] = 0
+                                oldOneSquareWaterItemsCount[innerItemSharedValue] += 1
+                                
+                                # remove some sub elements
+                                tagsToRemove = ["IsCustom", "Amount", "MessageFileRef", "PlayerID", "GroupID", "showCameras"]
+                                for tagToRemove in tagsToRemove:
+                                    someItem = innerItem.find(tagToRemove)
+                                    if someItem is not None:
+                                        innerItem.remove(someItem)
+                                
+                                oneSquareWaterItems.append({"item": item, "innerItem": innerItem})
+            
+            # change water objects
+            for oneSquareWaterItem in oneSquareWaterItems:
+                item = oneSquareWaterItem["item"]
+                innerItem = oneSquareWaterItem["innerItem"]
+                innerItemShared = innerItem.find("Shared")
+                
+                if rand.random() < waterObjDelRatio:
+                    # remove water object
+                    self.mEdits.remove(item)
                 else:
-                    # building
-                    item.set("href", "#n:inline(AdvMapBuilding)")
-                    innerItem.tag = "AdvMapBuilding"
-                    innerItemShared.set("href", rand.choice(oneSquareWaterObjsSharedWeight))
+                    isTreasure = rand.random() < waterTreaRatio
+                    if isTreasure:
+                        # treasure
+                        item.set("href", "#n:inline(AdvMapTreasure)")
+                        innerItem.tag = "AdvMapTreasure"
+                        innerItemShared.set("href", oneSquareWaterTreasSharedSampler.choice())
+                        
+                        # add some sub elements
+                        XmlBackend.subElement(innerItem, "IsCustom").text = "false"
+                        XmlBackend.subElement(innerItem, "Amount").text = "0"
+                        XmlBackend.subElement(innerItem, "MessageFileRef").set("href", "")
+                    else:
+                        # building
+                        item.set("href", "#n:inline(AdvMapBuilding)")
+                        innerItem.tag = "AdvMapBuilding"
+                        innerItemShared.set("href", oneSquareWaterObjsSharedSampler.choice())
+                        
+                        # add some sub elements
+                        XmlBackend.subElement(innerItem, "PlayerID").text = "PLAYER_NONE"
+                        captureTriggerItem = XmlBackend.subElement(innerItem, "CaptureTrigger")
+                        captureTriggerActionItem = XmlBackend.subElement(captureTriggerItem, "Action")
+                        XmlBackend.subElement(captureTriggerActionItem, "FunctionName")
+                        XmlBackend.subElement(innerItem, "GroupID").text = "0"
+                        XmlBackend.subElement(innerItem, "showCameras")
                     
-                    # add some sub elements
-                    ET.SubElement(innerItem, "PlayerID").text = "PLAYER_NONE"
-                    captureTriggerItem = ET.SubElement(innerItem, "CaptureTrigger")
-                    captureTriggerActionItem = ET.SubElement(captureTriggerItem, "Action")
-                    ET.SubElement(captureTriggerActionItem, "FunctionName")
-                    ET.SubElement(innerItem, "GroupID").text = "0"
-                    ET.SubElement(innerItem, "showCameras")
-                
-                innerItemSharedValue = innerItemShared.get("href", "")
-                if innerItemSharedValue not in newOneSquareWaterItemsCount:
-                    newOneSquareWaterItemsCount[innerItemSharedValue] = 0
-                newOneSquareWaterItemsCount[innerItemSharedValue] += 1
-        
-        oldWaterObjCount = len(oneSquareWaterItems)
-        
-        print("water objects changed: {}".format(oldWaterObjCount))
-        
-        if logWaterChange and oldWaterObjCount > 0:
-            def getCounts(pCountMap, pListObjs, pObjsType):
-                totalValue = 0
-                for obj in pListObjs:
-                    if obj["type"] == pObjsType and obj["shared"] in pCountMap:
-                        totalValue += pCountMap[obj["shared"]]
-                return totalValue
-            
-            oldWaterTreaFloatsamCount = getCounts(oldOneSquareWaterItemsCount, oneSquareWaterTreaList, "floatsam")
-            oldWaterTreaChestCount = getCounts(oldOneSquareWaterItemsCount, oneSquareWaterTreaList, "chest")
-            oldWaterTreaSpecialCount = getCounts(oldOneSquareWaterItemsCount, oneSquareWaterTreaList, "special")
-            oldWaterTreaCount = oldWaterTreaFloatsamCount + oldWaterTreaChestCount + oldWaterTreaSpecialCount
-            oldWaterBuildCombatCount = getCounts(oldOneSquareWaterItemsCount, oneSquareWaterObjList, "combat")
-            oldWaterBuildOtherCount = getCounts(oldOneSquareWaterItemsCount, oneSquareWaterObjList, "other")
-            oldWaterBuildCount = oldWaterBuildCombatCount + oldWaterBuildOtherCount
+                    innerItemSharedValue = innerItemShared.get("href", "")
+                    if innerItemSharedValue not in newOneSquareWaterItemsCount:
+                        newOneSquareWaterItemsCount[innerItemSharedValue] = 0
+                    newOneSquareWaterItemsCount[innerItemSharedValue] += 1
             
-            newWaterTreaFloatsamCount = getCounts(newOneSquareWaterItemsCount, oneSquareWaterTreaList, "floatsam")
-            newWaterTreaChestCount = getCounts(newOneSquareWaterItemsCount, oneSquareWaterTreaList, "chest")
-            newWaterTreaSpecialCount = getCounts(newOneSquareWaterItemsCount, oneSquareWaterTreaList, "special")
-            newWaterTreaCount = newWaterTreaFloatsamCount + newWaterTreaChestCount + newWaterTreaSpecialCount
-            newWaterBuildCombatCount = getCounts(newOneSquareWaterItemsCount, oneSquareWaterObjList, "combat")
-            newWaterBuildOtherCount = getCounts(newOneSquareWaterItemsCount, oneSquareWaterObjList, "other")
-            newWaterBuildCount = newWaterBuildCombatCount + newWaterBuildOtherCount
-            newWaterObjCount = newWaterTreaCount + newWaterBuildCount
-            newWaterDelObjCount = oldWaterObjCount - newWaterObjCount
+            oldWaterObjCount = len(oneSquareWaterItems)
             
-            print("\nWATER OBJECTS COUNT (old map):")
-            print("water objects - count: {}".format(oldWaterObjCount))
-            if oldWaterObjCount > 0:
-                print("water treasures - count: {} ({:.2f}%) (floatsam: {} ({:.2f}%) chest: {} ({:.2f}%) special: {} ({:.2f}%))".format(
-                        oldWaterTreaCount, oldWaterTreaCount / oldWaterObjCount * 100, 
-                        oldWaterTreaFloatsamCount, (oldWaterTreaFloatsamCount / oldWaterTreaCount * 100) if oldWaterTreaCount > 0 else 0, 
-                        oldWaterTreaChestCount, (oldWaterTreaChestCount / oldWaterTreaCount * 100) if oldWaterTreaCount > 0 else 0, 
-                        oldWaterTreaSpecialCount, (oldWaterTreaSpecialCount / oldWaterTreaCount * 100) if oldWaterTreaCount > 0 else 0))
-                print("water buildings - count: {} ({:.2f}%) (combat: {} ({:.2f}%) other: {} ({:.2f}%))".format(
-                        oldWaterBuildCount, oldWaterBuildCount / oldWaterObjCount * 100, 
-                        oldWaterBuildCombatCount, (oldWaterBuildCombatCount / oldWaterBuildCount * 100) if oldWaterBuildCount > 0 else 0, 
-                        oldWaterBuildOtherCount, (oldWaterBuildOtherCount / oldWaterBuildCount * 100) if oldWaterBuildCount > 0 else 0))
-            print("")
+            print("water objects changed: {}".format(oldWaterObjCount))
             
-            print("\nWATER OBJECTS COUNT (new map):")
-            print("water objects - count: {} changed: {} ({:.2f}%) removed: {} ({:.2f}%)".format(
-                    oldWaterObjCount, 
-                    newWaterObjCount, newWaterObjCount / oldWaterObjCount * 100,
-                    newWaterDelObjCount, newWaterDelObjCount / oldWaterObjCount * 100))
-            if newWaterObjCount > 0:
-                print("water treasures - count: {} ({:.2f}%) (floatsam: {} ({:.2f}%) chest: {} ({:.2f}%) special: {} ({:.2f}%))".format(
-                        newWaterTreaCount, newWaterTreaCount / newWaterObjCount * 100, 
-                        newWaterTreaFloatsamCount, (newWaterTreaFloatsamCount / newWaterTreaCount * 100) if newWaterTreaCount > 0 else 0, 
-                        newWaterTreaChestCount, (newWaterTreaChestCount / newWaterTreaCount * 100) if newWaterTreaCount > 0 else 0, 
-                        newWaterTreaSpecialCount, (newWaterTreaSpecialCount / newWaterTreaCount * 100) if newWaterTreaCount > 0 else 0))
-                print("water buildings - count: {} ({:.2f}%) (combat: {} ({:.2f}%) other: {} ({:.2f}%))".format(
-                        newWaterBuildCount, newWaterBuildCount / newWaterObjCount * 100, 
-                        newWaterBuildCombatCount, (newWaterBuildCombatCount / newWaterBuildCount * 100) if newWaterBuildCount > 0 else 0, 
-                        newWaterBuildOtherCount, (newWaterBuildOtherCount / newWaterBuildCount * 100) if newWaterBuildCount > 0 else 0))
-            print("")
+            if logWaterChange and oldWaterObjCount > 0:
+                def getCounts(pCountMap, pListObjs, pObjsType):
+                    totalValue = 0
+                    for obj in pListObjs:
+                        if obj["type"] == pObjsType and obj["shared"] in pCountMap:
+                            totalValue += pCountMap[obj["shared"]]
+                    return totalValue
+                
+                oldWaterTreaFloatsamCount = getCounts(oldOneSquareWaterItemsCount, oneSquareWaterTreaList, "floatsam")
+                oldWaterTreaChestCount = getCounts(oldOneSquareWaterItemsCount, oneSquareWaterTreaList, "chest")
+                oldWaterTreaSpecialCount = getCounts(oldOneSquareWaterItemsCount, oneSquareWaterTreaList, "special")
+                oldWaterTreaCount = oldWaterTreaFloatsamCount + oldWaterTreaChestCount + oldWaterTreaSpecialCount
+                oldWaterBuildCombatCount = getCounts(oldOneSquareWaterItemsCount, oneSquareWaterObjList, "combat")
+                oldWaterBuildOtherCount = getCounts(oldOneSquareWaterItemsCount, oneSquareWaterObjList, "other")
+                oldWaterBuildCount = oldWaterBuildCombatCount + oldWaterBuildOtherCount
+                
+                newWaterTreaFloatsamCount = getCounts(newOneSquareWaterItemsCount, oneSquareWaterTreaList, "floatsam")
+                newWaterTreaChestCount = getCounts(newOneSquareWaterItemsCount, oneSquareWaterTreaList, "chest")
+                newWaterTreaSpecialCount = getCounts(newOneSquareWaterItemsCount, oneSquareWaterTreaList, "special")
+                newWaterTreaCount = newWaterTreaFloatsamCount + newWaterTreaChestCount + newWaterTreaSpecialCount
+                newWaterBuildCombatCount = getCounts(newOneSquareWaterItemsCount, oneSquareWaterObjList, "combat")
+                newWaterBuildOtherCount = getCounts(newOneSquareWaterItemsCount, oneSquareWaterObjList, "other")
+                newWaterBuildCount = newWaterBuildCombatCount + newWaterBuildOtherCount
+                newWaterObjCount = newWaterTreaCount + newWaterBuildCount
+                newWaterDelObjCount = oldWaterObjCount - newWaterObjCount
+                
+                print("\nWATER OBJECTS COUNT (old map):")
+                print("water objects - count: {}".format(oldWaterObjCount))
+                if oldWaterObjCount > 0:
+                    print("water treasures - count: {} ({:.2f}%) (floatsam: {} ({:.2f}%) chest: {} ({:.2f}%) special: {} ({:.2f}%))".format(
+                            oldWaterTreaCount, oldWaterTreaCount / oldWaterObjCount * 100, 
+                            oldWaterTreaFloatsamCount, (oldWaterTreaFloatsamCount / oldWaterTreaCount * 100) if oldWaterTreaCount > 0 else 0, 
+                            oldWaterTreaChestCount, (oldWaterTreaChestCount / oldWaterTreaCount * 100) if oldWaterTreaCount > 0 else 0, 
+                            oldWaterTreaSpecialCount, (oldWaterTreaSpecialCount / oldWaterTreaCount * 100) if oldWaterTreaCount > 0 else 0))
+                    print("water buildings - count: {} ({:.2f}%) (combat: {} ({:.2f}%) other: {} ({:.2f}%))".format(
+                            oldWaterBuildCount, oldWaterBuildCount / oldWaterObjCount * 100, 
+                            oldWaterBuildCombatCount, (oldWaterBuildCombatCount / oldWaterBuildCount * 100) if oldWaterBuildCount > 0 else 0, 
+                            oldWaterBuildOtherCount, (oldWaterBuildOtherCount / oldWaterBuildCount * 100) if oldWaterBuildCount > 0 else 0))
+                print("")
+                
+                print("\nWATER OBJECTS COUNT (new map):")
+                print("water objects - count: {} changed: {} ({:.2f}%) removed: {} ({:.2f}%)".format(
+                        oldWaterObjCount, 
+                        newWaterObjCount, newWaterObjCount / oldWaterObjCount * 100,
+                        newWaterDelObjCount, newWaterDelObjCount / oldWaterObjCount * 100))
+                if newWaterObjCount > 0:
+                    print("water treasures - count: {} ({:.2f}%) (floatsam: {} ({:.2f}%) chest: {} ({:.2f}%) special: {} ({:.2f}%))".format(
+                            newWaterTreaCount, newWaterTreaCount / newWaterObjCount * 100, 
+                            newWaterTreaFloatsamCount, (newWaterTreaFloatsamCount / newWaterTreaCount * 100) if newWaterTreaCount > 0 else 0, 
+                            newWaterTreaChestCount, (newWaterTreaChestCount / newWaterTreaCount * 100) if newWaterTreaCount > 0 else 0, 
+                            newWaterTreaSpecialCount, (newWaterTreaSpecialCount / newWaterTreaCount * 100) if newWaterTreaCount > 0 else 0))
+                    print("water buildings - count: {} ({:.2f}%) (combat: {} ({:.2f}%) other: {} ({:.2f}%))".format(
+                            newWaterBuildCount, newWaterBuildCount / newWaterObjCount * 100, 
+                            newWaterBuildCombatCount, (newWaterBuildCombatCount / newWaterBuildCount * 100) if newWaterBuildCount > 0 else 0, 
+                            newWaterBuildOtherCount, (newWaterBuildOtherCount / newWaterBuildCount * 100) if newWaterBuildCount > 0 else 0))
+                print("")
+        
+        self.runStage("water", pDispatcher, {"#n:inline(AdvMapTreasure)": waterItems.append, "#n:inline(AdvMapBuilding)": waterItems.append}, finish)
     
-    def changeDwellings(self):
+    def changeDwellings(self, pDispatcher=None):
         if self.mTree is None:
             return
         
-        highTierDwellsShared = [
-            "/MapObjects/Random/RandomDwelling4.xdb#xpointer(/AdvMapDwellingShared)",
-            "/MapObjects/Random/RandomDwelling5.xdb#xpointer(/AdvMapDwellingShared)",
-            "/MapObjects/Random/RandomDwelling6.xdb#xpointer(/AdvMapDwellingShared)",
-            "/MapObjects/Random/RandomDwelling7.xdb#xpointer(/AdvMapDwellingShared)",
-            "/MapObjects/Haven/Heaven_Military_Post.(AdvMapDwellingShared).xdb#xpointer(/AdvMapDwellingShared)",
-            "/MapObjects/Inferno/InfernoMilitaryPost.(AdvMapDwellingShared).xdb#xpointer(/AdvMapDwellingShared)",
-            "/MapObjects/Necropolis/Necropolis_Military_Post.(AdvMapDwellingShared).xdb#xpointer(/AdvMapDwellingShared)",
-            "/MapObjects/Preserve/Preserve_Military_Post.xdb#xpointer(/AdvMapDwellingShared)",
-            "/MapObjects/Dungeon/Dungeon_Military_Post.xdb#xpointer(/AdvMapDwellingShared)",
-            "/MapObjects/Academy/Academy_Military_Post.xdb#xpointer(/AdvMapDwellingShared)",
-            "/MapObjects/Dwarven/DwarvenDwelling04.(AdvMapDwellingShared).xdb#xpointer(/AdvMapDwellingShared)",
-            "/MapObjects/Dwarven/DwarvenDwelling04.(AdvMapDwellingShared) (2).xdb#xpointer(/AdvMapDwellingShared)",
-            "/MapObjects/Orcs/OrcishDwelling04.(AdvMapDwellingShared).xdb#xpointer(/AdvMapDwellingShared)"
-        ]
-        battleSitesShared = [
-            "AdvMapBuildingShared:MapObjects\GargoyleStonevault.(AdvMapBuildingShared).xdb#xpointer(/AdvMapBuildingShared)",
-            "AdvMapBuildingShared:MapObjects\WitchBank.(AdvMapBuildingShared).xdb#xpointer(/AdvMapBuildingShared)",
-            "AdvMapBuildingShared:MapObjects\DeserterTower.(AdvMapBuildingShared).xdb#xpointer(/AdvMapBuildingShared)",
-            "AdvMapBuildingShared:MapObjects\Cyclops_Stockpile.(AdvMapBuildingShared).xdb#xpointer(/AdvMapBuildingShared)",
-            "AdvMapBuildingShared:MapObjects\DwarvenTreasury.(AdvMapBuildingShared).xdb#xpointer(/AdvMapBuildingShared)",
-            "AdvMapBuildingShared:MapObjects\MysteryTower.(AdvMapBuildingShared).xdb#xpointer(/AdvMapBuildingShared)",
-            "AdvMapBuildingShared:MapObjects\ForestTower.(AdvMapBuildingShared).xdb#xpointer(/AdvMapBuildingShared)",
-            "AdvMapBuildingShared:MapObjects\Crypt.(AdvMapBuildingShared).xdb#xpointer(/AdvMapBuildingShared)",
-            "AdvMapBuildingShared:MapObjects\MagiVault.xdb#xpointer(/AdvMapBuildingShared)",
-            "AdvMapBuildingShared:MapObjects\TreantThicket.(AdvMapBuildingShared).xdb#xpointer(/AdvMapBuildingShared)"
-        ]
-        
-        playerTownDwellSharedList = {}
-        townDwellSharedList = {}
-        playerMap = {}
-        townMap = {}
-        dwellsChanged = 0
-        
-        townIdPrefixLen = len("#xpointer(id(")
-        townIdPostfixLen = len(")/AdvMapTown)")
-        
-        root = self.mTree.getroot()
-        objectsRoot = root.find("objects")
-        allDwells = root.findall("./objects/Item[@href='#n:inline(AdvMapDwelling)']")
-        
-        for dwellOuterNode in allDwells:
-            dwell = dwellOuterNode.find("AdvMapDwelling")
-            sharedNode = dwell.find("Shared")
-            if sharedNode is not None:
-                sharedValue = sharedNode.get("href", "")
-                if sharedValue in highTierDwellsShared:
-                    dwellsChanged += 1
-                    
-                    if len(dwellList) > 0:
-                        town = None
-                        player = None
-                        linkTownHref = dwell.find("LinkToTown").get("href", "")
-                        if len(linkTownHref) > (townIdPrefixLen + townIdPostfixLen):
-                            town = Town.getById(linkTownHref[townIdPrefixLen : len(linkTownHref) - townIdPostfixLen])
+        allDwells = []
+        
+        def finish():
+            highTierDwellsShared = [
+                "/MapObjects/Random/RandomDwelling4.xdb#xpointer(/AdvMapDwellingShared)",
+                "/MapObjects/Random/RandomDwelling5.xdb#xpointer(/AdvMapDwellingShared)",
+                "/MapObjects/Random/RandomDwelling6.xdb#xpointer(/AdvMapDwellingShared)",
+                "/MapObjects/Random/RandomDwelling7.xdb#xpointer(/AdvMapDwellingShared)",
+                "/MapObjects/Haven/Heaven_Military_Post.(AdvMapDwellingShared).xdb#xpointer(/AdvMapDwellingShared)",
+                "/MapObjects/Inferno/InfernoMilitaryPost.(AdvMapDwellingShared).xdb#xpointer(/AdvMapDwellingShared)",
+                "/MapObjects/Necropolis/Necropolis_Military_Post.(AdvMapDwellingShared).xdb#xpointer(/AdvMapDwellingShared)",
+                "/MapObjects/Preserve/Preserve_Military_Post.xdb#xpointer(/AdvMapDwellingShared)",
+                "/MapObjects/Dungeon/Dungeon_Military_Post.xdb#xpointer(/AdvMapDwellingShared)",
+                "/MapObjects/Academy/Academy_Military_Post.xdb#xpointer(/AdvMapDwellingShared)",
+                "/MapObjects/Dwarven/DwarvenDwelling04.(AdvMapDwellingShared).xdb#xpointer(/AdvMapDwellingShared)",
+                "/MapObjects/Dwarven/DwarvenDwelling04.(AdvMapDwellingShared) (2).xdb#xpointer(/AdvMapDwellingShared)",
+                "/MapObjects/Orcs/OrcishDwelling04.(AdvMapDwellingShared).xdb#xpointer(/AdvMapDwellingShared)"
+            ]
+            battleSitesShared = [
+                "AdvMapBuildingShared:MapObjects\GargoyleStonevault.(AdvMapBuildingShared).xdb#xpointer(/AdvMapBuildingShared)",
+                "AdvMapBuildingShared:MapObjects\WitchBank.(AdvMapBuildingShared).xdb#xpointer(/AdvMapBuildingShared)",
+                "AdvMapBuildingShared:MapObjects\DeserterTower.(AdvMapBuildingShared).xdb#xpointer(/AdvMapBuildingShared)",
+                "AdvMapBuildingShared:MapObjects\Cyclops_Stockpile.(AdvMapBuildingShared).xdb#xpointer(/AdvMapBuildingShared)",
+                "AdvMapBuildingShared:MapObjects\DwarvenTreasury.(AdvMapBuildingShared).xdb#xpointer(/AdvMapBuildingShared)",
+                "AdvMapBuildingShared:MapObjects\MysteryTower.(AdvMapBuildingShared).xdb#xpointer(/AdvMapBuildingShared)",
+                "AdvMapBuildingShared:MapObjects\ForestTower.(AdvMapBuildingShared).xdb#xpointer(/AdvMapBuildingShared)",
+                "AdvMapBuildingShared:MapObjects\Crypt.(AdvMapBuildingShared).xdb#xpointer(/AdvMapBuildingShared)",
+                "AdvMapBuildingShared:MapObjects\MagiVault.xdb#xpointer(/AdvMapBuildingShared)",
+                "AdvMapBuildingShared:MapObjects\TreantThicket.(AdvMapBuildingShared).xdb#xpointer(/AdvMapBuildingShared)"
+            ]
+            
+            playerTownDwellSharedList = {}
+            townDwellSharedList = {}
+            playerMap = {}
+            townMap = {}
+            dwellsChanged = 0
+            
+            townIdPrefixLen = len("#xpointer(id(")
+            townIdPostfixLen = len(")/AdvMapTown)")
+            
+            for dwellOuterNode in allDwells:
+                dwell = dwellOuterNode.find("AdvMapDwelling")
+                sharedNode = dwell.find("Shared")
+                if sharedNode is not None:
+                    sharedValue = sharedNode.get("href", "")
+                    if sharedValue in highTierDwellsShared:
+                        dwellsChanged += 1
                         
-                        if town is not None and town.hasPlayer():
-                            player = town.mPlayer
-                        else:
-                            dwellPlayer = dwell.find("PlayerID").text
-                            if dwellPlayer != "PLAYER_NONE":
-                                player = dwellPlayer
-                            """
-                            # looks like LinkToPlayer do nothing
+                        if len(dwellSampler) > 0:
+                            town = None
+                            player = None
+                            linkTownHref = dwell.find("LinkToTown").get("href", "")
+                            if len(linkTownHref) > (townIdPrefixLen + townIdPostfixLen):
+                                town = Town.getById(linkTownHref[townIdPrefixLen : len(linkTownHref) - townIdPostfixLen])
+                            
+                            if town is not None and town.hasPlayer():
+                                player = town.mPlayer
                             else:
-                                dwellLinkPlayer = dwell.find("LinkToPlayer").text
-                                if dwellLinkPlayer != "PLAYER_NONE":
-                                    player = dwellLinkPlayer
-                            """
-                        
-                        if player is not None:
-                            # player town (link) or player (owner)
-                            # all players will have same dwellings
-                            if player not in playerMap:
-                                playerMap[player] = 0
-                            if playerMap[player] not in playerTownDwellSharedList:
-                                playerTownDwellSharedList[playerMap[player]] = rand.choice(dwellList)
-                            sharedNode.set("href", playerTownDwellSharedList[playerMap[player]])
+                                dwellPlayer = dwell.find("PlayerID").text
+                                if dwellPlayer != "PLAYER_NONE":
+                                    player = dwellPlayer
+                                """
+                                # looks like LinkToPlayer do nothing
+                                else:
+                                    dwellLinkPlayer = dwell.find("LinkToPlayer").text
+                                    if dwellLinkPlayer != "PLAYER_NONE":
+                                        player = dwellLinkPlayer
+                                """
                             
-                            playerMap[player] += 1
-                        elif town is not None:
-                            # non player town
-                            # all non players towns will have same dwellings
-                            if town.mId not in townMap:
-                                townMap[town.mId] = 0
-                            if townMap[town.mId] not in townDwellSharedList:
-                                townDwellSharedList[townMap[town.mId]] = rand.choice(dwellList)
-                            sharedNode.set("href", townDwellSharedList[townMap[town.mId]])
+                            if player is not None:
+                                # player town (link) or player (owner)
+                                # all players will have same dwellings
+                                if player not in playerMap:
+                                    playerMap[player] = 0
+                                if playerMap[player] not in playerTownDwellSharedList:
+                                    playerTownDwellSharedList[playerMap[player]] = dwellSampler.choice()
+                                sharedNode.set("href", playerTownDwellSharedList[playerMap[player]])
+                                
+                                playerMap[player] += 1
+                            elif town is not None:
+                                # non player town
+                                # all non players towns will have same dwellings
+                                if town.mId not in townMap:
+                                    townMap[town.mId] = 0
+                                if townMap[town.mId] not in townDwellSharedList:
+                                    townDwellSharedList[townMap[town.mId]] = dwellSampler.choice()
+                                sharedNode.set("href", townDwellSharedList[townMap[town.mId]])
+                                
+                                townMap[town.mId] += 1
+                            else:
+                                # other
+                                sharedNode.set("href", dwellSampler.choice())
                             
-                            townMap[town.mId] += 1
+                            dwell.find("RandomCreatures").text = "false"
+                            dwell.find("creaturesEnabled").clear()
                         else:
-                            # other
-                            sharedNode.set("href", rand.choice(dwellList))
-                        
-                        dwell.find("RandomCreatures").text = "false"
-                        dwell.find("creaturesEnabled").clear()
-                    else:
-                        # disable high tier dwellings and replace them with battle sites
-                        battleSiteOuterObj = ET.SubElement(objectsRoot, "Item")
-                        battleSiteOuterObj.set("href", "#n:inline(AdvMapBuilding)")
-                        battleSiteOuterObj.set("id", "item_bsite_" + str(rand.randint(1, 999999999)))
-                        battleSiteObj = ET.SubElement(battleSiteOuterObj, "AdvMapBuilding")
-
-                        dwellPos = dwell.find("Pos")
-                        posObj = ET.SubElement(battleSiteObj, "Pos")
-                        ET.SubElement(posObj, "x").text = dwellPos.find("x").text
-                        ET.SubElement(posObj, "y").text = dwellPos.find("y").text
-                        ET.SubElement(posObj, "z").text = dwellPos.find("z").text
-                        ET.SubElement(battleSiteObj, "Rot").text = dwell.find("Rot").text
-                        ET.SubElement(battleSiteObj, "Floor").text = dwell.find("Floor").text
-                        ET.SubElement(battleSiteObj, "Shared").set("href", rand.choice(battleSitesShared))
-
-                        objectsRoot.remove(dwellOuterNode)
-                        pass
-        
-        print("high tier dwellings changed: {}".format(dwellsChanged))
-    
-    def buildTowns(self, townBuild, gamePowerLimit):
-        townBuildStr = townBuild
-        if gamePowerLimit:
-            townBuildStr += "#TB_TOWN_HALL,1,3#TB_DWELLING_5,0,0#TB_DWELLING_6,0,0#TB_DWELLING_7,0,0"
-
-        buildsTypes = []
-        buildsList = []
-        buildsListStr = townBuildStr.split("#")
-
-        for buildOptionsStr in buildsListStr:
-            buildOptions = buildOptionsStr.split(",")
-            buildObj = {
-                "Type": buildOptions[0],
-                "InitialUpgrade": "BLD_UPG_" + (buildOptions[1] if buildOptions[1] != "0" else "NONE"),
-                "MaxUpgrade": "BLD_UPG_" + ((buildOptions[2] if buildOptions[2] != "0" else "NONE") if len(buildOptions) >= 3 else "5"),
-                "Player": buildOptions[3] if len(buildOptions) == 4 else "ALL"
-            }
-            buildsTypes.append(buildObj["Type"])
-            buildsList.append(buildObj)
+                            # disable high tier dwellings and replace them with battle sites
+                            battleSiteOuterObj = self.mEdits.add("Item")
+                            battleSiteOuterObj.set("href", "#n:inline(AdvMapBuilding)")
+                            battleSiteOuterObj.set("id", RandTools.getObjectId("item_bsite_"))
+                            battleSiteObj = XmlBackend.subElement(battleSiteOuterObj, "AdvMapBuilding")
+
+                            dwellPos = dwell.find("Pos")
+                            posObj = XmlBackend.subElement(battleSiteObj, "Pos")
+                            XmlBackend.subElement(posObj, "x").text = dwellPos.find("x").text
+                            XmlBackend.subElement(posObj, "y").text = dwellPos.find("y").text
+                            XmlBackend.subElement(posObj, "z").text = dwellPos.find("z").text
+                            XmlBackend.subElement(battleSiteObj, "Rot").text = dwell.find("Rot").text
+                            XmlBackend.subElement(battleSiteObj, "Floor").text = dwell.find("Floor").text
+                            XmlBackend.subElement(battleSiteObj, "Shared").set("href", rand.choice(battleSitesShared))
+
+                            self.mEdits.remove(dwellOuterNode)
+                            pass
+            
+            print("high tier dwellings changed: {}".format(dwellsChanged))
         
-        for town in Town.sAll:
-            townInnerObj = town.mObj.find("AdvMapTown")
-            townBuilds = townInnerObj.find("buildings")
+        self.runStage("dwellings", pDispatcher, {"#n:inline(AdvMapDwelling)": allDwells.append}, finish)
+    
+    def buildTowns(self, townBuild, gamePowerLimit, pDispatcher=None):
+        def finish():
+            townBuildStr = townBuild
+            if gamePowerLimit:
+                townBuildStr += "#TB_TOWN_HALL,1,3#TB_DWELLING_5,0,0#TB_DWELLING_6,0,0#TB_DWELLING_7,0,0"
+
+            buildsTypes = []
+            buildsList = []
+            buildsListStr = townBuildStr.split("#")
+
+            for buildOptionsStr in buildsListStr:
+                buildOptions = buildOptionsStr.split(",")
+                buildObj = {
+                    "Type": buildOptions[0],
+                    "InitialUpgrade": "BLD_UPG_" + (buildOptions[1] if buildOptions[1] != "0" else "NONE"),
+                    "MaxUpgrade": "BLD_UPG_" + ((buildOptions[2] if buildOptions[2] != "0" else "NONE") if len(buildOptions) >= 3 else "5"),
+                    "Player": buildOptions[3] if len(buildOptions) == 4 else "ALL"
+                }
+                buildsTypes.append(buildObj["Type"])
+                buildsList.append(buildObj)
             
-            for build in buildsList:
-                if build["Player"] != "ALL":
-                    townPlayerID = townInnerObj.find("PlayerID").text
+            for town in Town.sAll:
+                townInnerObj = town.mObj.find("AdvMapTown")
+                townBuilds = townInnerObj.find("buildings")
+                
+                for build in buildsList:
+                    if build["Player"] != "ALL":
+                        townPlayerID = townInnerObj.find("PlayerID").text
 
-                    if build["Player"] == "PLAYER":
-                        if townPlayerID == "PLAYER_NONE":
-                            continue
-                    elif build["Player"] == "NONE":
-                        if townPlayerID != "PLAYER_NONE":
+                        if build["Player"] == "PLAYER":
+                            if townPlayerID == "PLAYER_NONE":
+                                continue
+                        elif build["Player"] == "NONE":
+                            if townPlayerID != "PLAYER_NONE":
+                                continue
+                        elif townPlayerID != ("PLAYER_" + build["Player"]):
                             continue
-                    elif townPlayerID != ("PLAYER_" + build["Player"]):
-                        continue
-                
-                for townBuild in townBuilds:
-                    if townBuild.find("Type").text == build["Type"]:
-                        townBuilds.remove(townBuild)
-                        break
-                
-                buildDesc = ET.SubElement(townBuilds, "Item")
-                ET.SubElement(buildDesc, "Type").text = build["Type"]
-                ET.SubElement(buildDesc, "InitialUpgrade").text = build["InitialUpgrade"]
-                ET.SubElement(buildDesc, "MaxUpgrade").text = build["MaxUpgrade"]
-        
-        print("towns buildings changed")
-
-    def addPlayerBonus(self, bonusChest, bonusArt):
-        # NOTE: Map position 0-0 is at left-bottom corner.
-        #       Object position is usually at center.
-        #       Object basic rotations are: 0 (6 hours), 1.57079 (3 hours), 3.14159 (12 hours), 4.71238 (9 hours)
-        #       Work only with basic rotations!!
-        townSize = 9
-        entranceAddPos = 4 # or 5?
-        bonusAddPos = 7
-        rotEntranceDescs = {
-            "0":       {"frontPos": "y", "sidePos": "x", "frontMulti": -1, "reverseRot": "3.14159"},
-            "1.57079": {"frontPos": "x", "sidePos": "y", "frontMulti": 1, "reverseRot": "4.71238"},
-            "3.14159": {"frontPos": "y", "sidePos": "x", "frontMulti": 1, "reverseRot": "0"},
-            "4.71238": {"frontPos": "x", "sidePos": "y", "frontMulti": -1, "reverseRot": "1.57079"},
-        }
+                    
+                    for townBuildNode in townBuilds:
+                        if townBuildNode.find("Type").text == build["Type"]:
+                            townBuilds.remove(townBuildNode)
+                            break
+                    
+                    buildDesc = XmlBackend.subElement(townBuilds, "Item")
+                    XmlBackend.subElement(buildDesc, "Type").text = build["Type"]
+                    XmlBackend.subElement(buildDesc, "InitialUpgrade").text = build["InitialUpgrade"]
+                    XmlBackend.subElement(buildDesc, "MaxUpgrade").text = build["MaxUpgrade"]
+            
+            print("towns buildings changed")
+        
+        self.runStage("towns", pDispatcher, {}, finish)
 
-        root = self.mTree.getroot()
-        objectsRoot = root.find("objects")
-
-        for town in Town.sAll:
-            townInnerObj = town.mObj.find("AdvMapTown")
-            if townInnerObj.find("PlayerID").text != "PLAYER_NONE":
-                townPos = townInnerObj.find("Pos")
-                townPosInfo = {
-                    "x": int(townPos.find("x").text),
-                    "y": int(townPos.find("y").text),
-                    "z": int(townPos.find("z").text),
-                    "Floor": townInnerObj.find("Floor").text,
-                    "Rot": townInnerObj.find("Rot").text
-                }
-                rotEntranceDesc = rotEntranceDescs[townPosInfo["Rot"]] if townPosInfo["Rot"] in rotEntranceDescs else rotEntranceDescs["0"]
+    def addPlayerBonus(self, bonusChest, bonusArt, pDispatcher=None):
+        def finish():
+            # NOTE: Map position 0-0 is at left-bottom corner.
+            #       Object position is usually at center.
+            #       Object basic rotations are: 0 (6 hours), 1.57079 (3 hours), 3.14159 (12 hours), 4.71238 (9 hours)
+            #       Work only with basic rotations!!
+            townSize = 9
+            entranceAddPos = 4 # or 5?
+            bonusAddPos = 7
+            rotEntranceDescs = {
+                "0":       {"frontPos": "y", "sidePos": "x", "frontMulti": -1, "reverseRot": "3.14159"},
+                "1.57079": {"frontPos": "x", "sidePos": "y", "frontMulti": 1, "reverseRot": "4.71238"},
+                "3.14159": {"frontPos": "y", "sidePos": "x", "frontMulti": 1, "reverseRot": "0"},
+                "4.71238": {"frontPos": "x", "sidePos": "y", "frontMulti": -1, "reverseRot": "1.57079"},
+            }
 
-                bonusPosInfo = {
-                    rotEntranceDesc["frontPos"]: townPosInfo[rotEntranceDesc["frontPos"]] + (bonusAddPos  * rotEntranceDesc["frontMulti"]),
-                    rotEntranceDesc["sidePos"]: townPosInfo[rotEntranceDesc["sidePos"]],
-                    "Rot": rotEntranceDesc["reverseRot"]
-                }
+            for town in Town.sAll:
+                townInnerObj = town.mObj.find("AdvMapTown")
+                if townInnerObj.find("PlayerID").text != "PLAYER_NONE":
+                    townPos = townInnerObj.find("Pos")
+                    townPosInfo = {
+                        "x": int(townPos.find("x").text),
+                        "y": int(townPos.find("y").text),
+                        "z": int(townPos.find("z").text),
+                        "Floor": townInnerObj.find("Floor").text,
+                        "Rot": townInnerObj.find("Rot").text
+                    }
+                    rotEntranceDesc = rotEntranceDescs[townPosInfo["Rot"]] if townPosInfo["Rot"] in rotEntranceDescs else rotEntranceDescs["0"]
 
-                if bonusChest > 0:
-                    # bonus chest
-                    bonusOuterObj = ET.SubElement(objectsRoot, "Item")
-                    bonusOuterObj.set("href", "#n:inline(AdvMapTreasure)")
-                    bonusOuterObj.set("id", "item_chest_" + str(rand.randint(1, 999999999)))
-                    bonusObj = ET.SubElement(bonusOuterObj, "AdvMapTreasure")
-                    posObj = ET.SubElement(bonusObj, "Pos")
-                    ET.SubElement(posObj, "x").text = str(bonusPosInfo["x"])
-                    ET.SubElement(posObj, "y").text = str(bonusPosInfo["y"])
-                    ET.SubElement(posObj, "z").text = str(townPosInfo["z"])
-                    ET.SubElement(bonusObj, "Rot").text = bonusPosInfo["Rot"]
-                    ET.SubElement(bonusObj, "Floor").text = townPosInfo["Floor"]
-                    ET.SubElement(bonusObj, "Shared").set("href", "/MapObjects/Chest.(AdvMapTreasureShared).xdb#xpointer(/AdvMapTreasureShared)")
-                    ET.SubElement(bonusObj, "IsCustom").text = "true"
-                    ET.SubElement(bonusObj, "Amount").text = str(bonusChest) # (x * 500 XP) or ((x * 500) + 500 gold)
-                    # ET.SubElement(bonusObj, "Name")
-                    # ET.SubElement(bonusObj, "CombatScript")
-                    # ET.SubElement(bonusObj, "pointLights")
-                    # ET.SubElement(bonusObj, "MessageFileRef").set("href", "")
-
-                if bonusArt:
-                    # bonus artifact
-                    bonusOuterObj = ET.SubElement(objectsRoot, "Item")
-                    bonusOuterObj.set("href", "#n:inline(AdvMapArtifact)")
-                    bonusOuterObj.set("id", "item_art_" + str(rand.randint(1, 999999999)))
-                    bonusObj = ET.SubElement(bonusOuterObj, "AdvMapArtifact")
-                    posObj = ET.SubElement(bonusObj, "Pos")
-                    ET.SubElement(posObj, rotEntranceDesc["frontPos"]).text = str(bonusPosInfo[rotEntranceDesc["frontPos"]])
-                    ET.SubElement(posObj, rotEntranceDesc["sidePos"]).text = str(bonusPosInfo[rotEntranceDesc["sidePos"]] + 1)
-                    ET.SubElement(posObj, "z").text = str(townPosInfo["z"])
-                    ET.SubElement(bonusObj, "Rot").text = bonusPosInfo["Rot"]
-                    ET.SubElement(bonusObj, "Floor").text = townPosInfo["Floor"]
-                    ET.SubElement(bonusObj, "Shared").set("href", "/MapObjects/Random/Random-Minor.(AdvMapArtifactShared).xdb#xpointer(/AdvMapArtifactShared)")
-
-                # # bonus unit (not working ...)
-                # bonusOuterObj = ET.SubElement(objectsRoot, "Item")
-                # bonusOuterObj.set("href", "#n:inline(AdvMapMonster)")
-                # bonusOuterObj.set("id", "item_monter_" + str(rand.randint(1, 999999999)))
-                # bonusObj = ET.SubElement(bonusOuterObj, "AdvMapMonster")
-                # posObj = ET.SubElement(bonusObj, "Pos")
-                # ET.SubElement(posObj, rotEntranceDesc["frontPos"]).text = str(bonusPosInfo[rotEntranceDesc["frontPos"]])
-                # ET.SubElement(posObj, rotEntranceDesc["sidePos"]).text = str(bonusPosInfo[rotEntranceDesc["sidePos"]] - 1)
-                # ET.SubElement(posObj, "z").text = str(townPosInfo["z"])
-                # ET.SubElement(bonusObj, "Rot").text = bonusPosInfo["Rot"]
-                # ET.SubElement(bonusObj, "Floor").text = townPosInfo["Floor"]
-                # ET.SubElement(bonusObj, "Shared").set("href", "/MapObjects/Random/Random-Monster-L4.(AdvMapMonsterShared).xdb#xpointer(/AdvMapMonsterShared)")
-                # ET.SubElement(bonusObj, "Custom").text = "true"
-                # ET.SubElement(bonusObj, "Amount").text = "5"
-                # ET.SubElement(bonusObj, "Amount2").text = "0"
-                # ET.SubElement(bonusObj, "DoesNotGrow").text = "true"
-                # ET.SubElement(bonusObj, "Mood").text = "MONSTER_MOOD_FRIENDLY"
-                # ET.SubElement(bonusObj, "Courage").text = "MONSTER_COURAGE_ALWAYS_JOIN"
-                # # ET.SubElement(bonusObj, "LinkToPlayer").text = townInnerObj.find("PlayerID").text
-                # # ET.SubElement(bonusObj, "LinkToTown").set("href", "#xpointer(id(" + town.mObj.get("id") + ")/AdvMapTown)")
-            
-        print("players' bonuses added")
+                    bonusPosInfo = {
+                        rotEntranceDesc["frontPos"]: townPosInfo[rotEntranceDesc["frontPos"]] + (bonusAddPos  * rotEntranceDesc["frontMulti"]),
+                        rotEntranceDesc["sidePos"]: townPosInfo[rotEntranceDesc["sidePos"]],
+                        "Rot": rotEntranceDesc["reverseRot"]
+                    }
+
+                    if bonusChest > 0:
+                        # bonus chest
+                        bonusOuterObj = self.mEdits.add("Item")
+                        bonusOuterObj.set("href", "#n:inline(AdvMapTreasure)")
+                        bonusOuterObj.set("id", RandTools.getObjectId("item_chest_"))
+                        bonusObj = XmlBackend.subElement(bonusOuterObj, "AdvMapTreasure")
+                        posObj = XmlBackend.subElement(bonusObj, "Pos")
+                        XmlBackend.subElement(posObj, "x").text = str(bonusPosInfo["x"])
+                        XmlBackend.subElement(posObj, "y").text = str(bonusPosInfo["y"])
+                        XmlBackend.subElement(posObj, "z").text = str(townPosInfo["z"])
+                        XmlBackend.subElement(bonusObj, "Rot").text = bonusPosInfo["Rot"]
+                        XmlBackend.subElement(bonusObj, "Floor").text = townPosInfo["Floor"]
+                        XmlBackend.subElement(bonusObj, "Shared").set("href", "/MapObjects/Chest.(AdvMapTreasureShared).xdb#xpointer(/AdvMapTreasureShared)")
+                        XmlBackend.subElement(bonusObj, "IsCustom").text = "true"
+                        XmlBackend.subElement(bonusObj, "Amount").text = str(bonusChest) # (x * 500 XP) or ((x * 500) + 500 gold)
+                        # XmlBackend.subElement(bonusObj, "Name")
+                        # XmlBackend.subElement(bonusObj, "CombatScript")
+                        # XmlBackend.subElement(bonusObj, "pointLights")
+                        # XmlBackend.subElement(bonusObj, "MessageFileRef").set("href", "")
+
+                    if bonusArt:
+                        # bonus artifact
+                        bonusOuterObj = self.mEdits.add("Item")
+                        bonusOuterObj.set("href", "#n:inline(AdvMapArtifact)")
+                        bonusOuterObj.set("id", RandTools.getObjectId("item_art_"))
+                        bonusObj = XmlBackend.subElement(bonusOuterObj, "AdvMapArtifact")
+                        posObj = XmlBackend.subElement(bonusObj, "Pos")
+                        XmlBackend.subElement(posObj, rotEntranceDesc["frontPos"]).text = str(bonusPosInfo[rotEntranceDesc["frontPos"]])
+                        XmlBackend.subElement(posObj, rotEntranceDesc["sidePos"]).text = str(bonusPosInfo[rotEntranceDesc["sidePos"]] + 1)
+                        XmlBackend.subElement(posObj, "z").text = str(townPosInfo["z"])
+                        XmlBackend.subElement(bonusObj, "Rot").text = bonusPosInfo["Rot"]
+                        XmlBackend.subElement(bonusObj, "Floor").text = townPosInfo["Floor"]
+                        XmlBackend.subElement(bonusObj, "Shared").set("href", "/MapObjects/Random/Random-Minor.(AdvMapArtifactShared).xdb#xpointer(/AdvMapArtifactShared)")
+
+                    # # bonus unit (not working ...)
+                    # bonusOuterObj = self.mEdits.add("Item")
+                    # bonusOuterObj.set("href", "#n:inline(AdvMapMonster)")
+                    # bonusOuterObj.set("id", RandTools.getObjectId("item_monter_"))
+                    # bonusObj = XmlBackend.subElement(bonusOuterObj, "AdvMapMonster")
+                    # posObj = XmlBackend.subElement(bonusObj, "Pos")
+                    # XmlBackend.subElement(posObj, rotEntranceDesc["frontPos"]).text = str(bonusPosInfo[rotEntranceDesc["frontPos"]])
+                    # XmlBackend.subElement(posObj, rotEntranceDesc["sidePos"]).text = str(bonusPosInfo[rotEntranceDesc["sidePos"]] - 1)
+                    # XmlBackend.subElement(posObj, "z").text = str(townPosInfo["z"])
+                    # XmlBackend.subElement(bonusObj, "Rot").text = bonusPosInfo["Rot"]
+                    # XmlBackend.subElement(bonusObj, "Floor").text = townPosInfo["Floor"]
+                    # XmlBackend.subElement(bonusObj, "Shared").set("href", "/MapObjects/Random/Random-Monster-L4.(AdvMapMonsterShared).xdb#xpointer(/AdvMapMonsterShared)")
+                    # XmlBackend.subElement(bonusObj, "Custom").text = "true"
+                    # XmlBackend.subElement(bonusObj, "Amount").text = "5"
+                    # XmlBackend.subElement(bonusObj, "Amount2").text = "0"
+                    # XmlBackend.subElement(bonusObj, "DoesNotGrow").text = "true"
+                    # XmlBackend.subElement(bonusObj, "Mood").text = "MONSTER_MOOD_FRIENDLY"
+                    # XmlBackend.subElement(bonusObj, "Courage").text = "MONSTER_COURAGE_ALWAYS_JOIN"
+                    # # XmlBackend.subElement(bonusObj, "LinkToPlayer").text = townInnerObj.find("PlayerID").text
+                    # # XmlBackend.subElement(bonusObj, "LinkToTown").set("href", "#xpointer(id(" + town.mObj.get("id") + ")/AdvMapTown)")
+                
+            print("players' bonuses added")
+        
+        self.runStage("bonus", pDispatcher, {}, finish)
     
-    def enableScripts(self):
+    def enableScripts(self, pDispatcher=None):
         if self.mTree is None:
             return
         
-        root = self.mTree.getroot()
-        mapScriptNode = root.find("MapScript")
-        
-        if mapScriptNode is None:
-            mapScriptNode = ET.SubElement(root, "MapScript")
+        def finish():
+            root = self.mTree.getroot()
+            mapScriptNode = root.find("MapScript")
+            
+            if mapScriptNode is None:
+                mapScriptNode = XmlBackend.subElement(root, "MapScript")
+            
+            if len(mapScriptNode.get("href", "")) == 0:
+                mapScriptNode.set("href", "MapScript.xdb#xpointer(/Script)")
+                print("scripts enabled")
         
-        if len(mapScriptNode.get("href", "")) == 0:
-            mapScriptNode.set("href", "MapScript.xdb#xpointer(/Script)")
-            print("scripts enabled")
+        self.runStage("scripts", pDispatcher, {}, finish)
+
+
+# catalog state funcs
+def getCatalogState():
+    # all class variables of catalogs (to be shipped to worker processes)
+    state = {}
+    for catalogClass in [Artifact, Creature]:
+        state[catalogClass.__name__] = {name: value for name, value in vars(catalogClass).items() 
+                                        if name.startswith("s") and not callable(value) and not isinstance(value, (staticmethod, classmethod))}
+    return state
+
+def setCatalogState(pState):
+    for catalogClass in [Artifact, Creature]:
+        for name, value in pState[catalogClass.__name__].items():
+            setattr(catalogClass, name, value)
+
+
+# map funcs
+def getMapStages(pMap):
+    stages = []
+    if artChange:
+        stages.append(pMap.changeArtifacts)
+    if creaChange:
+        stages.append(pMap.changeCreatures)
+    if enableScripts:
+        stages.append(pMap.enableScripts)
+    if waterChange:
+        stages.append(pMap.changeWaterObjects)
+    if dwellChange:
+        stages.append(pMap.changeDwellings)
+    if len(townBuild) != 0 or gamePowerLimit:
+        stages.append(functools.partial(pMap.buildTowns, townBuild, gamePowerLimit))
+    if bonusChest > 0 or bonusArt:
+        stages.append(functools.partial(pMap.addPlayerBonus, bonusChest, bonusArt))
+    return stages
+
+def changeMap(pMap, pArgs=None, pJobs=1):
+    if candidates > 1 and pMap.mTree is not None:
+        pMap.setStream(pMap.mVariant, pMap.findBestCandidate(pArgs, pJobs))
+    pMap.processObjects(getMapStages(pMap))
+
+def processMap(pMapFile, pArgs=None, pJobs=1):
+    print("")
+    Profiler.begin(pMapFile)
+    Counters.begin(pMapFile)
+    gameMap = Map(pMapFile)
+    with Profiler.stage("load"):
+        gameMap.load()
+    
+    if variants > 1 and gameMap.mTree is not None:
+        # more maps from one loaded map (last variant changes loaded tree)
+        with Profiler.stage("members"):
+            rawMembers = gameMap.getRawMembers()
+        for variant in range(1, variants + 1):
+            print("variant {}:".format(variant))
+            with Profiler.stage("variant{}".format(variant)):
+                if variant < variants:
+                    with Profiler.stage("copy"):
+                        variantMap = gameMap.getCopy(variant)
+                else:
+                    variantMap = gameMap
+                    variantMap.setStream(variant)
+                changeMap(variantMap, pArgs, pJobs)
+                with Profiler.stage("save"):
+                    variantMap.saveAs(gameMap.getVariantFileName(variant), rawMembers)
+    else:
+        changeMap(gameMap, pArgs, pJobs)
+        with Profiler.stage("save"):
+            gameMap.save()
+    return Profiler.end(), Counters.end()
+
+def initMapJob(pArgs, pCatalogState):
+    # init worker process (args and already loaded catalogs)
+    PakArchive.forget()
+    parseArgs(pArgs)
+    setCatalogState(pCatalogState)
+
+def initCandidateJob(pArgs, pCatalogState, pMap):
+    # init worker process (args, catalogs and already loaded map)
+    initMapJob(pArgs, pCatalogState)
+    Map.sJobMap = pMap
+
+def runCandidateJob(pCandidate):
+    return Map.sJobMap.getCandidateScore(pCandidate)
+
+def runMapJob(pMapFile):
+    # change map in worker process (output and error are returned to main process)
+    output = io.StringIO()
+    error = None
+    report = None
+    counterReport = None
+    with contextlib.redirect_stdout(output):
+        try:
+            report, counterReport = processMap(pMapFile)
+        except MyException as ex:
+            error = str(ex)
+        except Exception:
+            error = traceback.format_exc()
+    return output.getvalue(), error, report, counterReport
 
 
 # main func
@@ -1755,36 +3185,66 @@ def run(pArgs=None):
         pArgs = sys.argv[1:]
     parseArgs(pArgs)
     
+    if candidates > 1 and seed is None:
+        # candidates are changed again by seed
+        pArgs = list(pArgs) + ["--seed={}".format(rand.SystemRandom().getrandbits(32))]
+        parseArgs(pArgs)
+        print("seed: {}".format(seed))
+    
     if (artChange or creaChange or enableScripts or waterChange or dwellChange or len(townBuild) != 0 
             or gamePowerLimit or bonusChest > 0 or bonusArt):
-        Artifact.init()
-        Creature.init()
-        
-        for mapFile in mapFiles:
-            print("")
-            gameMap = Map(mapFile)
-            gameMap.load()
-            
-            if artChange:
-                gameMap.changeArtifacts()
-            if creaChange:
-                gameMap.changeCreatures()
-            if enableScripts:
-                gameMap.enableScripts()
-            if waterChange:
-                gameMap.changeWaterObjects()
-            if dwellChange:
-                gameMap.changeDwellings()
-            if len(townBuild) != 0 or gamePowerLimit:
-                gameMap.buildTowns(townBuild, gamePowerLimit)
-            if bonusChest > 0 or bonusArt:
-                gameMap.addPlayerBonus(bonusChest, bonusArt)
-
-            gameMap.save()
+        RandTools.setStream("catalogs")
+        Profiler.sReports = []
+        Counters.sReports = []
+        Profiler.begin("catalogs")
+        Counters.begin("catalogs")
+        with Profiler.stage("artifacts"):
+            Artifact.init()
+        with Profiler.stage("creatures"):
+            Creature.init()
+        Profiler.end()
+        Counters.end()
+        
+        failedMapFiles = []
+        if jobs > 1 and len(mapFiles) > 1:
+            # change maps in worker processes
+            with concurrent.futures.ProcessPoolExecutor(min(jobs, len(mapFiles)), initializer=initMapJob, 
+                                                        initargs=(pArgs, getCatalogState())) as pool:
+                futures = {pool.submit(runMapJob, mapFile): mapFile for mapFile in mapFiles}
+                for future in concurrent.futures.as_completed(futures):
+                    mapFile = futures[future]
+                    try:
+                        output, error, report, counterReport = future.result()
+                    except Exception as ex:
+                        output, error, report, counterReport = "", repr(ex), None, None
+                    
+                    print(output, end="")
+                    if report is not None:
+                        Profiler.sReports.append(report)
+                    if counterReport is not None:
+                        Counters.sReports.append(counterReport)
+                    if error is not None:
+                        failedMapFiles.append(mapFile)
+                        print("map failed ({}): {}".format(mapFile, error))
+        else:
+            for mapFile in mapFiles:
+                processMap(mapFile, pArgs, jobs)
+        
+        if profile is not None:
+            Profiler.printSummary()
+            Profiler.writeReport(profile)
+            if tracemalloc.is_tracing():
+                tracemalloc.stop()
+        if counters is not None:
+            Counters.writeReport(counters)
+        
+        if len(failedMapFiles) > 0:
+            Log.error("Maps failed: {}".format(", ".join(failedMapFiles)))
 
 
 if __name__ == "__main__":
     # prog execution
+    multiprocessing.freeze_support()
     try:
         run()
     except MyException as ex:
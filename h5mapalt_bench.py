@@ -0,0 +1,851 @@
+#!/usr/bin/env python3
+# -*- encoding: UTF-8 -*-
+#
+
+import os, sys, time, bisect, collections, json, math, shutil, statistics, subprocess, zipfile
+import random as rand
+import h5mapalt as mapalt
+
+
+__author__ = mapalt.__author__
+__version__ = mapalt.__version__
+
+
+# print help func
+def printHelp():
+    print("""
+Execution: python script.py [OPTIONS]
+
+This script benchmarks h5mapalt on synthetic game data and map (real game is not needed).
+Synthetic "data" folder and map are generated to bench folder (only when fixture options are changed),
+then map is changed by h5mapalt (in own process) and times of its stages are stored to results file.
+
+Options:
+    --benchFolder=h5mapalt_bench    Folder of synthetic game ("data" folder, "Maps" folder).
+    --fixtureSeed=1                 Seed of generated game data and map.
+    --creatures=126                 Number of creatures in "data.pak" (spread over towns, tiers and upgrades).
+    --artifacts=60                  Number of artifacts in "data.pak".
+    --ncfCreatures=0                Number of creatures in "NCF_1.pak" (NCF creatures are used, if not 0).
+    --indexPak=false                To generate also "MMH55-Index.pak" (creatures/artifacts are loaded from it).
+    --monsters=1000                 Number of monsters on map.
+    --mapArtifacts=500              Number of artifacts on map.
+    --water=500                     Number of water objects on map (flotsams, sirens).
+    --dwellings=200                 Number of random dwellings on map.
+    --towns=4                       Number of towns on map (first two belong to players).
+    
+    --script=""                     Benchmarked script (empty value: h5mapalt.py next to this script).
+    --toolArgs=""                   More args of benchmarked script (separated by spaces, e.g. "--xmlBackend=lxml --compressJobs=2").
+    --repeats=3                     Number of runs (median of stage times is stored).
+    --results=h5mapalt_bench.json   File of stored results (results of more labels/versions).
+    --label=""                      Label of stored results (empty value: version of h5mapalt).
+    --compare=""                    Label of stored results to compare with (ratio of times is printed).
+    
+    --scaling=""                    Sizes of maps (numbers of objects) to measure scaling of stages (e.g. "1000,10000,100000").
+                                        - objects are split by ratio of fixture options (monsters, mapArtifacts, water, dwellings, towns)
+                                        - growth exponent of every map stage is fitted (time ~ size ** exponent)
+                                        - fails (exit code 1), when some exponent is higher than its bound
+    --maxExponent=1.25              Bound of growth exponent (1.0 == linear, 2.0 == quadratic).
+    --stageExponents=""             Bounds of some stages (e.g. "map/objects/creatures:1.5,map/save:1.1").
+    --minTime=0.05                  Stages faster than this (on biggest map, in seconds) are not checked (too noisy).
+    
+    --reference=""                  Reference script (e.g. older version) to compare changed maps with (golden output).
+                                        - map is changed by both scripts with same seeds (seeds 1 - goldenRuns)
+                                        - map file (canonicalized xml) and other files of map archive are compared
+                                        - power, tiers, moods and stacks of armies are compared as distributions (all runs)
+                                        - fails (exit code 1), when outputs or distributions differ
+    --referenceArgs=""              Args of reference script (empty value: same as arg "toolArgs").
+    --goldenRuns=3                  Number of seeds (runs of both scripts).
+    --exact=true                    Map files must be same (false: only distributions and other files are compared).
+                                        - false is needed, when reference has other random values (other version of random values, no seed)
+    --referenceSeed=true            To pass seed to reference (false: for versions without arg "seed").
+    
+    --fillCheck=false               To check fill of big armies (closed form) against loop (in this process, map is not changed).
+                                        - armies of fixture creature groups above loop limit are filled by both ways (fillDraws times)
+                                        - power and counts of stacks are compared as distributions (Kolmogorov-Smirnov)
+                                        - fails (exit code 1), when distributions differ
+    --fillDraws=3000                Number of filled armies (of every group and way).
+    
+    --backendCheck=false            To check that map saved by lxml is same as map saved by xml.etree (arg "xmlBackend" of h5mapalt).
+                                        - map is changed with both backends (seeds 1 - goldenRuns, args "toolArgs")
+                                        - raw bytes of map file (not canonicalized) and other files of map archive are compared
+                                        - fails (exit code 1), when bytes differ (lxml must be installed)
+
+Author: {}
+Version: {}
+    """.format(__author__, __version__))
+
+
+# reset args func
+def resetArgs():
+    g = globals()
+    g["benchFolder"] = "h5mapalt_bench"
+    g["fixtureSeed"] = "1"
+    g["creatures"] = "126"
+    g["artifacts"] = "60"
+    g["ncfCreatures"] = "0"
+    g["indexPak"] = "false"
+    g["monsters"] = "1000"
+    g["mapArtifacts"] = "500"
+    g["water"] = "500"
+    g["dwellings"] = "200"
+    g["towns"] = "4"
+    
+    g["script"] = ""
+    g["toolArgs"] = ""
+    g["repeats"] = "3"
+    g["results"] = "h5mapalt_bench.json"
+    g["label"] = ""
+    g["compare"] = ""
+    
+    g["scaling"] = ""
+    g["maxExponent"] = "1.25"
+    g["stageExponents"] = ""
+    g["minTime"] = "0.05"
+    
+    g["reference"] = ""
+    g["referenceArgs"] = ""
+    g["goldenRuns"] = "3"
+    g["exact"] = "true"
+    g["referenceSeed"] = "true"
+    
+    g["fillCheck"] = "false"
+    g["fillDraws"] = "3000"
+    
+    g["backendCheck"] = "false"
+
+
+# parse args func
+def parseArgs(pArgs):
+    resetArgs()
+    g = globals()
+    
+    # parse args
+    validArgs = [
+        "benchFolder", "fixtureSeed", "creatures", "artifacts", "ncfCreatures", "indexPak", "monsters", "mapArtifacts",
+        "water", "dwellings", "towns", "script", "toolArgs", "repeats", "results", "label", "compare", 
+        "scaling", "maxExponent", "stageExponents", "minTime", "reference", "referenceArgs", "goldenRuns", "exact", "referenceSeed",
+        "fillCheck", "fillDraws", "backendCheck"
+    ]
+    for arg in pArgs:
+        if arg == "-h" or arg == "--help":
+            printHelp()
+            sys.exit()
+        knownArg = False
+        valueSepPos = arg.find("=")
+        if len(arg) > 1 and valueSepPos != -1:
+            argName = arg[2:valueSepPos]
+            argValue = arg[valueSepPos + 1:]
+            if argName in validArgs:
+                g[argName] = argValue
+                knownArg = True
+        if not knownArg:
+            printHelp()
+            mapalt.Log.error("Unknown argument: \"{}\"".format(arg))
+    
+    # convert args
+    trueStrList = ["true"]
+    
+    g["indexPak"] = g["indexPak"] in trueStrList
+    g["exact"] = g["exact"] in trueStrList
+    g["referenceSeed"] = g["referenceSeed"] in trueStrList
+    g["fillCheck"] = g["fillCheck"] in trueStrList
+    g["backendCheck"] = g["backendCheck"] in trueStrList
+    try:
+        for argName in ["fixtureSeed", "creatures", "artifacts", "ncfCreatures", "monsters", "mapArtifacts", "water", "dwellings", "towns"]:
+            g[argName] = max(0, int(g[argName]))
+        g["creatures"] = max(1, g["creatures"])
+        g["artifacts"] = max(3, g["artifacts"])
+        g["repeats"] = max(1, int(g["repeats"]))
+        g["scaling"] = sorted(set(max(1, int(size)) for size in g["scaling"].split(",") if len(size.strip()) > 0))
+        g["maxExponent"] = float(g["maxExponent"])
+        g["stageExponents"] = {stage.strip(): float(bound) for stage, bound in 
+                               (item.rsplit(":", 1) for item in g["stageExponents"].split(",") if len(item.strip()) > 0)}
+        g["minTime"] = float(g["minTime"])
+        g["goldenRuns"] = max(1, int(g["goldenRuns"]))
+        g["fillDraws"] = max(10, int(g["fillDraws"]))
+    except ValueError:
+        printHelp()
+        mapalt.Log.error("Value error!")
+    
+    if len(g["script"]) == 0:
+        g["script"] = os.path.join(os.path.dirname(os.path.abspath(__file__)), "h5mapalt.py")
+    if not os.path.exists(g["script"]):
+        mapalt.Log.error("Script does not exist: \"{}\"".format(g["script"]))
+    g["toolArgs"] = g["toolArgs"].split()
+    g["referenceArgs"] = g["referenceArgs"].split() if len(g["referenceArgs"]) > 0 else g["toolArgs"]
+    if len(g["reference"]) > 0 and not os.path.exists(g["reference"]):
+        mapalt.Log.error("Script does not exist: \"{}\"".format(g["reference"]))
+    if len(g["label"]) == 0:
+        g["label"] = __version__
+    if len(g["scaling"]) == 1:
+        mapalt.Log.error("More sizes are needed to measure scaling!")
+
+
+# main prog
+
+class Fixture:
+    sTowns = ["TOWN_HEAVEN", "TOWN_INFERNO", "TOWN_NECROMANCY", "TOWN_PRESERVE", "TOWN_DUNGEON", "TOWN_ACADEMY", "TOWN_FORTRESS", "TOWN_STRONGHOLD"]
+    sNeutralTown = "TOWN_NO_TYPE"
+    sTierPowers = [60, 130, 250, 500, 900, 1700, 3500]
+    sArtTypes = ["ARTF_CLASS_MINOR", "ARTF_CLASS_MAJOR", "ARTF_CLASS_RELIC"]
+    sArtPrices = [1000, 5000, 10000]
+    sWaterShareds = ["/MapObjects/Floatsam.(AdvMapTreasureShared).xdb#xpointer(/AdvMapTreasureShared)",
+                     "/MapObjects/Sirens.(AdvMapBuildingShared).xdb#xpointer(/AdvMapBuildingShared)"]
+    sMapFolder = "Maps/SingleMissions/bench/"
+    sVersion = 2 # fixture is generated again, when it is changed
+    
+    @classmethod
+    def getParams(pClass):
+        # fixture is generated again, only when some of these is changed
+        params = {argName: globals()[argName] for argName in
+                  ["fixtureSeed", "creatures", "artifacts", "ncfCreatures", "indexPak", "monsters", "mapArtifacts", "water", "dwellings", "towns"]}
+        params["version"] = pClass.sVersion
+        return params
+    
+    @staticmethod
+    def getMapFileName():
+        return os.path.join(benchFolder, "Maps", "bench.h5m")
+    
+    @classmethod
+    def update(pClass):
+        paramsFileName = os.path.join(benchFolder, "fixture.json")
+        params = pClass.getParams()
+        if os.path.exists(paramsFileName) and os.path.exists(pClass.getMapFileName()):
+            with open(paramsFileName, "r", encoding="utf-8") as paramsFile:
+                if json.load(paramsFile) == params:
+                    return
+        
+        startTime = time.perf_counter()
+        if os.path.exists(benchFolder):
+            shutil.rmtree(benchFolder)
+        os.makedirs(os.path.join(benchFolder, "data"))
+        os.makedirs(os.path.join(benchFolder, "Maps"))
+        
+        random = rand.Random(fixtureSeed)
+        pClass.writeGameData(random)
+        pClass.writeMap(random, pClass.getMapFileName())
+        with open(paramsFileName, "w", encoding="utf-8") as paramsFile:
+            json.dump(params, paramsFile, indent=2)
+        print("fixture generated ({:.2f}s)".format(time.perf_counter() - startTime))
+    
+    @staticmethod
+    def getXml(pRoot, pContent):
+        return '<?xml version="1.0" encoding="UTF-8"?>\n<{0}>{1}</{0}>'.format(pRoot, pContent)
+    
+    @classmethod
+    def getCreatureXml(pClass, pTown, pTier, pIsUpgrade, pPower, pNumber):
+        # unused fields before wanted ones (as in game files)
+        return pClass.getXml("Creature", "<AttackSkill>1</AttackSkill><DefenceSkill>1</DefenceSkill><Flying>false</Flying>"
+                             "<CreatureTown>{}</CreatureTown><CreatureTier>{}</CreatureTier><Upgrade>{}</Upgrade><Power>{}</Power>"
+                             "<WeeklyGrowth>{}</WeeklyGrowth><SubjectOfRandomGeneration>true</SubjectOfRandomGeneration>"
+                             "<MonsterShared href=\"/MapObjects/Creatures/c{}.xdb#xpointer(/AdvMapMonsterShared)\"/>".format(
+                             pTown, pTier, "true" if pIsUpgrade else "false", pPower, max(1, 15 - pTier * 2), pNumber))
+    
+    @classmethod
+    def getSharedXml(pClass, pId):
+        return pClass.getXml("AdvMapMonsterShared", "<Creature>{}</Creature>".format(pId))
+    
+    @classmethod
+    def writeGameData(pClass, pRandom):
+        # creatures are spread over towns, tiers and upgrades (neutral creatures only of tiers 1 - 5)
+        slots = [(town, tier, isUpgrade) for town in pClass.sTowns for tier in range(1, 8) for isUpgrade in (False, True)]
+        slots += [(pClass.sNeutralTown, tier, False) for tier in range(1, 6)]
+        gameFiles = {}
+        for number in range(1, creatures + 1):
+            town, tier, isUpgrade = slots[(number - 1) % len(slots)]
+            power = int(pClass.sTierPowers[tier - 1] * (1.2 if isUpgrade else 1.0) * pRandom.uniform(0.9, 1.1))
+            gameFiles["GameMechanics/Creature/Creatures/{}/c{}.xdb".format(town, number)] = pClass.getCreatureXml(town, tier, isUpgrade, power, number)
+            gameFiles["MapObjects/Creatures/c{}.xdb".format(number)] = pClass.getSharedXml("CREATURE_{}".format(number))
+        
+        arts = []
+        for number in range(artifacts):
+            artType = number % len(pClass.sArtTypes)
+            price = pClass.sArtPrices[artType] + pRandom.randint(0, 4) * 500
+            arts.append("<Item><ID>ARTIFACT_{0}</ID><obj><Type>{1}</Type><Slot>PRIMARY</Slot><CostOfGold>{2}</CostOfGold>"
+                        "<CanBeGeneratedToSell>{3}</CanBeGeneratedToSell>"
+                        "<ArtifactShared href=\"/MapObjects/Artifacts/a{0}.xdb#xpointer(/AdvMapArtifactShared)\"/></obj></Item>".format(
+                        number, pClass.sArtTypes[artType], price, "true" if pRandom.random() < 0.85 else "false"))
+        gameFiles["GameMechanics/RefTables/Artifacts.xdb"] = pClass.getXml("Table_DBArtifact_ArtifactEffect", "<objects>{}</objects>".format("".join(arts)))
+        
+        dataFolder = os.path.join(benchFolder, "data")
+        pClass.writeArch(os.path.join(dataFolder, "data.pak"), gameFiles)
+        if indexPak:
+            pClass.writeArch(os.path.join(dataFolder, "MMH55-Index.pak"), gameFiles)
+        
+        if ncfCreatures > 0:
+            ncfFiles = {}
+            for number in range(10001, 10001 + ncfCreatures):
+                tier = pRandom.randint(1, 7)
+                ncfFiles["GameMechanics/Creature/Creatures/NCF/c{}.xdb".format(number)] = pClass.getCreatureXml(
+                        pClass.sNeutralTown, tier, False, int(pClass.sTierPowers[tier - 1] * pRandom.uniform(0.8, 1.5)), number)
+                ncfFiles["MapObjects/Creatures/c{}.xdb".format(number)] = pClass.getSharedXml("CREATURE_NCF_{}".format(number))
+            pClass.writeArch(os.path.join(dataFolder, "NCF_1.pak"), ncfFiles)
+    
+    @staticmethod
+    def writeArch(pFileName, pFiles):
+        with zipfile.ZipFile(pFileName, "w", zipfile.ZIP_DEFLATED) as arch:
+            for path, data in pFiles.items():
+                arch.writestr(path, data)
+    
+    @classmethod
+    def writeMap(pClass, pRandom, pFileName):
+        mapSize = max(72, int((monsters + mapArtifacts + water + dwellings) ** 0.5 * 4))
+        
+        def getPos():
+            return "<Pos><x>{}</x><y>{}</y><z>0</z></Pos><Rot>0</Rot><Floor>0</Floor>".format(
+                    pRandom.randint(0, mapSize - 1), pRandom.randint(0, mapSize - 1))
+        
+        items = []
+        for i in range(towns):
+            player = "PLAYER_{}".format(i + 1) if i < 2 else "PLAYER_NONE"
+            items.append("<Item href=\"#n:inline(AdvMapTown)\" id=\"item_town{}\"><AdvMapTown>{}<PlayerID>{}</PlayerID>"
+                         "<buildings><Item><Type>TB_FORT</Type><InitialUpgrade>BLD_UPG_NONE</InitialUpgrade><MaxUpgrade>BLD_UPG_5</MaxUpgrade></Item></buildings>"
+                         "</AdvMapTown></Item>".format(i, getPos(), player))
+        for i in range(monsters):
+            # specific creatures, some of them random (by tier)
+            if pRandom.random() < 0.8:
+                shared = "/MapObjects/Creatures/c{}.xdb#xpointer(/AdvMapMonsterShared)".format(pRandom.randint(1, creatures))
+            else:
+                shared = "/MapObjects/Random/Random-Monster-L{}.(AdvMapMonsterShared).xdb#xpointer(/AdvMapMonsterShared)".format(pRandom.randint(1, 7))
+            items.append("<Item href=\"#n:inline(AdvMapMonster)\" id=\"item_monster{}\"><AdvMapMonster>{}<Shared href=\"{}\"/>"
+                         "<Custom>true</Custom><Amount>{}</Amount><Amount2>0</Amount2><Mood>MONSTER_MOOD_AGGRESSIVE</Mood>"
+                         "<Courage>MONSTER_COURAGE_CAN_FLEE_JOIN</Courage><AdditionalStacks/></AdvMapMonster></Item>".format(
+                         i, getPos(), shared, pRandom.randint(1, 60)))
+        for i in range(mapArtifacts):
+            items.append("<Item href=\"#n:inline(AdvMapArtifact)\" id=\"item_artifact{}\"><AdvMapArtifact>{}"
+                         "<Shared href=\"/MapObjects/Artifacts/a{}.xdb#xpointer(/AdvMapArtifactShared)\"/></AdvMapArtifact></Item>".format(
+                         i, getPos(), pRandom.randint(0, artifacts - 1)))
+        for i in range(water):
+            if i % 2 == 0:
+                items.append("<Item href=\"#n:inline(AdvMapTreasure)\" id=\"item_water{}\"><AdvMapTreasure>{}<Shared href=\"{}\"/>"
+                             "<IsCustom>false</IsCustom><Amount>0</Amount><MessageFileRef href=\"\"/></AdvMapTreasure></Item>".format(
+                             i, getPos(), pClass.sWaterShareds[0]))
+            else:
+                items.append("<Item href=\"#n:inline(AdvMapBuilding)\" id=\"item_water{}\"><AdvMapBuilding>{}<Shared href=\"{}\"/>"
+                             "<PlayerID>PLAYER_NONE</PlayerID><GroupID>0</GroupID></AdvMapBuilding></Item>".format(
+                             i, getPos(), pClass.sWaterShareds[1]))
+        for i in range(dwellings):
+            townLink = "#xpointer(id(item_town{})/AdvMapTown)".format(i % towns) if towns > 0 else ""
+            items.append("<Item href=\"#n:inline(AdvMapDwelling)\" id=\"item_dwelling{}\"><AdvMapDwelling>{}"
+                         "<Shared href=\"/MapObjects/Random/RandomDwelling{}.xdb#xpointer(/AdvMapDwellingShared)\"/>"
+                         "<PlayerID>PLAYER_NONE</PlayerID><LinkToTown href=\"{}\"/><RandomCreatures>true</RandomCreatures>"
+                         "<creaturesEnabled><Item>x</Item></creaturesEnabled></AdvMapDwelling></Item>".format(
+                         i, getPos(), pRandom.randint(4, 7), townLink))
+        pRandom.shuffle(items)
+        
+        with zipfile.ZipFile(pFileName, "w", zipfile.ZIP_DEFLATED) as arch:
+            # tab in attribute is written differently by xml libraries (checked by arg "backendCheck")
+            arch.writestr(pClass.sMapFolder + "map.xdb", pClass.getXml("AdvMapDesc", "<TileX>{0}</TileX><TileY>{0}</TileY><objects>{1}</objects>"
+                                                                       "<MapScript href=\"\"/><CustomGameMode name=\"bench&#9;map\"/>".format(mapSize, "".join(items))))
+            arch.writestr(pClass.sMapFolder + "map-tag.xdb", pClass.getXml("AdvMapDescTag", ""))
+            arch.writestr(pClass.sMapFolder + "GroundTerrain.bin", bytes(pRandom.getrandbits(8) for i in range(mapSize * mapSize)))
+
+
+class Bench:
+    @staticmethod
+    def getToolArgs(pMapFileName, pReportFileName):
+        # all stages are run, caches are disabled (every run loads everything)
+        args = [
+            "--pathToGameFolder={}".format(os.path.abspath(benchFolder)),
+            "--loadMapFromBck=false", "--createMapBck=false", "--catalogCache=false", "--mapCache=false",
+            "--seed=1", "--bonusChest=1", "--bonusArt=true", "--townBuild=TB_FORT,1,3,ALL",
+            "--profile={}".format(pReportFileName)
+        ]
+        if ncfCreatures > 0:
+            args += ["--creaNCF=true", "--creaNeutralRatio=0"]
+        return args + toolArgs + [pMapFileName]
+    
+    @classmethod
+    def runTool(pClass):
+        # change copy of fixture map by benchmarked script, times of stages are read from its report
+        mapFileName = os.path.join(benchFolder, "Maps", "run.h5m")
+        reportFileName = os.path.join(benchFolder, "report.json")
+        shutil.copyfile(Fixture.getMapFileName(), mapFileName)
+        startTime = time.perf_counter()
+        process = subprocess.run([sys.executable, script] + pClass.getToolArgs(mapFileName, reportFileName),
+                                 stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True)
+        wallTime = time.perf_counter() - startTime
+        if process.returncode != 0 or not os.path.exists(reportFileName):
+            mapalt.Log.error("Benchmarked script failed:\n{}".format(process.stdout))
+        
+        with open(reportFileName, "r", encoding="utf-8") as reportFile:
+            report = json.load(reportFile)
+        os.remove(reportFileName)
+        
+        times = {"process": {"wall": wallTime, "cpu": None}}
+        for stageReport in report["reports"]:
+            reportName = "catalogs" if stageReport["name"] == "catalogs" else "map"
+            times[reportName] = {"wall": stageReport["wall"], "cpu": stageReport["cpu"]}
+            for record in stageReport["stages"]:
+                times["{}/{}".format(reportName, record["name"])] = {"wall": record["wall"], "cpu": record["cpu"]}
+        return times, report
+    
+    @classmethod
+    def run(pClass):
+        runs = []
+        for i in range(repeats):
+            times, report = pClass.runTool()
+            runs.append(times)
+            print("run {}: {:.3f}s".format(i + 1, times["process"]["wall"]))
+        
+        # median of runs (stages of all runs)
+        stages = {}
+        for name in runs[0]:
+            walls = [times[name]["wall"] for times in runs if name in times]
+            cpus = [times[name]["cpu"] for times in runs if name in times and times[name]["cpu"] is not None]
+            stages[name] = {
+                "wall": statistics.median(walls),
+                "wallMin": min(walls),
+                "cpu": statistics.median(cpus) if len(cpus) > 0 else None
+            }
+        
+        return {
+            "version": report["version"],
+            "script": os.path.abspath(script),
+            "toolArgs": toolArgs,
+            "python": report["python"],
+            "xmlBackend": report["xmlBackend"],
+            "numpy": report["numpy"],
+            "date": time.strftime("%Y-%m-%d %H:%M:%S"),
+            "repeats": repeats,
+            "fixture": Fixture.getParams(),
+            "stages": stages
+        }
+    
+    @staticmethod
+    def loadResults():
+        if os.path.exists(results):
+            with open(results, "r", encoding="utf-8") as resultsFile:
+                return json.load(resultsFile)
+        return {}
+    
+    @staticmethod
+    def saveResults(pResults):
+        with open(results, "w", encoding="utf-8") as resultsFile:
+            json.dump(pResults, resultsFile, indent=2)
+        print("results saved ({}, label: {})".format(results, label))
+    
+    @staticmethod
+    def printResult(pResult, pCompared=None):
+        # stage times (and ratio to compared result, < 1.0 == faster)
+        print("")
+        header = "{:<40} {:>10} {:>10}".format("stage", "wall [s]", "cpu [s]")
+        if pCompared is not None:
+            header += " {:>12} {:>7}".format("compared [s]", "ratio")
+            if pCompared["fixture"] != pResult["fixture"]:
+                print("compared result has other fixture: {}".format(pCompared["fixture"]))
+        print(header)
+        for name, stage in pResult["stages"].items():
+            line = "{:<40} {:>10.3f} {:>10}".format(name[:40], stage["wall"], "{:.3f}".format(stage["cpu"]) if stage["cpu"] is not None else "")
+            if pCompared is not None:
+                comparedStage = pCompared["stages"].get(name)
+                if comparedStage is not None:
+                    ratio = stage["wall"] / comparedStage["wall"] if comparedStage["wall"] > 0 else 0.0
+                    line += " {:>12.3f} {:>7.2f}".format(comparedStage["wall"], ratio)
+            print(line)
+
+
+class Scaling:
+    sSizeArgs = ["monsters", "mapArtifacts", "water", "dwellings", "towns"]
+    
+    @staticmethod
+    def getExponent(pSizes, pTimes):
+        # slope of least squares line of log(time) ~ log(size)
+        xs = [math.log(size) for size in pSizes]
+        ys = [math.log(max(stageTime, 1e-6)) for stageTime in pTimes]
+        meanX = sum(xs) / len(xs)
+        meanY = sum(ys) / len(ys)
+        return sum((x - meanX) * (y - meanY) for x, y in zip(xs, ys)) / sum((x - meanX) ** 2 for x in xs)
+    
+    @classmethod
+    def setSize(pClass, pSize, pRatios, pFolder):
+        # fixture of map with pSize objects (split by ratios), every size has own folder
+        g = globals()
+        ratioSum = sum(pRatios.values())
+        for argName in pClass.sSizeArgs:
+            g[argName] = int(round(pSize * pRatios[argName] / ratioSum))
+        g["towns"] = max(2, towns)
+        g["benchFolder"] = os.path.join(pFolder, "scaling_{}".format(pSize))
+    
+    @classmethod
+    def run(pClass):
+        # stages of all sizes (only map stages, catalogs do not depend on map)
+        ratios = {argName: globals()[argName] for argName in pClass.sSizeArgs}
+        if sum(ratios.values()) == 0:
+            mapalt.Log.error("Map has no objects!")
+        folder = benchFolder
+        sizeResults = []
+        for size in scaling:
+            print("size {}:".format(size))
+            pClass.setSize(size, ratios, folder)
+            Fixture.update()
+            sizeResults.append(Bench.run())
+        
+        stages = {}
+        failedStages = []
+        for name in sizeResults[-1]["stages"]:
+            if not name.startswith("map"):
+                continue
+            times = [result["stages"][name]["wall"] for result in sizeResults if name in result["stages"]]
+            if len(times) != len(scaling):
+                continue
+            
+            bound = stageExponents.get(name, maxExponent)
+            stage = {"times": times, "bound": bound, "exponent": None, "checked": times[-1] >= minTime}
+            if stage["checked"]:
+                stage["exponent"] = pClass.getExponent(scaling, times)
+                if stage["exponent"] > bound:
+                    failedStages.append(name)
+            stages[name] = stage
+        
+        return {
+            "version": sizeResults[-1]["version"],
+            "date": time.strftime("%Y-%m-%d %H:%M:%S"),
+            "sizes": scaling,
+            "ratios": ratios,
+            "stages": stages,
+            "failedStages": failedStages
+        }
+    
+    @staticmethod
+    def printResult(pResult):
+        print("")
+        print("{:<40}".format("stage") + "".join(" {:>10}".format(size) for size in pResult["sizes"]) + " {:>8} {:>6}".format("exponent", "bound"))
+        for name, stage in pResult["stages"].items():
+            line = "{:<40}".format(name[:40]) + "".join(" {:>10.3f}".format(stageTime) for stageTime in stage["times"])
+            if stage["checked"]:
+                line += " {:>8.2f} {:>6.2f}{}".format(stage["exponent"], stage["bound"], "  FAILED" if name in pResult["failedStages"] else "")
+            else:
+                line += " {:>8} {:>6.2f}".format("-", stage["bound"])
+            print(line)
+        
+        if len(pResult["failedStages"]) > 0:
+            print("stages scale worse than bound: {}".format(", ".join(pResult["failedStages"])))
+        else:
+            print("all stages scale within bounds")
+
+
+class Golden:
+    sMapFile = "map.xdb"
+    sKsCoef = 1.95 # Kolmogorov-Smirnov critical value coefficient (alpha 0.001)
+    sChiZ = 3.09 # normal quantile of chi-square critical value (alpha 0.001)
+    
+    @staticmethod
+    def getToolArgs(pSeed, pMapFileName, pArgs, pUseSeed=True):
+        # only args known by older versions (caches of new versions are kept enabled - results must be same)
+        args = [
+            "--pathToGameFolder={}".format(os.path.abspath(benchFolder)),
+            "--loadMapFromBck=false", "--createMapBck=false", 
+            "--bonusChest=1", "--bonusArt=true", "--townBuild=TB_FORT,1,3,ALL"
+        ]
+        if pUseSeed:
+            args.append("--seed={}".format(pSeed))
+        if ncfCreatures > 0:
+            args += ["--creaNCF=true", "--creaNeutralRatio=0"]
+        return args + pArgs + [pMapFileName]
+    
+    @staticmethod
+    def runScript(pScript, pArgs, pMapFileName):
+        shutil.copyfile(Fixture.getMapFileName(), pMapFileName)
+        process = subprocess.run([sys.executable, pScript] + pArgs, 
+                                 stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True)
+        if process.returncode != 0 or "map saved" not in process.stdout:
+            mapalt.Log.error("Script failed ({}):\n{}".format(pScript, process.stdout))
+    
+    @classmethod
+    def readMap(pClass, pMapFileName):
+        # canonicalized map file and crc of other files
+        members = {}
+        mapData = None
+        with zipfile.ZipFile(pMapFileName, "r") as arch:
+            for info in arch.infolist():
+                if info.filename.endswith(pClass.sMapFile):
+                    mapData = mapalt.ET.canonicalize(arch.read(info).decode("utf-8"), strip_text=True)
+                else:
+                    members[info.filename] = info.CRC
+        return mapData, members
+    
+    @staticmethod
+    def getFirstDiff(pData, pRefData):
+        # position and surroundings of first different char
+        pos = next((i for i, (char, refChar) in enumerate(zip(pData, pRefData)) if char != refChar), min(len(pData), len(pRefData)))
+        return "at char {}:\n  reference: ...{}...\n  tested:    ...{}...".format(
+                pos, pRefData[max(0, pos - 80):pos + 80], pData[max(0, pos - 80):pos + 80])
+    
+    @staticmethod
+    def getCreatures():
+        # tier and power of fixture creatures (by shared and by id)
+        creatures = {}
+        sharedIds = {}
+        for fileName in ["data.pak", "NCF_1.pak"]:
+            archFileName = os.path.join(benchFolder, "data", fileName)
+            if not os.path.exists(archFileName):
+                continue
+            with zipfile.ZipFile(archFileName, "r") as arch:
+                for path in arch.namelist():
+                    if path.startswith("GameMechanics/Creature/Creatures/"):
+                        root = mapalt.ET.fromstring(arch.read(path))
+                        creatures[root.find("MonsterShared").get("href")] = (int(root.findtext("CreatureTier")), int(root.findtext("Power")))
+                    elif path.startswith("MapObjects/Creatures/"):
+                        sharedIds["/{}#xpointer(/AdvMapMonsterShared)".format(path)] = mapalt.ET.fromstring(arch.read(path)).findtext("Creature")
+        return creatures, {sharedIds[shared]: creature for shared, creature in creatures.items() if shared in sharedIds}
+    
+    @staticmethod
+    def getArmies(pMapFileName, pCreatures, pCreaturesById):
+        # power, tier (of strongest stack), mood and number of stacks of armies on map
+        armies = []
+        with zipfile.ZipFile(pMapFileName, "r") as arch:
+            mapFileName = next(name for name in arch.namelist() if name.endswith(Golden.sMapFile))
+            root = mapalt.ET.fromstring(arch.read(mapFileName))
+        for armyXml in root.iter("AdvMapMonster"):
+            stacks = [(pCreatures.get(armyXml.find("Shared").get("href")), int(armyXml.findtext("Amount", "0")))]
+            for stackXml in armyXml.iterfind("AdditionalStacks/Item"):
+                stacks.append((pCreaturesById.get(stackXml.findtext("Creature")), int(stackXml.findtext("Amount", "0"))))
+            stacks = [(creature, count) for creature, count in stacks if creature is not None]
+            if len(stacks) > 0:
+                armies.append({
+                    "power": sum(creature[1] * count for creature, count in stacks),
+                    "tier": max(stacks, key=lambda stack: stack[0][1] * stack[1])[0][0],
+                    "mood": armyXml.findtext("Mood", ""),
+                    "stacks": len(stacks)
+                })
+        return armies
+    
+    @classmethod
+    def getKs(pClass, pValues, pRefValues):
+        # two sample Kolmogorov-Smirnov statistic and its critical value
+        values = sorted(pValues)
+        refValues = sorted(pRefValues)
+        statistic = 0.0
+        for value in set(values) | set(refValues):
+            statistic = max(statistic, abs(bisect.bisect_right(values, value) / len(values) - bisect.bisect_right(refValues, value) / len(refValues)))
+        return statistic, pClass.sKsCoef * math.sqrt((len(values) + len(refValues)) / (len(values) * len(refValues)))
+    
+    @classmethod
+    def getChiSquare(pClass, pValues, pRefValues):
+        # chi-square statistic of homogeneity and its critical value (Wilson-Hilferty approximation)
+        counts = collections.Counter(pValues)
+        refCounts = collections.Counter(pRefValues)
+        categories = set(counts) | set(refCounts)
+        statistic = 0.0
+        for category in categories:
+            total = counts[category] + refCounts[category]
+            for sampleCounts, sampleSize in [(counts, len(pValues)), (refCounts, len(pRefValues))]:
+                expected = total * sampleSize / (len(pValues) + len(pRefValues))
+                statistic += (sampleCounts[category] - expected) ** 2 / expected
+        freedom = max(1, len(categories) - 1)
+        return statistic, freedom * (1 - 2 / (9 * freedom) + pClass.sChiZ * math.sqrt(2 / (9 * freedom))) ** 3
+    
+    @classmethod
+    def run(pClass):
+        Fixture.update()
+        creatures, creaturesById = pClass.getCreatures()
+        # same file names (random values of map depend on its name)
+        mapFileName = os.path.join(benchFolder, "Maps", "golden.h5m")
+        refMapFileName = os.path.join(benchFolder, "Maps", "reference", "golden.h5m")
+        os.makedirs(os.path.dirname(refMapFileName), exist_ok=True)
+        
+        failures = []
+        armies = []
+        refArmies = []
+        for seed in range(1, goldenRuns + 1):
+            pClass.runScript(script, pClass.getToolArgs(seed, mapFileName, toolArgs), mapFileName)
+            pClass.runScript(reference, pClass.getToolArgs(seed, refMapFileName, referenceArgs, referenceSeed), refMapFileName)
+            
+            mapData, members = pClass.readMap(mapFileName)
+            refMapData, refMembers = pClass.readMap(refMapFileName)
+            if members != refMembers:
+                failures.append("seed {}: other files differ ({})".format(seed, ", ".join(sorted(
+                        name for name in set(members) | set(refMembers) if members.get(name) != refMembers.get(name)))))
+            if mapData != refMapData:
+                if exact:
+                    failures.append("seed {}: map file differs {}".format(seed, pClass.getFirstDiff(mapData, refMapData)))
+                else:
+                    print("seed {}: map file differs (not checked)".format(seed))
+            else:
+                print("seed {}: map file is same".format(seed))
+            
+            armies += pClass.getArmies(mapFileName, creatures, creaturesById)
+            refArmies += pClass.getArmies(refMapFileName, creatures, creaturesById)
+        
+        # distributions of all runs
+        print("")
+        print("{:<10} {:>14} {:>14} {:>10} {:>10}".format("armies", "reference", "tested", "statistic", "critical"))
+        if len(armies) == 0 or len(refArmies) == 0:
+            failures.append("no armies on changed map")
+        else:
+            for key, getTest in [("power", pClass.getKs), ("tier", pClass.getChiSquare), ("mood", pClass.getChiSquare), ("stacks", pClass.getChiSquare)]:
+                values = [army[key] for army in armies]
+                refValues = [army[key] for army in refArmies]
+                statistic, critical = getTest(values, refValues)
+                summary = "{:.1f}".format(statistics.mean(values)) if key != "mood" else str(len(set(values)))
+                refSummary = "{:.1f}".format(statistics.mean(refValues)) if key != "mood" else str(len(set(refValues)))
+                print("{:<10} {:>14} {:>14} {:>10.3f} {:>10.3f}{}".format(key, refSummary, summary, statistic, critical, "  FAILED" if statistic > critical else ""))
+                if statistic > critical:
+                    failures.append("{} of armies differs ({:.3f} > {:.3f})".format(key, statistic, critical))
+            print("armies: {} (reference: {})".format(len(armies), len(refArmies)))
+        
+        for failure in failures:
+            print(failure)
+        if len(failures) > 0:
+            print("outputs are different")
+        else:
+            print("outputs are same" if exact else "outputs are equivalent (distributions of armies)")
+        return len(failures) == 0
+
+
+class FillCheck:
+    # groups of tier powers and army powers (multiples of loop limit)
+    sGroups = [[0, 1], [0, 1, 2, 3], [4, 5, 6], [0, 6]]
+    sLimitRatios = [1.5, 10]
+    
+    @staticmethod
+    def getCreas(pPowers):
+        creas = []
+        for power in pPowers:
+            crea = mapalt.Creature()
+            crea.mPower = power
+            creas.append({"crea": crea, "count": 0})
+        return creas
+    
+    @classmethod
+    def getDraws(pClass, pPowers, pArmyPower, pFill):
+        # power and counts of filled armies
+        powers = []
+        counts = [[] for power in pPowers]
+        for i in range(fillDraws):
+            creas = pClass.getCreas(pPowers)
+            pFill(creas, pArmyPower, pArmyPower)
+            powers.append(sum(crea["count"] * power for crea, power in zip(creas, pPowers)))
+            for stackCounts, crea in zip(counts, creas):
+                stackCounts.append(crea["count"])
+        return powers, counts
+    
+    @classmethod
+    def run(pClass):
+        rand.seed(fixtureSeed)
+        failures = []
+        print("{:<24} {:>9} {:>12} {:>12} {:>8} {:>10} {:>10}".format("group", "army", "loop sd", "closed sd", "ratio", "statistic", "critical"))
+        for group in pClass.sGroups:
+            powers = [Fixture.sTierPowers[tier] for tier in group]
+            for limitRatio in pClass.sLimitRatios:
+                armyPower = round(limitRatio * mapalt.Army.sAddLoopLimit * sum(powers) / len(powers))
+                refPowers, refCounts = pClass.getDraws(powers, armyPower, mapalt.Army.addMissingPowerByLoop)
+                armyPowers, counts = pClass.getDraws(powers, armyPower, mapalt.Army.addMissingPower)
+                
+                # power and every stack (worst statistic relative to its critical value is printed)
+                tests = [Golden.getKs(armyPowers, refPowers)]
+                tests += [Golden.getKs(stackCounts, refStackCounts) for stackCounts, refStackCounts in zip(counts, refCounts)]
+                statistic, critical = max(tests, key=lambda test: test[0] / test[1])
+                refSd = statistics.stdev(refPowers)
+                sd = statistics.stdev(armyPowers)
+                failed = any(test[0] > test[1] for test in tests)
+                name = ",".join(str(power) for power in powers)
+                print("{:<24} {:>9} {:>12.1f} {:>12.1f} {:>8.3f} {:>10.3f} {:>10.3f}{}".format(
+                        name, armyPower, refSd, sd, sd / refSd if refSd > 0 else 1.0, statistic, critical, "  FAILED" if failed else ""))
+                if failed:
+                    failures.append("fill of group {} (army {}) differs ({:.3f} > {:.3f})".format(name, armyPower, statistic, critical))
+        
+        for failure in failures:
+            print(failure)
+        print("closed form fill differs from loop" if len(failures) > 0 else "closed form fill is same as loop (distributions)")
+        return len(failures) == 0
+
+
+class BackendCheck:
+    sBackends = ["stdlib", "lxml"]
+    
+    @staticmethod
+    def readMap(pMapFileName):
+        # raw map file and crc of other files
+        members = {}
+        mapData = None
+        with zipfile.ZipFile(pMapFileName, "r") as arch:
+            for info in arch.infolist():
+                if info.filename.endswith(Golden.sMapFile):
+                    mapData = arch.read(info)
+                else:
+                    members[info.filename] = info.CRC
+        return mapData, members
+    
+    @classmethod
+    def run(pClass):
+        if mapalt.LET is None:
+            mapalt.Log.error("Module lxml is not installed!")
+        Fixture.update()
+        
+        failures = []
+        for seed in range(1, goldenRuns + 1):
+            # same file names (random values of map depend on its name)
+            outputs = []
+            for backend in pClass.sBackends:
+                mapFileName = os.path.join(benchFolder, "Maps", backend, "backend.h5m")
+                os.makedirs(os.path.dirname(mapFileName), exist_ok=True)
+                args = [arg for arg in toolArgs if not arg.startswith("--xmlBackend=")] + ["--xmlBackend={}".format(backend)]
+                Golden.runScript(script, Golden.getToolArgs(seed, mapFileName, args), mapFileName)
+                outputs.append(pClass.readMap(mapFileName))
+            
+            (refMapData, refMembers), (mapData, members) = outputs
+            if members != refMembers:
+                failures.append("seed {}: other files differ ({})".format(seed, ", ".join(sorted(
+                        name for name in set(members) | set(refMembers) if members.get(name) != refMembers.get(name)))))
+            if mapData != refMapData:
+                failures.append("seed {}: map file differs (reference: stdlib, tested: lxml) {}".format(seed, Golden.getFirstDiff(
+                        mapData.decode("utf-8", "replace"), refMapData.decode("utf-8", "replace"))))
+            else:
+                print("seed {}: map file is same ({} bytes)".format(seed, len(mapData)))
+        
+        for failure in failures:
+            print(failure)
+        print("maps saved by backends differ" if len(failures) > 0 else "maps saved by backends are same")
+        return len(failures) == 0
+
+
+# main func
+def run(pArgs=None):
+    # returns False, when some stage scales worse than bound (or outputs differ from reference)
+    if pArgs is None:
+        pArgs = sys.argv[1:]
+    parseArgs(pArgs)
+    
+    if fillCheck:
+        return FillCheck.run()
+    
+    if backendCheck:
+        return BackendCheck.run()
+    
+    if len(reference) > 0:
+        return Golden.run()
+    
+    if len(scaling) > 0:
+        result = Scaling.run()
+        Scaling.printResult(result)
+        storedResults = Bench.loadResults()
+        storedResults["{} scaling".format(label)] = result
+        Bench.saveResults(storedResults)
+        return len(result["failedStages"]) == 0
+    
+    Fixture.update()
+    result = Bench.run()
+    
+    storedResults = Bench.loadResults()
+    compared = None
+    if len(compare) > 0:
+        compared = storedResults.get(compare)
+        if compared is None:
+            mapalt.Log.error("Results not found: \"{}\"".format(compare))
+    Bench.printResult(result, compared)
+    
+    storedResults[label] = result
+    Bench.saveResults(storedResults)
+    return True
+
+
+if __name__ == "__main__":
+    # prog execution
+    try:
+        if not run():
+            sys.exit(1)
+    except mapalt.MyException as ex:
+        print(str(ex))
+        sys.exit()
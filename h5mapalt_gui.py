@@ -1,7 +1,7 @@
 #!/usr/bin/env python3
 # -*- coding: UTF-8 -*-
 
-import sys
+import sys, multiprocessing
 import h5mapalt as mapalt
 import wx
 
@@ -386,19 +386,24 @@ class MyApp(wx.App):
         return True
 
 
-# prog execution
-if "-h" in sys.argv or "--help" in sys.argv:
-    mapalt.resetArgs()
-    mapalt.printHelp()
-    sys.exit()
-elif "--nogui" in sys.argv:
-    try:
-        mapalt.run()
-    except mapalt.MyException as ex:
-        print(str(ex))
+# main func
+def main():
+    if "-h" in sys.argv or "--help" in sys.argv:
+        mapalt.resetArgs()
+        mapalt.printHelp()
         sys.exit()
-else:
-    app = MyApp()
-    app.MainLoop()
+    elif "--nogui" in sys.argv:
+        try:
+            mapalt.run()
+        except mapalt.MyException as ex:
+            print(str(ex))
+            sys.exit()
+    else:
+        app = MyApp()
+        app.MainLoop()
 
 
+if __name__ == "__main__":
+    # prog execution (worker processes import this module too - they must not run it)
+    multiprocessing.freeze_support()
+    main()